@@ -3,11 +3,12 @@
 # license that can be found in the LICENSE file.
 
 import json
+import os
 from bson import json_util
 
 from flask import request, Response
 
-from rpaas import auth, get_manager, storage, plan, flavor
+from rpaas import auth, get_manager, nginx, storage, plan, flavor, tasks
 
 
 @auth.required
@@ -20,6 +21,44 @@ def healings():
     return json.dumps(healing_list, default=json_util.default)
 
 
+@auth.required
+def warm_pools():
+    manager = get_manager()
+    sizes = tasks.parse_warm_pools(os.environ.get("RPAAS_WARM_POOLS"))
+    stats = dict((s.pop("_id"), s) for s in manager.storage.list_warm_pool_stats())
+    pools = []
+    for key in sorted(set(sizes) | set(stats)):
+        group = tasks.warm_pool_group(key)
+        pool = {"hits": 0, "misses": 0, "replenished": 0, "replenish_seconds": 0}
+        pool.update(stats.get(key, {}))
+        pool.update({"pool": key, "size": sizes.get(key, 0),
+                     "ready": manager.storage.count_pool_hosts(group, "ready"),
+                     "booting": manager.storage.count_pool_hosts(group, "booting")})
+        if pool["replenished"]:
+            pool["avg_replenish_seconds"] = pool["replenish_seconds"] / pool["replenished"]
+        pools.append(pool)
+    return json.dumps(pools)
+
+
+@auth.required
+def drift():
+    reports = get_manager().storage.list_drift_reports()
+    return json.dumps(reports, default=json_util.default)
+
+
+@auth.required
+def consul_cache():
+    kv_cache = get_manager().consul_manager.kv_cache
+    if kv_cache is None:
+        return "consul kv cache is disabled", 404
+    return json.dumps(kv_cache.stats())
+
+
+@auth.required
+def nginx_admin_clients():
+    return json.dumps(nginx.admin_clients_stats())
+
+
 @auth.required
 def create_plan():
     name = request.form.get("name")
@@ -33,6 +72,7 @@ def create_plan():
         return "plan already exists", 409
     except plan.InvalidPlanError as e:
         return unicode(e), 400
+    manager.catalog.invalidate()
     return "", 201
 
 
@@ -40,7 +80,7 @@ def create_plan():
 def retrieve_plan(name):
     manager = get_manager()
     try:
-        plan = manager.storage.find_plan(name)
+        plan = manager.catalog.find_plan(name)
     except storage.PlanNotFoundError:
         return "plan not found", 404
     return json.dumps(plan.to_dict())
@@ -55,6 +95,8 @@ def update_plan(name):
         manager.storage.update_plan(name, description, config)
     except storage.PlanNotFoundError:
         return "plan not found", 404
+    manager.config_resolver.invalidate(plan_name=name)
+    manager.catalog.invalidate()
     return ""
 
 
@@ -65,6 +107,8 @@ def delete_plan(name):
         manager.storage.delete_plan(name)
     except storage.PlanNotFoundError:
         return "plan not found", 404
+    manager.config_resolver.invalidate(plan_name=name)
+    manager.catalog.invalidate()
     return ""
 
 
@@ -81,6 +125,7 @@ def create_flavor():
         return "flavor already exists", 409
     except flavor.InvalidFlavorError as e:
         return unicode(e), 400
+    manager.catalog.invalidate()
     return "", 201
 
 
@@ -88,7 +133,7 @@ def create_flavor():
 def retrieve_flavor(name):
     manager = get_manager()
     try:
-        flavor = manager.storage.find_flavor(name)
+        flavor = manager.catalog.find_flavor(name)
     except storage.FlavorNotFoundError:
         return "flavor not found", 404
     return json.dumps(flavor.to_dict())
@@ -103,6 +148,8 @@ def update_flavor(name):
         manager.storage.update_flavor(name, description, config)
     except storage.FlavorNotFoundError:
         return "flavor not found", 404
+    manager.config_resolver.invalidate(flavor_name=name)
+    manager.catalog.invalidate()
     return ""
 
 
@@ -113,6 +160,8 @@ def delete_flavor(name):
         manager.storage.delete_flavor(name)
     except storage.FlavorNotFoundError:
         return "flavor not found", 404
+    manager.config_resolver.invalidate(flavor_name=name)
+    manager.catalog.invalidate()
     return ""
 
 
@@ -142,13 +191,22 @@ def restore_instance():
     instance_name = request.form.get("instance_name")
     if not instance_name:
         return "instance name required", 400
+    max_unavailable = request.form.get("max_unavailable")
     manager = get_manager()
-    return Response(manager.restore_instance(instance_name), content_type='event/stream')
+    return Response(manager.restore_instance(instance_name, max_unavailable), content_type='event/stream')
 
 
 def register_views(app, list_plans, list_flavors):
     app.add_url_rule("/admin/healings", methods=["GET"],
                      view_func=healings)
+    app.add_url_rule("/admin/warm-pools", methods=["GET"],
+                     view_func=warm_pools)
+    app.add_url_rule("/admin/consul-cache", methods=["GET"],
+                     view_func=consul_cache)
+    app.add_url_rule("/admin/nginx-admin-clients", methods=["GET"],
+                     view_func=nginx_admin_clients)
+    app.add_url_rule("/admin/drift", methods=["GET"],
+                     view_func=drift)
     app.add_url_rule("/admin/plans", methods=["GET"],
                      view_func=list_plans)
     app.add_url_rule("/admin/plans", methods=["POST"],
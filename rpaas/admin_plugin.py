@@ -282,9 +282,13 @@ def list_healings(args):
 def restore_instance(args):
     parser = _base_args("restore-instance")
     parser.add_argument("-i", "--instance", required=True)
+    parser.add_argument("-u", "--max-unavailable", required=False)
     parsed_args = parser.parse_args(args)
+    params = {"instance_name": parsed_args.instance}
+    if parsed_args.max_unavailable:
+        params["max_unavailable"] = parsed_args.max_unavailable
     result = proxy_request(parsed_args.service, "/admin/restore", method="POST",
-                           body=urllib.urlencode({"instance_name": parsed_args.instance}),
+                           body=urllib.urlencode(params),
                            headers={"Content-Type": "application/x-www-form-urlencoded"})
     if result.getcode() == 200:
         for msg in parser_result(result):
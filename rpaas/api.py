@@ -28,6 +28,9 @@ else:
 api.logger.addHandler(handler)
 hm.log.set_handler(handler)
 
+if not check_option_enable(os.environ.get("SKIP_ENSURE_INDEXES")):
+    storage.MongoDBStorage().ensure_indexes()
+
 if check_option_enable(os.environ.get("RUN_LE_RENEWER")):
     from rpaas.ssl_plugins import le_renewer
     le_renewer.LeRenewer().start()
@@ -50,21 +53,33 @@ if check_option_enable(os.environ.get("RUN_SESSION_RESUMPTION")):
     from rpaas.session_resumption import SessionResumption
     SessionResumption().start()
 
+if check_option_enable(os.environ.get("RUN_WARM_POOL")):
+    from rpaas.warm_pool import WarmPool
+    WarmPool().start()
+
+if check_option_enable(os.environ.get("RUN_DRIFT_SCANNER")):
+    from rpaas.drift_scanner import DriftScanner
+    DriftScanner().start()
+
 
 @api.route("/resources/plans", methods=["GET"])
 @api.route("/resources/<name>/plans", methods=["GET"])
 @auth.required
 def plans(name=None):
-    plans = get_manager().storage.list_plans()
-    return json.dumps([p.to_dict() for p in plans])
+    return catalog_response(*get_manager().catalog.plans_json())
 
 
 @api.route("/resources/flavors", methods=["GET"])
 @api.route("/resources/<name>/flavors", methods=["GET"])
 @auth.required
 def flavors(name=None):
-    flavors = get_manager().storage.list_flavors()
-    return json.dumps([f.to_dict() for f in flavors])
+    return catalog_response(*get_manager().catalog.flavors_json())
+
+
+def catalog_response(body, etag):
+    response = Response(body)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 @api.route("/resources", methods=["POST"])
@@ -406,21 +421,31 @@ def purge_location(name):
 @api.route("/resources/<name>/purge/bulk", methods=["POST"])
 def purge_bulk_location(name):
     purges = request.get_json()
-    result = []
     if not purges or not isinstance(purges, list):
         return 'missing required list of purges', 400
-
+    locations = []
     for purge in purges:
-        path = purge.get("path")
-        preserve_path = purge.get("preserve_path", False)
-        try:
-            instances_purged = get_manager().purge_location(name, path, preserve_path)
-            result.append({"path": path, "instances_purged": instances_purged})
-        except storage.InstanceNotFoundError:
-            return "Instance not found", 404
-        except tasks.NotReadyError as e:
-            return "Instance not ready: {}".format(e), 412
+        if not isinstance(purge, dict) or not purge.get("path"):
+            return 'missing required path', 400
+        locations.append((purge["path"], check_option_enable(purge.get("preserve_path"))))
+    try:
+        purged = get_manager().purge_locations(name, locations)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    except tasks.NotReadyError as e:
+        return "Instance not ready: {}".format(e), 412
 
+    if check_option_enable(request.args.get("stream")):
+        def stream():
+            for path, instances_purged in purged:
+                yield json.dumps({"path": path, "instances_purged": instances_purged}) + "\n"
+        return Response(stream(), status=200, mimetype='application/x-ndjson')
+
+    positions = {}
+    for idx, (path, _) in enumerate(locations):
+        positions.setdefault(path, idx)
+    result = [{"path": path, "instances_purged": instances_purged} for path, instances_purged in purged]
+    result.sort(key=lambda r: positions.get(r["path"]))
     response = api.response_class(
         response=json.dumps(result),
         status=200,
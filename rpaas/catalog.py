@@ -0,0 +1,125 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import copy
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from rpaas import flavor, plan, storage
+from rpaas.misc import ExpiringCache, check_option_enable
+
+
+class _Snapshot(object):
+
+    def __init__(self, items):
+        self.items = items
+        self.by_name = dict((item["name"], item) for item in items)
+        self.body = json.dumps(items)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class Catalog(object):
+    """
+    Plans and flavors as served by the API, along with their JSON and a
+    strong ETag. When RPAAS_CATALOG_CACHE is enabled they are kept in memory
+    for RPAAS_CATALOG_CACHE_TTL seconds, and admin changes are broadcast to
+    the other API processes through a Redis channel, each one dropping its
+    copy as soon as it gets the message.
+    """
+
+    kinds = {"plans": (plan.Plan, storage.PlanNotFoundError, "find_plan"),
+             "flavors": (flavor.Flavor, storage.FlavorNotFoundError, "find_flavor")}
+
+    def __init__(self, storage, config=None, redis_conn=None):
+        config = config or {}
+        self.storage = storage
+        self.redis_conn = redis_conn
+        self.enabled = check_option_enable(config.get("RPAAS_CATALOG_CACHE"))
+        self.ttl = int(config.get("RPAAS_CATALOG_CACHE_TTL", 300))
+        service_name = config.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.channel = config.get("RPAAS_CATALOG_CHANNEL", "catalog:{}".format(service_name))
+        self.snapshots = ExpiringCache()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def plans(self):
+        return self._objects("plans")
+
+    def flavors(self):
+        return self._objects("flavors")
+
+    def find_plan(self, name):
+        return self._find("plans", name)
+
+    def find_flavor(self, name):
+        return self._find("flavors", name)
+
+    def plans_json(self):
+        snapshot = self._snapshot("plans")
+        return snapshot.body, snapshot.etag
+
+    def flavors_json(self):
+        snapshot = self._snapshot("flavors")
+        return snapshot.body, snapshot.etag
+
+    def invalidate(self, publish=True):
+        self.snapshots.clear()
+        if publish and self.enabled and self.redis_conn is not None:
+            try:
+                self.redis_conn.publish(self.channel, "invalidate")
+            except Exception as e:
+                logging.error("Error broadcasting catalog change: {}".format(e))
+
+    def _objects(self, kind):
+        factory, _, _ = self.kinds[kind]
+        return [factory(**copy.deepcopy(item)) for item in self._snapshot(kind).items]
+
+    def _find(self, kind, name):
+        factory, not_found, find = self.kinds[kind]
+        if not self.enabled:
+            return getattr(self.storage, find)(name)
+        item = self._snapshot(kind).by_name.get(name)
+        if item is None:
+            raise not_found()
+        return factory(**copy.deepcopy(item))
+
+    def _snapshot(self, kind):
+        if not self.enabled:
+            return self._load(kind)
+        self._start_listener()
+        return self.snapshots.get(kind, lambda: self._load(kind), self.ttl)
+
+    def _load(self, kind):
+        if kind == "plans":
+            objects = self.storage.list_plans()
+        else:
+            objects = self.storage.list_flavors()
+        return _Snapshot([o.to_dict() for o in objects])
+
+    def _start_listener(self):
+        if self.redis_conn is None:
+            return
+        with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = threading.Thread(target=self._listen)
+            self.listener.daemon = True
+        self.listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # changes may have been missed while not subscribed
+                self.invalidate(publish=False)
+                for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.invalidate(publish=False)
+            except Exception as e:
+                logging.error("Error listening to catalog changes: {}".format(e))
+            time.sleep(1)
@@ -0,0 +1,57 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import copy
+import threading
+
+from rpaas.misc import ExpiringCache
+
+
+class ConfigResolver(object):
+    """
+    Resolves the effective config of a plan and flavor on top of a base
+    config. Plan and flavor configs are cached for RPAAS_CONFIG_CACHE_TTL
+    seconds, and the merged config of each plan and flavor pair is reused
+    for as long as their versions do not change. Callers get a shallow copy
+    they are free to change.
+    """
+
+    def __init__(self, storage, config=None):
+        self.storage = storage
+        self.base = copy.deepcopy(config or {})
+        self.ttl = int(self.base.get("RPAAS_CONFIG_CACHE_TTL", 30))
+        self.documents = ExpiringCache()
+        self.resolved = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, plan_name=None, flavor_name=None):
+        plan_version, plan_config = self._document("plan", plan_name)
+        flavor_version, flavor_config = self._document("flavor", flavor_name)
+        versions = (plan_version, flavor_version)
+        with self.lock:
+            entry = self.resolved.get((plan_name, flavor_name))
+        if entry is not None and entry[0] == versions:
+            return dict(entry[1])
+        config = dict(self.base)
+        config.update(plan_config or {})
+        config.update(flavor_config or {})
+        with self.lock:
+            self.resolved[(plan_name, flavor_name)] = (versions, config)
+        return dict(config)
+
+    def invalidate(self, plan_name=None, flavor_name=None):
+        self.documents.invalidate(("plan", plan_name), ("flavor", flavor_name))
+        with self.lock:
+            for key in [k for k in self.resolved if (plan_name and k[0] == plan_name) or
+                        (flavor_name and k[1] == flavor_name)]:
+                del self.resolved[key]
+
+    def _document(self, kind, name):
+        if not name:
+            return None, None
+        if kind == "plan":
+            load = self.storage.find_plan_config
+        else:
+            load = self.storage.find_flavor_config
+        return self.documents.get((kind, name), lambda: load(name), self.ttl)
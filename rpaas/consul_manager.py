@@ -2,11 +2,17 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import base64
 import consul
+import functools
+import json
+import logging
 import os
+import threading
+import time
 
 from . import nginx
-from misc import host_from_destination
+from misc import check_option_enable, host_from_destination
 
 ACL_TEMPLATE = """key "{service_name}/{instance_name}" {{
     policy = "read"
@@ -30,6 +36,319 @@ class CertificateNotFoundError(Exception):
     pass
 
 
+class TransactionError(Exception):
+
+    def __init__(self, msg, errors=None):
+        super(TransactionError, self).__init__(msg)
+        self.errors = errors or []
+
+
+class KVTransaction(object):
+    """
+    Collects the KV writes of one logical change and sends them to Consul's
+    /v1/txn endpoint on commit, so consul-template never renders a half
+    applied change. Changes larger than a single transaction accepts are
+    split into chunks committed in order.
+    """
+
+    def __init__(self, client, max_ops=64, max_bytes=512 * 1024):
+        self.client = client
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.operations = []
+
+    def put(self, key, value, cas=None):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        op = {"Verb": "set", "Key": key, "Value": base64.b64encode(value or "")}
+        if cas is not None:
+            op.update({"Verb": "cas", "Index": cas})
+        self.operations.append({"KV": op})
+
+    def delete(self, key, recurse=None, cas=None):
+        op = {"Verb": "delete-tree" if recurse else "delete", "Key": key}
+        if cas is not None:
+            op.update({"Verb": "delete-cas", "Index": cas})
+        self.operations.append({"KV": op})
+
+    def commit(self):
+        operations, self.operations = self.operations, []
+        results = []
+        for chunk in self._chunks(operations):
+            params = {}
+            if self.client.token:
+                params["token"] = self.client.token
+            if self.client.dc:
+                params["dc"] = self.client.dc
+            results.extend(self.client.http.put(self._response, "/v1/txn", params=params,
+                                                data=json.dumps(chunk)) or [])
+        return results
+
+    def _chunks(self, operations):
+        chunk = []
+        size = 0
+        for op in operations:
+            op_size = len(json.dumps(op))
+            if chunk and (len(chunk) >= self.max_ops or size + op_size > self.max_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(op)
+            size += op_size
+        if chunk:
+            yield chunk
+
+    def _response(self, response):
+        if response.code not in (200, 409):
+            raise TransactionError("{} {}".format(response.code, response.body))
+        data = json.loads(response.body)
+        if response.code == 409 or data.get("Errors"):
+            errors = data.get("Errors") or []
+            raise TransactionError("transaction rolled back: {}".format(
+                "; ".join(e.get("What", "") for e in errors)), errors)
+        return data.get("Results")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+
+class _KVTree(object):
+
+    def __init__(self):
+        self.index = None
+        self.items = None
+        self.synced_at = 0
+        self.read_at = time.time()
+        self.generation = 0
+        self.healthy = True
+
+    def update(self, index, items):
+        self.index = index
+        self.items = dict((item["Key"], item) for item in items or [])
+        self.synced_at = time.time()
+
+
+class KVCache(object):
+    """
+    Process-wide read cache of the <service>/<instance>/ KV trees. A tree is
+    loaded on its first read and then kept fresh by a blocking query running
+    in a background thread, which stops after idle_timeout seconds without
+    reads. Trees keep being served for max_stale seconds after their watch
+    last reached Consul, so short Consul outages do not fail reads.
+    """
+
+    def __init__(self, client, service_name, wait="30s", max_stale=60, idle_timeout=300, retry_interval=1):
+        self.client = client
+        self.service_name = service_name
+        self.wait = wait
+        self.max_stale = float(max_stale)
+        self.idle_timeout = float(idle_timeout)
+        self.retry_interval = float(retry_interval)
+        self.trees = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stale_hits": 0, "invalidations": 0, "watch_errors": 0}
+
+    def get(self, instance_name, key, recurse=False):
+        """
+        Returns (index, value) for key the way consul.Consul.kv.get does.
+        """
+        index, items = self._snapshot(instance_name)
+        if recurse:
+            found = [items[k] for k in sorted(items) if k.startswith(key)]
+            return index, found or None
+        return index, items.get(key)
+
+    def invalidate(self, instance_name):
+        with self.lock:
+            tree = self.trees.get(instance_name)
+            if tree is not None:
+                tree.items = None
+                tree.generation += 1
+            self.counters["invalidations"] += 1
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            stats = dict(self.counters)
+            synced = [tree.synced_at for tree in self.trees.values() if tree.items is not None]
+            stats["instances"] = len(self.trees)
+            stats["unhealthy_watches"] = len([t for t in self.trees.values() if not t.healthy])
+        stats["max_staleness"] = max([now - s for s in synced] or [0])
+        return stats
+
+    def _prefix(self, instance_name):
+        return "{}/{}/".format(self.service_name, instance_name)
+
+    def _snapshot(self, instance_name):
+        with self.lock:
+            tree = self.trees.get(instance_name)
+            now = time.time()
+            if tree is not None and tree.items is not None and now - tree.synced_at < self.max_stale:
+                tree.read_at = now
+                self.counters["hits"] += 1
+                if not tree.healthy:
+                    self.counters["stale_hits"] += 1
+                return tree.index, tree.items
+            self.counters["misses"] += 1
+            generation = tree.generation if tree is not None else 0
+        index, items = self.client.kv.get(self._prefix(instance_name), recurse=True)
+        with self.lock:
+            tree = self.trees.get(instance_name)
+            if tree is None:
+                tree = self.trees[instance_name] = _KVTree()
+                self._start_watch(instance_name, tree)
+            tree.read_at = time.time()
+            if tree.generation == generation:
+                tree.update(index, items)
+                return tree.index, tree.items
+        return index, dict((item["Key"], item) for item in items or [])
+
+    def _start_watch(self, instance_name, tree):
+        watch = threading.Thread(target=self._watch, args=(instance_name, tree))
+        watch.daemon = True
+        watch.start()
+
+    def _watch(self, instance_name, tree):
+        index = None
+        while True:
+            with self.lock:
+                if time.time() - tree.read_at > self.idle_timeout:
+                    if self.trees.get(instance_name) is tree:
+                        del self.trees[instance_name]
+                    return
+                generation = tree.generation
+            try:
+                new_index, items = self.client.kv.get(self._prefix(instance_name), recurse=True,
+                                                      index=index, wait=self.wait)
+            except Exception as e:
+                logging.warning("Error watching consul keys of {}: {}".format(instance_name, e))
+                with self.lock:
+                    tree.healthy = False
+                    self.counters["watch_errors"] += 1
+                time.sleep(self.retry_interval)
+                continue
+            with self.lock:
+                tree.healthy = True
+                if tree.generation == generation:
+                    tree.update(new_index, items)
+            # consul resets the index when its raft log is restored
+            index = new_index if index is None or int(new_index) >= int(index) else None
+
+
+_kv_caches = {}
+_kv_caches_lock = threading.Lock()
+
+
+def get_kv_cache(host, port, token, service_name, **params):
+    key = (host, port, token, service_name)
+    with _kv_caches_lock:
+        cache = _kv_caches.get(key)
+        if cache is None:
+            client = consul.Consul(host=host, port=port, token=token)
+            cache = _kv_caches[key] = KVCache(client, service_name, **params)
+        return cache
+
+
+class CatalogIndex(object):
+    """
+    Process-wide address to node name index of the Consul catalog. It is
+    built from one catalog fetch and then refreshed by a blocking query in a
+    background thread, which stops after idle_timeout seconds without
+    lookups. When the watch has not reached Consul for max_stale seconds the
+    catalog is fetched again on lookup.
+    """
+
+    def __init__(self, client, wait="30s", max_stale=60, idle_timeout=300, retry_interval=1):
+        self.client = client
+        self.wait = wait
+        self.max_stale = float(max_stale)
+        self.idle_timeout = float(idle_timeout)
+        self.retry_interval = float(retry_interval)
+        self.index = None
+        self.nodes = None
+        self.synced_at = 0
+        self.read_at = 0
+        self.watching = False
+        self.lock = threading.Lock()
+
+    def lookup(self, addresses=None):
+        nodes = self._nodes()
+        if addresses is None:
+            return dict(nodes)
+        return dict((address, nodes[address]) for address in addresses if address in nodes)
+
+    def _nodes(self):
+        with self.lock:
+            self.read_at = time.time()
+            if self.nodes is not None and self.read_at - self.synced_at < self.max_stale:
+                return self.nodes
+        index, nodes = self.client.catalog.nodes()
+        with self.lock:
+            self._update(index, nodes)
+            if not self.watching:
+                self.watching = True
+                watch = threading.Thread(target=self._watch)
+                watch.daemon = True
+                watch.start()
+            return self.nodes
+
+    def _update(self, index, nodes):
+        hostnames = {}
+        for node in nodes or []:
+            hostnames.setdefault(node['Address'], node['Node'])
+        self.index = index
+        self.nodes = hostnames
+        self.synced_at = time.time()
+
+    def _watch(self):
+        while True:
+            with self.lock:
+                if time.time() - self.read_at > self.idle_timeout:
+                    self.watching = False
+                    self.nodes = None
+                    return
+                index = self.index
+            try:
+                new_index, nodes = self.client.catalog.nodes(index=index, wait=self.wait)
+            except Exception as e:
+                logging.warning("Error watching consul catalog: {}".format(e))
+                time.sleep(self.retry_interval)
+                continue
+            with self.lock:
+                if index is not None and int(new_index) < int(index):
+                    # consul resets the index when its raft log is restored
+                    new_index = None
+                self._update(new_index, nodes)
+
+
+_catalog_indexes = {}
+_catalog_indexes_lock = threading.Lock()
+
+
+def get_catalog_index(host, port, token, **params):
+    key = (host, port, token)
+    with _catalog_indexes_lock:
+        catalog = _catalog_indexes.get(key)
+        if catalog is None:
+            client = consul.Consul(host=host, port=port, token=token)
+            catalog = _catalog_indexes[key] = CatalogIndex(client, **params)
+        return catalog
+
+
+def _invalidates(method):
+    @functools.wraps(method)
+    def wrapper(self, instance_name, *args, **kwargs):
+        try:
+            return method(self, instance_name, *args, **kwargs)
+        finally:
+            self._invalidate(instance_name)
+    return wrapper
+
+
 class ConsulManager(object):
 
     def __init__(self, config):
@@ -39,6 +358,48 @@ class ConsulManager(object):
         self.client = consul.Consul(host=host, port=port, token=token)
         self.config_manager = nginx.ConfigManager(config)
         self.service_name = config.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.txn_max_ops = int(config.get("CONSUL_TXN_MAX_OPS", 64))
+        self.txn_max_bytes = int(config.get("CONSUL_TXN_MAX_BYTES", 512 * 1024))
+        self.txn_cas_retries = int(config.get("CONSUL_TXN_CAS_RETRIES", 5))
+        self.kv_cache = None
+        if check_option_enable(config.get("CONSUL_KV_CACHE")):
+            self.kv_cache = get_kv_cache(host, port, token, self.service_name,
+                                         wait=config.get("CONSUL_KV_CACHE_WAIT", "30s"),
+                                         max_stale=config.get("CONSUL_KV_CACHE_MAX_STALE", 60),
+                                         idle_timeout=config.get("CONSUL_KV_CACHE_IDLE_TIMEOUT", 300))
+        self.catalog_index = get_catalog_index(host, port, token,
+                                               wait=config.get("CONSUL_CATALOG_WAIT", "30s"),
+                                               max_stale=config.get("CONSUL_CATALOG_MAX_STALE", 60))
+
+    def transaction(self):
+        return KVTransaction(self.client, self.txn_max_ops, self.txn_max_bytes)
+
+    def _get(self, instance_name, key, recurse=False):
+        if self.kv_cache is None:
+            return self.client.kv.get(key, recurse=recurse)
+        return self.kv_cache.get(instance_name, key, recurse=recurse)
+
+    def _invalidate(self, instance_name):
+        if self.kv_cache is not None:
+            self.kv_cache.invalidate(instance_name)
+
+    def list_keys(self):
+        """
+        Returns every KV key of the service in a single request.
+        """
+        return self.client.kv.get(self.service_name + "/", keys=True)[1] or []
+
+    def delete_keys(self, keys, recurse=False):
+        """
+        Deletes the given keys in transactions of at most CONSUL_TXN_MAX_OPS
+        operations each.
+        """
+        txn = self.transaction()
+        for key in keys:
+            txn.delete(key, recurse=recurse)
+        txn.commit()
+        for instance_name in set(key.split("/")[1] for key in keys):
+            self._invalidate(instance_name)
 
     def generate_token(self, instance_name):
         rules = ACL_TEMPLATE.format(service_name=self.service_name,
@@ -49,12 +410,15 @@ class ConsulManager(object):
     def destroy_token(self, acl_id):
         self.client.acl.destroy(acl_id)
 
+    @_invalidates
     def destroy_instance(self, instance_name):
         self.client.kv.delete(self._key("{}/".format(instance_name)), recurse=True)
 
+    @_invalidates
     def write_healthcheck(self, instance_name):
         self.client.kv.put(self._key(instance_name, "healthcheck"), "true")
 
+    @_invalidates
     def remove_healthcheck(self, instance_name):
         self.client.kv.delete(self._key(instance_name, "healthcheck"))
 
@@ -62,23 +426,36 @@ class ConsulManager(object):
         _, instances = self.client.health.service("nginx", tag=self.service_name)
         return instances
 
+    def watch_service_healthcheck(self, index=None, wait=None):
+        """
+        Blocking query on the nginx service health, returning (index, nodes)
+        as soon as it changes after index or when wait expires.
+        """
+        return self.client.health.service("nginx", tag=self.service_name, index=index, wait=wait)
+
     def list_node(self):
         _, nodes = self.client.catalog.nodes()
         return nodes
 
+    @_invalidates
     def remove_node(self, instance_name, server_name, host_id):
-        self.client.kv.delete(self._server_status_key(instance_name, server_name))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "", host_id), recurse=True)
+        with self.transaction() as txn:
+            txn.delete(self._server_status_key(instance_name, server_name))
+            txn.delete(self._ssl_cert_path(instance_name, "", host_id), recurse=True)
         self.client.agent.force_leave(server_name)
 
     def node_hostname(self, host):
-        for node in self.list_node():
-            if node['Address'] == host:
-                return node['Node']
-        return None
+        return self.node_hostnames([host]).get(host)
+
+    def node_hostnames(self, addresses=None):
+        """
+        Returns the node names of the given addresses, or of every address in
+        the catalog when none are given. Unknown addresses are left out.
+        """
+        return self.catalog_index.lookup(addresses)
 
     def node_status(self, instance_name):
-        node_status = self.client.kv.get(self._server_status_key(instance_name), recurse=True)
+        node_status = self._get(instance_name, self._server_status_key(instance_name), recurse=True)
         node_status_list = {}
         if node_status is not None:
             for node in node_status[1]:
@@ -86,8 +463,10 @@ class ConsulManager(object):
                 node_status_list[node_server_name] = node['Value']
         return node_status_list
 
+    @_invalidates
     def write_location(self, instance_name, path, destination=None, content=None, router_mode=False,
                        bind_mode=False, https_only=False):
+        upstream = upstream_server = None
         if content:
             content = content.strip()
         else:
@@ -95,15 +474,30 @@ class ConsulManager(object):
             upstream_server = upstream
             if bind_mode:
                 upstream = "rpaas_default_upstream"
-            content = self.config_manager.generate_host_config(path, destination, upstream, router_mode, https_only)
+            content = self.config_manager.generate_host_config(path, destination, upstream, router_mode,
+                                                               https_only)
             if router_mode:
                 upstream_server = None
-            self.add_server_upstream(instance_name, upstream, upstream_server)
-        self.client.kv.put(self._location_key(instance_name, path), content)
 
+        def write(txn):
+            self.add_server_upstream(instance_name, upstream, upstream_server, txn=txn)
+            txn.put(self._location_key(instance_name, path), content)
+
+        self._commit_with_retry(write)
+
+    @_invalidates
     def remove_location(self, instance_name, path):
         self.client.kv.delete(self._location_key(instance_name, path))
 
+    def list_locations(self, instance_name):
+        locations = self._get(instance_name, self._key(instance_name, "locations"), recurse=True)[1]
+        paths = set()
+        for location in locations or []:
+            location_key = location["Key"].split("/")[-1]
+            paths.add("/" if location_key == "ROOT" else location_key.replace("___", "/"))
+        return paths
+
+    @_invalidates
     def write_block(self, instance_name, block_name, content):
         content = self._set_header_footer(content, block_name)
         self.client.kv.put(self._block_key(instance_name, block_name), content)
@@ -112,8 +506,7 @@ class ConsulManager(object):
         self.write_block(instance_name, block_name, None)
 
     def list_blocks(self, instance_name, block_name=None):
-        blocks = self.client.kv.get(self._block_key(instance_name, block_name),
-                                    recurse=True)
+        blocks = self._get(instance_name, self._block_key(instance_name, block_name), recurse=True)
         block_list = []
         if blocks[1]:
             for block in blocks[1]:
@@ -137,6 +530,7 @@ class ConsulManager(object):
             content = begin_block + end_block
         return content
 
+    @_invalidates
     def write_lua(self, instance_name, lua_module_name, lua_module_type, content):
         content_block = self._lua_module_escope(lua_module_name, content)
         key = self._lua_key(instance_name, lua_module_name, lua_module_type)
@@ -152,7 +546,7 @@ class ConsulManager(object):
         return escope
 
     def list_lua_modules(self, instance_name):
-        modules = self.client.kv.get(self._lua_key(instance_name), recurse=True)
+        modules = self._get(instance_name, self._lua_key(instance_name), recurse=True)
         module_list = []
         if modules[1]:
             for module in modules[1]:
@@ -164,74 +558,152 @@ class ConsulManager(object):
     def remove_lua(self, instance_name, lua_module_name, lua_module_type):
         self.write_lua(instance_name, lua_module_name, lua_module_type, None)
 
-    def add_server_upstream(self, instance_name, upstream_name, server):
+    def add_server_upstream(self, instance_name, upstream_name, server, txn=None, weight=None, metadata=None):
         if not server:
             return
-        servers = self.list_upstream(instance_name, upstream_name)
-        if isinstance(server, list):
-            for idx, _ in enumerate(server):
-                server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers |= set(server)
+        servers = self._normalize_servers(server)
+        entry = {}
+        if weight is not None:
+            entry["weight"] = int(weight)
+        if metadata:
+            entry["metadata"] = metadata
+
+        def add(txn):
+            self._migrate_upstream(txn, instance_name, upstream_name)
+            for srv in servers:
+                txn.put(self._upstream_server_key(instance_name, upstream_name, srv), json.dumps(entry))
+
+        if txn is None:
+            try:
+                self._commit_with_retry(add)
+            finally:
+                self._invalidate(instance_name)
         else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            servers.add(server)
-        self._save_upstream(instance_name, upstream_name, servers)
+            # the caller owns the transaction and invalidates once it commits
+            add(txn)
 
+    @_invalidates
     def remove_server_upstream(self, instance_name, upstream_name, server):
-        servers = self.list_upstream(instance_name, upstream_name)
-        if isinstance(server, list):
-            for idx, _ in enumerate(server):
-                server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers -= set(server)
-        else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            if server in servers:
-                servers.remove(server)
-        if len(servers) < 1:
-            self._remove_upstream(instance_name, upstream_name)
-        else:
-            self._save_upstream(instance_name, upstream_name, servers)
+        servers = self._normalize_servers(server)
 
-    def _remove_upstream(self, instance_name, upstream_name):
-        content = self._set_header_footer(None, "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+        def remove(txn):
+            self._migrate_upstream(txn, instance_name, upstream_name)
+            for srv in servers:
+                txn.delete(self._upstream_server_key(instance_name, upstream_name, srv))
+
+        self._commit_with_retry(remove)
 
     def list_upstream(self, instance_name, upstream_name):
-        servers = self.client.kv.get(self._upstream_key(instance_name, upstream_name))[1]
+        return set(self._upstream_servers(instance_name, upstream_name).keys())
+
+    def render_upstream(self, instance_name, upstream_name):
+        """
+        Returns the servers of the upstream the way nginx reads them, comma
+        separated and with their weights. Consul only keeps the server keys,
+        etc/upstream.ctmpl renders the same value on the nginx side.
+        """
+        servers = self._upstream_servers(instance_name, upstream_name)
+        rendered = []
+        for srv in sorted(servers):
+            if servers[srv].get("weight") is not None:
+                srv = "{} weight={}".format(srv, servers[srv]["weight"])
+            rendered.append(srv)
+        return ",".join(rendered)
+
+    def _normalize_servers(self, server):
+        if not isinstance(server, list):
+            server = [server]
+        return [":".join(map(str, filter(None, host_from_destination(srv)))) for srv in server]
+
+    def _upstream_servers(self, instance_name, upstream_name):
+        prefix = self._upstream_server_key(instance_name, upstream_name)
+        _, keys = self._get(instance_name, prefix, recurse=True)
+        servers = {}
+        for key in keys or []:
+            servers[key["Key"][len(prefix):]] = json.loads(key["Value"] or "{}")
         if servers:
-            servers = self._set_header_footer(servers["Value"], "upstream", True)
-            if servers == "":
-                return set()
-            return set(servers.split(","))
-        return set()
-
-    def _save_upstream(self, instance_name, upstream_name, servers):
-        content = self._set_header_footer(",".join(servers), "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+            return servers
+        # upstreams not changed since the per server layout keep the legacy value
+        _, item = self._get(instance_name, self._upstream_key(instance_name, upstream_name))
+        for srv in self._legacy_servers(item):
+            servers[srv] = {}
+        return servers
+
+    def _legacy_servers(self, item):
+        if not item:
+            return []
+        content = self._set_header_footer(item["Value"] or "", "upstream", True)
+        return [srv.split(" ")[0] for srv in content.split(",") if srv]
+
+    def _migrate_upstream(self, txn, instance_name, upstream_name):
+        # moves the servers of the legacy comma separated value to their own
+        # keys and drops it, the check-and-set delete makes it happen once
+        _, item = self.client.kv.get(self._upstream_key(instance_name, upstream_name))
+        if not item:
+            return
+        for srv in self._legacy_servers(item):
+            txn.put(self._upstream_server_key(instance_name, upstream_name, srv), json.dumps({}))
+        txn.delete(self._upstream_key(instance_name, upstream_name), cas=item["ModifyIndex"])
+
+    def _commit_with_retry(self, build):
+        for attempt in xrange(self.txn_cas_retries + 1):
+            txn = self.transaction()
+            build(txn)
+            try:
+                return txn.commit()
+            except TransactionError as e:
+                if not e.errors or attempt == self.txn_cas_retries:
+                    raise
 
     def swap_instances(self, src_instance, dst_instance):
-        if not self.check_swap_state(src_instance, dst_instance):
+        try:
+            self._swap_instances(src_instance, dst_instance)
+        finally:
+            self._invalidate(src_instance)
+            self._invalidate(dst_instance)
+
+    def _swap_instances(self, src_instance, dst_instance):
+        src_item, dst_item = self._swap_items(src_instance, dst_instance)
+        if not self._valid_swap_state(src_instance, dst_instance, src_item, dst_item):
             raise InstanceAlreadySwappedError()
-        src_instance_value = self.client.kv.get(self._key(src_instance, "swap"))[1]
-        if not src_instance_value:
-            self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-            self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
-            return
-        if src_instance_value['Value'] == dst_instance:
-            self.client.kv.delete(self._key(src_instance, "swap"))
-            self.client.kv.delete(self._key(dst_instance, "swap"))
-            return
-        self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-        self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
+        src_index = src_item["ModifyIndex"] if src_item else 0
+        dst_index = dst_item["ModifyIndex"] if dst_item else 0
+        txn = self.transaction()
+        if src_item and src_item['Value'] == dst_instance:
+            txn.delete(self._key(src_instance, "swap"), cas=src_index)
+            txn.delete(self._key(dst_instance, "swap"), cas=dst_index)
+        else:
+            txn.put(self._key(src_instance, "swap"), dst_instance, cas=src_index)
+            txn.put(self._key(dst_instance, "swap"), src_instance, cas=dst_index)
+        try:
+            txn.commit()
+        except TransactionError as e:
+            if e.errors:
+                # another swap changed the keys after they were read
+                raise InstanceAlreadySwappedError()
+            raise
 
     def check_swap_state(self, src_instance, dst_instance):
-        src_instance_status = self.client.kv.get(self._key(src_instance, "swap"))[1]
-        dst_instance_status = self.client.kv.get(self._key(dst_instance, "swap"))[1]
-        if not src_instance_status and not dst_instance_status:
+        src_item, dst_item = self._swap_items(src_instance, dst_instance, cached=True)
+        return self._valid_swap_state(src_instance, dst_instance, src_item, dst_item)
+
+    def _swap_items(self, src_instance, dst_instance, cached=False):
+        if cached and self.kv_cache is not None:
+            src_item = self._get(src_instance, self._key(src_instance, "swap"))[1]
+            dst_item = None
+            if dst_instance:
+                dst_item = self._get(dst_instance, self._key(dst_instance, "swap"))[1]
+            return src_item, dst_item
+        src_item = self.client.kv.get(self._key(src_instance, "swap"))[1]
+        dst_item = self.client.kv.get(self._key(dst_instance, "swap"))[1]
+        return src_item, dst_item
+
+    def _valid_swap_state(self, src_instance, dst_instance, src_item, dst_item):
+        if not src_item and not dst_item:
             return True
-        if not src_instance_status or not dst_instance_status:
+        if not src_item or not dst_item:
             return False
-        if sorted([src_instance_status['Value'], dst_instance_status['Value']]) != sorted([src_instance, dst_instance]):
+        if sorted([src_item['Value'], dst_item['Value']]) != sorted([src_instance, dst_instance]):
             return False
         return True
 
@@ -247,6 +719,7 @@ class ConsulManager(object):
                               "destination": acl["Value"].split(",")})
         return acls_list
 
+    @_invalidates
     def store_acl_network(self, instance_name, src, dst):
         acls = self.find_acl_network(instance_name, src)
         if acls:
@@ -257,6 +730,7 @@ class ConsulManager(object):
         src = self._normalize_acl_src(src)
         self.client.kv.put(self._acl_key(instance_name, src), ",".join(acls))
 
+    @_invalidates
     def remove_acl_network(self, instance_name, src):
         src = self._normalize_acl_src(src)
         self.client.kv.delete(self._acl_key(instance_name, src))
@@ -269,21 +743,25 @@ class ConsulManager(object):
         return src.replace("/", "_")
 
     def get_certificate(self, instance_name, host_id=None):
-        cert = self.client.kv.get(self._ssl_cert_path(instance_name, "cert", host_id))[1]
-        key = self.client.kv.get(self._ssl_cert_path(instance_name, "key", host_id))[1]
+        cert = self._get(instance_name, self._ssl_cert_path(instance_name, "cert", host_id))[1]
+        key = self._get(instance_name, self._ssl_cert_path(instance_name, "key", host_id))[1]
         if not cert or not key:
             raise CertificateNotFoundError()
         return cert["Value"], key["Value"]
 
+    @_invalidates
     def set_certificate(self, instance_name, cert_data, key_data, host_id=None):
-        self.client.kv.put(self._ssl_cert_path(instance_name, "cert", host_id),
-                           cert_data.replace("\r\n", "\n"))
-        self.client.kv.put(self._ssl_cert_path(instance_name, "key", host_id),
-                           key_data.replace("\r\n", "\n"))
+        with self.transaction() as txn:
+            txn.put(self._ssl_cert_path(instance_name, "cert", host_id),
+                    cert_data.replace("\r\n", "\n"))
+            txn.put(self._ssl_cert_path(instance_name, "key", host_id),
+                    key_data.replace("\r\n", "\n"))
 
+    @_invalidates
     def delete_certificate(self, instance_name):
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "cert"))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "key"))
+        with self.transaction() as txn:
+            txn.delete(self._ssl_cert_path(instance_name, "cert"))
+            txn.delete(self._ssl_cert_path(instance_name, "key"))
 
     def _ssl_cert_path(self, instance_name, key_type, host_id=None):
         if host_id:
@@ -321,6 +799,10 @@ class ConsulManager(object):
         base_key = "upstream/{}".format(upstream_name)
         return self._key(instance_name, base_key)
 
+    def _upstream_server_key(self, instance_name, upstream_name, server=""):
+        base_key = "upstream_servers/{}/{}".format(upstream_name, server)
+        return self._key(instance_name, base_key)
+
     def _acl_key(self, instance_name, src=None):
         base_key = "acl"
         if src:
@@ -0,0 +1,28 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import time
+from rpaas import scheduler, tasks
+
+
+class DriftScanner(scheduler.JobScheduler):
+    """
+    DriftScanner is a thread to periodically look for state left behind by
+    hosts that no longer exist, see tasks.ScanDriftTask.
+
+    """
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(DriftScanner, self).__init__(config, *args, **kwargs)
+        self.config = config or dict(os.environ)
+        self.interval = int(self.config.get("DRIFT_SCANNER_RUN_INTERVAL", 3600))
+        self.last_run_key = self.get_last_run_key("DRIFT_SCANNER")
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if self.try_lock():
+                tasks.ScanDriftTask().delay(self.config)
+            time.sleep(self.interval / 2)
@@ -73,10 +73,9 @@ class HCAPI(object):
         resp = self._issue_request("POST", "/url", data=json.dumps(data))
         if resp.status_code > 399:
             raise URLCreationError(resp.text)
-        if "urls" not in hc:
-            hc["urls"] = []
-        hc["urls"].append(url)
-        self.storage.store_hc(hc)
+        # hosts of an instance are added concurrently, so the url is pushed
+        # instead of storing back the document read above
+        self.storage.add_hc_url(name, url)
 
     def remove_url(self, name, url):
         hc = self.storage.retrieve_hc(name)
@@ -84,8 +83,7 @@ class HCAPI(object):
             url = self.hc_format.format(url)
         data = {"name": hc["resource_name"], "url": url}
         self._issue_request("DELETE", "/url", data=json.dumps(data))
-        hc["urls"].remove(url)
-        self.storage.store_hc(hc)
+        self.storage.remove_hc_url(name, url)
 
 
 class HCCreationError(Exception):
@@ -2,9 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
+import math
 import os
 import time
-from rpaas import scheduler, tasks
+from rpaas import consul_manager, lock, scheduler, tasks
+from rpaas.misc import check_option_enable
 
 
 class RestoreMachine(scheduler.JobScheduler):
@@ -32,6 +35,12 @@ class CheckMachine(scheduler.JobScheduler):
     CheckMachine detects machines where checks as marked 'critical' on
     Consul and creates tasks to be consumed by RestoreMachine.
 
+    With CHECK_MACHINE_WATCH enabled it long-polls the nginx service health
+    instead of checking every node each interval, and only sends the nodes
+    whose status changed and stayed changed for CHECK_MACHINE_DEBOUNCE
+    seconds. Only the process holding the CHECK_MACHINE_LEADER_KEY lease
+    watches, so each change is sent once.
+
     """
 
     def __init__(self, config=None, *args, **kwargs):
@@ -39,10 +48,104 @@ class CheckMachine(scheduler.JobScheduler):
         self.config = config or dict(os.environ)
         self.interval = int(self.config.get("CHECK_MACHINE_RUN_INTERVAL", 30))
         self.last_run_key = self.get_last_run_key("CHECK_MACHINE")
+        self.watch = check_option_enable(self.config.get("CHECK_MACHINE_WATCH"))
+        self.watch_wait = int(self.config.get("CHECK_MACHINE_WATCH_WAIT", 30))
+        self.debounce = float(self.config.get("CHECK_MACHINE_DEBOUNCE", 10))
+        self.leader_lease = int(self.config.get("CHECK_MACHINE_LEADER_LEASE", 30))
+        self.leader_key = self.config.get("CHECK_MACHINE_LEADER_KEY",
+                                          "check_machine:{}:leader".format(self.service_name))
+        self.states = {}
+        self.pending = {}
 
     def run(self):
         self.running = True
+        if self.watch:
+            return self.run_watch()
         while self.running:
             if self.try_lock():
                 tasks.CheckMachineTask().delay(self.config)
             time.sleep(self.interval / 2)
+
+    def run_watch(self):
+        consul = consul_manager.ConsulManager(self.config)
+        leases = lock.Leases(self.conn, self.leader_lease)
+        index = None
+        try:
+            while self.running:
+                if not leases.holds(self.leader_key):
+                    # the previous leader may have sent changes this process never saw
+                    self.states.clear()
+                    self.pending.clear()
+                    index = None
+                    if not leases.acquire(self.leader_key):
+                        time.sleep(1)
+                        continue
+                try:
+                    index, nodes = consul.watch_service_healthcheck(index, "{}s".format(self._wait()))
+                except Exception as e:
+                    logging.error("check_machine: error watching nginx health: {}".format(e))
+                    index = None
+                    time.sleep(1)
+                    continue
+                changed = self.due_nodes(nodes, time.time())
+                if not changed or not leases.holds(self.leader_key):
+                    continue
+                try:
+                    tasks.CheckMachineTask().delay(self.config, changed)
+                except Exception as e:
+                    logging.error("check_machine: error sending changed nodes: {}".format(e))
+                    continue
+                self.mark_sent(changed)
+        finally:
+            leases.stop()
+
+    def changed_nodes(self, nodes, now):
+        """
+        Returns the nodes whose status has been different from the last one
+        sent for at least debounce seconds, and records them as sent. Nodes
+        seen for the first time count as changed.
+        """
+        changed = self.due_nodes(nodes, now)
+        self.mark_sent(changed)
+        return changed
+
+    def due_nodes(self, nodes, now):
+        changed = []
+        seen = set()
+        for node in nodes:
+            address = node['Node']['Address']
+            seen.add(address)
+            failing = self._failing(node)
+            if address in self.states and self.states[address] == failing:
+                self.pending.pop(address, None)
+                continue
+            since = now
+            if address in self.pending and self.pending[address][0] == failing:
+                since = self.pending[address][1]
+            self.pending[address] = (failing, since, node)
+        for address in set(self.states) - seen:
+            del self.states[address]
+        for address in self.pending.keys():
+            failing, since, node = self.pending[address]
+            if address not in seen:
+                del self.pending[address]
+            elif now - since >= self.debounce:
+                changed.append(node)
+        return changed
+
+    def mark_sent(self, nodes):
+        for node in nodes:
+            address = node['Node']['Address']
+            self.pending.pop(address, None)
+            self.states[address] = self._failing(node)
+
+    def _failing(self, node):
+        return any(check['Status'] != 'passing' for check in node['Checks'])
+
+    def _wait(self):
+        # wake up when the oldest pending change is due
+        wait = self.watch_wait
+        now = time.time()
+        for _, since, _ in self.pending.values():
+            wait = min(wait, int(math.ceil(since + self.debounce - now)))
+        return max(wait, 1)
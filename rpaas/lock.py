@@ -2,6 +2,11 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
+import threading
+
+from redis.exceptions import LockError
+
 
 class Lock(object):
 
@@ -35,3 +40,76 @@ class Lock(object):
         if position:
             return position.pop()
         return None
+
+
+class Leases(object):
+    """
+    Redis locks taken with a short timeout and extended by a heartbeat
+    thread while they are held, so a worker that dies only blocks the
+    others for one lease.
+    """
+
+    def __init__(self, redis_conn, lease, interval=None):
+        self.redis_conn = redis_conn
+        self.lease = lease
+        self.interval = interval or lease / 3.0
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def acquire(self, name):
+        # the heartbeat thread extends the lock, so its token must not be
+        # kept in thread local storage
+        redis_lock = self.redis_conn.lock(name=name, timeout=self.lease, thread_local=False)
+        if not redis_lock.acquire(blocking=False):
+            return False
+        with self.lock:
+            self.held[name] = redis_lock
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self._beat)
+                self.heartbeat.daemon = True
+                self.heartbeat.start()
+        return True
+
+    def acquire_any(self, names):
+        for name in names:
+            if self.acquire(name):
+                return name
+        return None
+
+    def holds(self, name):
+        with self.lock:
+            return name in self.held
+
+    def release(self, name):
+        with self.lock:
+            redis_lock = self.held.pop(name, None)
+        if redis_lock is None:
+            return
+        try:
+            redis_lock.release()
+        except LockError:
+            logging.warning("lease {} expired before release".format(name))
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            names = self.held.keys()
+        for name in names:
+            self.release(name)
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                held = self.held.items()
+            for name, redis_lock in held:
+                try:
+                    redis_lock.extend(self.interval)
+                except LockError as e:
+                    logging.warning("could not renew lease {}: {}".format(name, e))
+                    with self.lock:
+                        if self.held.get(name) is redis_lock:
+                            del self.held[name]
+                except Exception as e:
+                    logging.error("error renewing lease {}: {}".format(name, e))
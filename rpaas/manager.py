@@ -4,9 +4,11 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import copy
+import collections
 import datetime
+import json
 import os
+import Queue
 import socket
 import threading
 import time
@@ -16,9 +18,9 @@ import hm.lb_managers.networkapi_cloudstack  # NOQA
 from hm.model.load_balancer import LoadBalancer
 from celery.utils import uuid
 
-from rpaas import (consul_manager, nginx, sslutils, ssl_plugins,
+from rpaas import (catalog, consul_manager, config_resolver, nginx, sslutils, ssl_plugins,
                    storage, tasks, acl, lock)
-from rpaas.misc import check_option_enable, host_from_destination
+from rpaas.misc import ExpiringCache, check_option_enable, host_from_destination, run_concurrently
 
 PENDING = "pending"
 FAILURE = "failure"
@@ -32,18 +34,18 @@ class Manager(object):
         self.consul_manager = consul_manager.ConsulManager(config)
         self.nginx_manager = nginx.Nginx(config)
         self.task_manager = tasks.TaskManager(config)
+        self.config_resolver = config_resolver.ConfigResolver(self.storage, config)
+        self.catalog = catalog.Catalog(self.storage, config, tasks.app.backend.client)
+        self.lb_cache = LoadBalancerCache(int(config.get("RPAAS_INSTANCE_CACHE_TTL", 0)),
+                                          config.get("RPAAS_INSTANCE_CACHE_NEGATIVE_TTL"),
+                                          busy=lambda name: self.storage.find_task_status(name) is not None)
         self.service_name = os.environ.get("RPAAS_SERVICE_NAME", "rpaas")
         self.acl_manager = acl.Dumb(self.consul_manager)
         if check_option_enable(os.environ.get("CHECK_ACL_API", None)):
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(tasks.app.backend.client))
 
     def new_instance(self, name, team=None, plan_name=None, flavor_name=None):
-        plan = None
-        flavor = None
-        if plan_name:
-            plan = self.storage.find_plan(plan_name)
-        if flavor_name:
-            flavor = self.storage.find_flavor(flavor_name)
+        config = self.config_resolver.resolve(plan_name, flavor_name)
         used, quota = self.storage.find_team_quota(team)
         if len(used) >= quota:
             raise QuotaExceededError(len(used), quota)
@@ -53,13 +55,11 @@ class Manager(object):
         if lb is not None:
             raise storage.DuplicateError(name)
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
+        self.lb_cache.invalidate(name)
         metadata = {}
-        if plan:
-            config.update(plan.config)
+        if plan_name:
             metadata["plan_name"] = plan_name
-        if flavor:
-            config.update(flavor.config)
+        if flavor_name:
             metadata["flavor_name"] = flavor_name
         metadata["consul_token"] = consul_token = self.consul_manager.generate_token(name)
         self.consul_manager.write_healthcheck(name)
@@ -83,30 +83,24 @@ class Manager(object):
             raise consul_manager.InstanceAlreadySwappedError()
         self.task_manager.create(name)
         metadata = self.storage.find_instance_metadata(name)
-        config = copy.deepcopy(self.config)
-        if metadata and "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            if plan:
-                config.update(plan.config)
-        if metadata and "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            if flavor:
-                config.update(flavor.config)
+        config = self._metadata_config(metadata)
         if metadata and metadata.get("consul_token"):
             self.consul_manager.destroy_token(metadata["consul_token"])
         self.storage.decrement_quota(name)
-        self.storage.remove_task(name)
         self.storage.remove_binding(name)
         self.storage.remove_instance_metadata(name)
+        self.storage.remove_desired_state(name)
+        self.storage.remove_scale_report(name)
+        self.lb_cache.invalidate(name)
         tasks.RemoveInstanceTask().delay(config, name)
 
     def update_instance(self, name, plan_name=None, flavor_name=None):
-        if plan_name and not self.storage.find_plan(plan_name):
+        if plan_name and not self.catalog.find_plan(plan_name):
             raise storage.PlanNotFoundError()
-        if flavor_name and not self.storage.find_flavor(flavor_name):
+        if flavor_name and not self.catalog.find_flavor(flavor_name):
             raise storage.FlavorNotFoundError()
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         metadata = self.storage.find_instance_metadata(name)
@@ -122,7 +116,7 @@ class Manager(object):
             self.task_manager.remove(task_name)
             return
         self.task_manager.ensure_ready(task_name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         machine_data = self.storage.find_host_id(machine)
@@ -131,18 +125,21 @@ class Manager(object):
         self.task_manager.create({"_id": task_name, "host": machine,
                                  "instance": name, "created": datetime.datetime.utcnow()})
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
+        """
+        Restores the hosts of the instance in batches of at most
+        max_unavailable hosts (a count or a percentage, RPAAS_RESTORE_MAX_UNAVAILABLE
+        by default), restoring the hosts of a batch concurrently. Progress is
+        streamed as one JSON event per line, and no batch starts after one
+        fails.
+        """
         self.task_manager.ensure_ready(name)
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
-        metadata = self.storage.find_instance_metadata(name)
-        if metadata and "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            config.update(plan.config or {})
-        if metadata and "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            config.update(flavor.config or {})
+        config = self._metadata_config(self.storage.find_instance_metadata(name))
         healthcheck_timeout = int(config.get("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
+        if max_unavailable is None:
+            max_unavailable = config.get("RPAAS_RESTORE_MAX_UNAVAILABLE", 1)
         tags = []
         extra_tags = config.get("INSTANCE_EXTRA_TAGS", "")
         if extra_tags:
@@ -153,52 +150,92 @@ class Manager(object):
             lb = LoadBalancer.find(name, config)
             if lb is None:
                 raise storage.InstanceNotFoundError()
-            length = len(lb.hosts)
-            for idx, host in enumerate(lb.hosts):
-                yield "Restoring host ({}/{}) {} ".format(idx + 1, length, host.id)
-                stop_host_job = JobWaiting(host.stop, 0)
-                stop_host_job.start()
-                while stop_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(stop_host_job.result, Exception):
-                    raise stop_host_job.result
-                scale_host_job = JobWaiting(host.scale, 0)
-                scale_host_job.start()
-                while scale_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(scale_host_job.result, Exception):
-                    raise scale_host_job.result
-                restore_host_job = JobWaiting(host.restore, 0, reset_template=True, reset_tags=True)
-                restore_host_job.start()
-                while restore_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(restore_host_job.result, Exception):
-                    raise restore_host_job.result
-                host.start()
-                nginx_waiting = self.nginx_manager.wait_healthcheck
-                restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
-                nginx_healthcheck_job = JobWaiting(nginx_waiting, restore_delay, host=host.dns_name,
-                                                   timeout=healthcheck_timeout, manage_healthcheck=False)
-                nginx_healthcheck_job.start()
-                while nginx_healthcheck_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(nginx_healthcheck_job.result, Exception):
-                    raise nginx_healthcheck_job.result
-                yield ": successfully restored\n"
+            hosts = list(lb.hosts)
+            batch_size = restore_batch_size(max_unavailable, len(hosts))
+            restored = failed = 0
+            for batch, offset in enumerate(xrange(0, len(hosts), batch_size)):
+                if batch > 0:
+                    time.sleep(restore_delay)
+                batch_hosts = hosts[offset:offset + batch_size]
+                for event in self._restore_batch(batch_hosts, batch + 1, offset, len(hosts), healthcheck_timeout):
+                    if event.get("status") == "restored":
+                        restored += 1
+                    elif event.get("status") == "failed":
+                        failed += 1
+                    yield json.dumps(event) + "\n"
+                if failed:
+                    break
+            yield json.dumps({"status": "failed" if failed else "finished", "restored": restored,
+                              "failed": failed, "total": len(hosts)}) + "\n"
         except storage.InstanceNotFoundError:
-            yield "instance {} not found\n".format(name)
+            yield json.dumps({"status": "error", "error": "instance {} not found".format(name)}) + "\n"
         except Exception as e:
-            yield ": failed to restore - {}\n".format(repr(e.message))
+            yield json.dumps({"status": "error", "error": repr(e.message)}) + "\n"
         finally:
             self.task_manager.remove(name)
 
+    def _restore_batch(self, hosts, batch, offset, total, healthcheck_timeout):
+        events = Queue.Queue()
+        done = object()
+
+        def restore_host(item):
+            idx, host = item
+            event = {"host": host.id, "address": host.dns_name, "batch": batch,
+                     "position": "{}/{}".format(offset + idx + 1, total)}
+            steps = [("stop", host.stop, {}),
+                     ("scale", host.scale, {}),
+                     ("restore", host.restore, {"reset_template": True, "reset_tags": True}),
+                     ("start", host.start, {})]
+            events.put(dict(event, status="restoring"))
+            host_start = time.time()
+            for step, job, params in steps:
+                step_start = time.time()
+                try:
+                    job(**params)
+                except Exception as e:
+                    events.put(dict(event, step=step, status="failed", error=repr(e.message),
+                                    seconds=time.time() - step_start))
+                    return None
+                events.put(dict(event, step=step, status="done", seconds=time.time() - step_start))
+            return event, host_start
+
+        def wait_started(started):
+            # the hosts of a batch boot at the same time, so wait for them as a group
+            pending = collections.defaultdict(list)
+            for event, host_start in started:
+                pending[event["address"]].append((event, host_start))
+            step_start = time.time()
+            for address, error in self.nginx_manager.wait_healthchecks(
+                    [event["address"] for event, _ in started], timeout=healthcheck_timeout,
+                    manage_healthcheck=False):
+                event, host_start = pending[address].pop()
+                if error is not None:
+                    events.put(dict(event, step="healthcheck", status="failed", error=repr(error.message),
+                                    seconds=time.time() - step_start))
+                    continue
+                events.put(dict(event, step="healthcheck", status="done", seconds=time.time() - step_start))
+                events.put(dict(event, status="restored", seconds=time.time() - host_start))
+
+        def run_batch():
+            try:
+                results = run_concurrently(restore_host, enumerate(hosts), len(hosts))
+                wait_started([r for r in results if isinstance(r, tuple)])
+            finally:
+                events.put(done)
+
+        runner = threading.Thread(target=run_batch)
+        runner.daemon = True
+        runner.start()
+        while True:
+            event = events.get()
+            if event is done:
+                break
+            yield event
+        runner.join()
+
     def bind(self, name, app_host, router_mode=False):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         binding_data = self.storage.find_binding(name)
@@ -221,7 +258,7 @@ class Manager(object):
 
     def unbind(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         binding_data = self.storage.find_binding(name)
@@ -254,7 +291,7 @@ class Manager(object):
                     routes_data.append("destination = {}".format(dst))
                 if content:
                     routes_data.append("content = {}".format(content.encode("utf-8")))
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         host_count = 0
         if lb:
             host_count = len(lb.hosts)
@@ -284,20 +321,19 @@ class Manager(object):
         self.task_manager.ensure_ready(src_instance)
         self.task_manager.ensure_ready(dst_instance)
         for instance in [src_instance, dst_instance]:
-            lb = LoadBalancer.find(instance)
+            lb = self.lb_cache.find(instance)
             if lb is None:
                 raise storage.InstanceNotFoundError(instance)
         self.consul_manager.swap_instances(src_instance, dst_instance)
 
     def node_status(self, name):
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         hostnames = {}
-        for host in lb.hosts:
-            hostname = self.consul_manager.node_hostname(host.dns_name)
-            if hostname is not None:
-                hostnames[hostname] = host.dns_name
+        addresses = self.consul_manager.node_hostnames([host.dns_name for host in lb.hosts])
+        for address, hostname in addresses.iteritems():
+            hostnames[hostname] = address
         node_status_return = {}
         for node, status in self.consul_manager.node_status(name).iteritems():
             node_status_return[node] = {'status': status}
@@ -307,28 +343,28 @@ class Manager(object):
 
     def get_certificate(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.get_certificate(name)
 
     def update_certificate(self, name, cert, key):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.set_certificate(name, cert, key)
 
     def delete_certificate(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.delete_certificate(name)
 
     def add_upstream(self, name, upstream_name, servers, acl=False):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         if acl:
@@ -342,55 +378,100 @@ class Manager(object):
 
     def remove_upstream(self, name, upstream_name, servers):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_server_upstream(name, upstream_name, servers)
 
     def list_upstreams(self, name, upstream_name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_upstream(name, upstream_name)
 
     def _get_address(self, name):
-        task = self.storage.find_task(name)
-        if task.count() >= 1:
-            result = tasks.NewInstanceTask().AsyncResult(task[0]["task_id"])
-            if result.status in ["FAILURE", "REVOKED"]:
+        task = self.storage.find_task_status(name)
+        if task is not None:
+            if task.get("status") == FAILURE or self._task_lost(task):
                 return FAILURE
             return PENDING
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return lb.address
 
+    def _task_lost(self, task):
+        # a lost worker or a hard time limit runs no failure hook, so task
+        # entries older than RPAAS_TASK_TIMEOUT are checked on the result backend
+        timeout = int(self.config.get("RPAAS_TASK_TIMEOUT", 3600))
+        created = task.get("created")
+        if created is not None and created > datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout):
+            return False
+        if not task.get("task_id"):
+            return False
+        result = tasks.NewInstanceTask().AsyncResult(task["task_id"])
+        return result.status in ["FAILURE", "REVOKED"]
+
     def scale_instance(self, name, quantity):
+        if self._reconciler_enabled():
+            if quantity < 0:
+                raise ScaleError("Can't have negative instances")
+            self.storage.store_desired_state(name, units=quantity)
+            self.reconcile_instance(name)
+            return
         self.task_manager.ensure_ready(name)
         if quantity < 0:
             raise ScaleError("Can't have negative instances")
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
+        self.lb_cache.invalidate(name)
+        config = self._instance_config(name)
+        task = tasks.ScaleInstanceTask().delay(config, name, quantity)
+        self.task_manager.update(name, task.task_id)
+
+    def reconcile_instance(self, name):
+        """
+        Queues a background run converging the instance towards its desired
+        state. Nothing is queued while a previous run is still waiting, as
+        it will pick up the latest desired state anyway.
+        """
+        if self.storage.find_desired_state(name) is None:
+            self.storage.store_desired_state(name)
+        task_id = uuid()
+        if not self.storage.queue_reconcile(name, task_id):
+            # the waiting run keeps its task id while it retries, so only a
+            # run that failed or was revoked before starting hands its flag over
+            queued_task_id = self.storage.find_desired_state(name).get("queued_task_id")
+            if queued_task_id is not None:
+                status = tasks.ReconcileInstanceTask().AsyncResult(queued_task_id).status
+                if status not in ["FAILURE", "REVOKED"]:
+                    return
+            if not self.storage.requeue_reconcile(name, queued_task_id, task_id):
+                return
+        self.lb_cache.invalidate(name)
+        tasks.ReconcileInstanceTask().apply_async(args=(self._instance_config(name), name), task_id=task_id)
+
+    def _reconciler_enabled(self):
+        return check_option_enable(self.config.get("RPAAS_RECONCILER", None))
+
+    def _instance_config(self, name):
         metadata = self.storage.find_instance_metadata(name)
         if not metadata or "consul_token" not in metadata:
             metadata = metadata or {}
             metadata["consul_token"] = self.consul_manager.generate_token(name)
             self.storage.store_instance_metadata(name, **metadata)
-        if "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            config.update(plan.config or {})
-        if "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            config.update(flavor.config or {})
+        config = self._metadata_config(metadata)
         self._add_tags(name, config, metadata["consul_token"])
-        task = tasks.ScaleInstanceTask().delay(config, name, quantity)
-        self.task_manager.update(name, task.task_id)
+        return config
+
+    def _metadata_config(self, metadata):
+        metadata = metadata or {}
+        return self.config_resolver.resolve(metadata.get("plan_name"), metadata.get("flavor_name"))
 
     def add_route(self, name, path, destination, content, https_only):
         self.task_manager.ensure_ready(name)
         path = path.strip()
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.storage.replace_binding_path(name, path, destination, content, https_only)
@@ -402,7 +483,7 @@ class Manager(object):
         path = path.strip()
         if path == "/":
             raise RouteError("You cannot remove a route for / location, unbind the app.")
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         routes = self.list_routes(name)
@@ -432,19 +513,43 @@ class Manager(object):
         self.task_manager.ensure_ready(name)
         if not preserve_path:
             path = path.strip()
-        lb = LoadBalancer.find(name)
-        purged_hosts = 0
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            if self.nginx_manager.purge_location(host.dns_name, path, preserve_path):
-                purged_hosts += 1
-        return purged_hosts
+        hosts = [host.dns_name for host in lb.hosts]
+        purged = self.nginx_manager.purge_location_hosts(hosts, path, preserve_path)
+        return len([host for host in hosts if purged.get(host)])
+
+    def purge_locations(self, name, purges):
+        self.task_manager.ensure_ready(name)
+        lb = self.lb_cache.find(name)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        hosts = [host.dns_name for host in lb.hosts]
+        locations = []
+        # every location is purged once, and reported under each path it was requested as
+        requested = {}
+        for path, preserve_path in purges:
+            preserve_path = bool(preserve_path)
+            location = (path if preserve_path else path.strip(), preserve_path)
+            if location not in requested:
+                requested[location] = []
+                locations.append(location)
+            if path not in requested[location]:
+                requested[location].append(path)
+        timeout = self.nginx_manager.nginx_purge_bulk_timeout
+
+        def purged_locations():
+            for location, purged in self.nginx_manager.purge_locations(hosts, locations, timeout):
+                instances_purged = len([host for host in hosts if purged.get(host)])
+                for path in requested[location]:
+                    yield path, instances_purged
+        return purged_locations()
 
     def add_block(self, name, block_name, content):
         self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.write_block(name, block_name, content)
@@ -452,35 +557,35 @@ class Manager(object):
     def delete_block(self, name, block_name):
         self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_block(name, block_name)
 
     def list_blocks(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_blocks(name)
 
     def add_lua(self, name, lua_module_name, lua_module_type, content):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             storage.InstanceNotFoundError()
         self.consul_manager.write_lua(name, lua_module_name, lua_module_type, content)
 
     def list_lua(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_lua_modules(name)
 
     def delete_lua(self, name, lua_module_name, lua_module_type):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_lua(name, lua_module_name, lua_module_type)
@@ -509,7 +614,7 @@ class Manager(object):
         return True
 
     def activate_ssl(self, name, domain, plugin='default'):
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
 
@@ -535,7 +640,7 @@ class Manager(object):
             return ''
 
     def revoke_ssl(self, name, plugin='default'):
-        lb = LoadBalancer.find(name)
+        lb = self.lb_cache.find(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
 
@@ -556,22 +661,42 @@ class Manager(object):
         return ''
 
 
-class JobWaiting(threading.Thread):
-
-    def __init__(self, job, sleep, **kwargs):
-        super(JobWaiting, self).__init__()
-        self.daemon = True
-        self.job = job
-        self.sleep = sleep
-        self.job_args = kwargs
-        self.result = None
-
-    def run(self):
-        try:
-            self.result = self.job(**self.job_args)
-            time.sleep(self.sleep)
-        except Exception as e:
-            self.result = e
+class LoadBalancerCache(ExpiringCache):
+    """
+    Read-through cache of LoadBalancer.find results for the API, kept for
+    ttl seconds, or negative_ttl seconds for instances that were not found.
+    A zero ttl disables caching. Lookups are not cached while busy(name) is
+    true, as the task holding the instance may be creating or destroying its
+    load balancer. Entries are only invalidated locally, so other API
+    processes see host changes once their entries expire.
+    """
+
+    def __init__(self, ttl, negative_ttl=None, busy=None):
+        super(LoadBalancerCache, self).__init__()
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else int(negative_ttl)
+        self.busy = busy or (lambda name: False)
+
+    def find(self, name):
+        def ttl(lb):
+            seconds = self.ttl if lb is not None else self.negative_ttl
+            if seconds > 0 and self.busy(name):
+                return 0
+            return seconds
+        return self.get(name, lambda: LoadBalancer.find(name), ttl)
+
+
+def restore_batch_size(max_unavailable, total):
+    """
+    Converts max_unavailable, a host count or a percentage such as "25%", into
+    the number of hosts restored at once, which is at least one.
+    """
+    value = str(max_unavailable).strip()
+    if value.endswith("%"):
+        size = int(total * float(value[:-1]) / 100)
+    else:
+        size = int(value)
+    return max(1, min(size, total or 1))
 
 
 class BindError(Exception):
@@ -2,9 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import multiprocessing
 import os
 import re
+import threading
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 
 class ValidationError(Exception):
@@ -36,3 +40,100 @@ def host_from_destination(destination):
     if '//' not in destination:
         destination = '%s%s' % ('http://', destination)
     return urlparse.urlparse(destination).hostname, urlparse.urlparse(destination).port
+
+
+def iter_concurrently(func, items, max_workers, timeout=None):
+    """
+    Calls func for each item using at most max_workers threads and yields
+    (item, result) pairs as soon as each call finishes. Exceptions raised by
+    func are yielded as results. Items still running when timeout seconds have
+    elapsed are yielded with a multiprocessing.TimeoutError.
+    """
+    items = list(items)
+    if not items:
+        return
+    deadline = None
+    if timeout:
+        deadline = time.time() + float(timeout)
+
+    def call(idx):
+        try:
+            return idx, func(items[idx])
+        except Exception as e:
+            return idx, e
+
+    pending = set(xrange(len(items)))
+    pool = ThreadPool(max(1, min(int(max_workers), len(items))))
+    try:
+        results = pool.imap_unordered(call, xrange(len(items)))
+        while pending:
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            try:
+                idx, result = results.next(wait)
+            except multiprocessing.TimeoutError:
+                break
+            pending.discard(idx)
+            yield items[idx], result
+    finally:
+        pool.terminate()
+    for idx in sorted(pending):
+        yield items[idx], multiprocessing.TimeoutError("timed out after {} seconds".format(timeout))
+
+
+def run_concurrently(func, items, max_workers, timeout=None):
+    """
+    Same as iter_concurrently, but waits for every call and returns the
+    results in the same order as items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    for (idx, _), result in iter_concurrently(lambda i: func(i[1]), enumerate(items), max_workers, timeout):
+        results[idx] = result
+    return results
+
+
+class ExpiringCache(object):
+    """
+    Thread-safe read-through cache keeping each loaded value for a number of
+    seconds. A value loaded while the cache was invalidated is returned but
+    not kept, as the invalidation may have made it stale.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load, ttl):
+        """
+        Returns the value cached for key, calling load() when there is none
+        or it expired. ttl is either a number of seconds or a function of the
+        loaded value returning it, values with a ttl of zero are not kept.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            generation = self.generation
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = load()
+        if callable(ttl):
+            ttl = ttl(value)
+        if ttl > 0:
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (now + ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
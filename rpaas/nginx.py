@@ -2,14 +2,23 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import time
-import datetime
+import collections
+import hashlib
+import logging
 import os
+import random
+import string
+import tempfile
+import threading
+import time
 
 import requests
+from requests.exceptions import ConnectionError, RequestException
 
 from hm import config
 
+from rpaas.misc import iter_concurrently
+
 NGINX_LOCATION_INSTANCE_NOT_BOUND = '''
 location / {
     return 404 "Instance not bound";
@@ -56,63 +65,268 @@ class NginxError(Exception):
 
 
 def retry_request(f):
+    """
+    Retries f on nginx and HTTP errors until the timeout keyword argument
+    (30 seconds by default) expires. Retries back off exponentially with
+    jitter while the host refuses connections, and restart from the fast
+    interval once the port starts accepting them.
+    """
     def f_retry(self, *args, **kwargs):
         timeout = kwargs.get("timeout")
         if not timeout:
             timeout = 30
-        t0 = datetime.datetime.now()
-        timeout = datetime.timedelta(seconds=timeout)
+        deadline = time.time() + timeout
+        interval = self.retry_min_interval
+        fast_poll = False
         while True:
             try:
-                f(self, *args, **kwargs)
-                break
-            except:
-                now = datetime.datetime.now()
-            if now > t0 + timeout:
-                raise
-            time.sleep(1)
+                return f(self, *args, **kwargs)
+            except (NginxError, RequestException) as e:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise
+                if not fast_poll and not isinstance(e, ConnectionError):
+                    fast_poll = True
+                    interval = self.retry_fast_interval
+                delay = random.uniform(interval / 2.0, interval)
+                interval = min(interval * 2, self.retry_max_interval)
+            time.sleep(min(delay, remaining))
     return f_retry
 
 
+class LocationTemplate(object):
+    """
+    A location template checked once when it is loaded, so rendering it is
+    just a string format.
+    """
+    fields = ("path", "host", "upstream", "https_only")
+
+    def __init__(self, text, etag=None, last_modified=None):
+        try:
+            names = set(name for _, name, _, _ in string.Formatter().parse(text) if name)
+        except ValueError as e:
+            raise NginxError("Invalid location template: {}".format(e))
+        unknown = names - set(self.fields)
+        if unknown:
+            raise NginxError("Invalid location template: unknown fields {}".format(", ".join(sorted(unknown))))
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time()
+
+    def render(self, **params):
+        return self.text.format(**params)
+
+
+_location_templates = {}
+_location_templates_lock = threading.Lock()
+_location_template_refreshes = {}
+
+
+def load_location_template(url, ttl=300, timeout=5):
+    """
+    Returns the template served at url, fetching it at most once every ttl
+    seconds per process. Only the first load blocks, expired templates keep
+    being served while a single background thread revalidates them with
+    ETag and Last-Modified.
+    """
+    with _location_templates_lock:
+        cached = _location_templates.get(url)
+        refresh = None
+        expired = cached is not None and time.time() - cached.fetched_at >= ttl
+        if expired and url not in _location_template_refreshes:
+            refresh = threading.Thread(target=_refresh_location_template, args=(url, cached, timeout))
+            refresh.daemon = True
+            _location_template_refreshes[url] = refresh
+    if cached is None:
+        return _fetch_location_template(url, None, timeout)
+    if refresh is not None:
+        refresh.start()
+    return cached
+
+
+def _refresh_location_template(url, cached, timeout):
+    try:
+        _fetch_location_template(url, cached, timeout)
+    except Exception as e:
+        logging.warning("Error refreshing location template from {}: {}".format(url, e))
+    finally:
+        with _location_templates_lock:
+            _location_template_refreshes.pop(url, None)
+
+
+def _fetch_location_template(url, cached, timeout):
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+    try:
+        rsp = requests.get(url, headers=headers, timeout=timeout)
+        if rsp.status_code == 304 and cached is not None:
+            cached.fetched_at = time.time()
+            return cached
+        if rsp.status_code > 299:
+            raise NginxError("Error trying to load location template: {} - {}".
+                             format(rsp.status_code, rsp.text))
+        template = LocationTemplate(rsp.text, rsp.headers.get("ETag"), rsp.headers.get("Last-Modified"))
+    except (NginxError, RequestException) as e:
+        if cached is None:
+            raise
+        logging.warning("Serving stale location template from {}: {}".format(url, e))
+        cached.fetched_at = time.time()
+        return cached
+    with _location_templates_lock:
+        _location_templates[url] = template
+    return template
+
+
 class ConfigManager(object):
 
     def __init__(self, conf=None):
-        self.location_template_default = self._load_location_template(conf, "default")
-        self.location_template_router = self._load_location_template(conf, "router")
+        self.conf = conf
+        self.template_ttl = int(config.get_config("NGINX_LOCATION_TEMPLATE_TTL", 300, conf))
+        self.template_timeout = int(config.get_config("NGINX_LOCATION_TEMPLATE_TIMEOUT", 5, conf))
+        self.templates = {}
+        for mode in ("default", "router"):
+            self._location_template(mode)
+
+    @property
+    def location_template_default(self):
+        return self._location_template("default").text
+
+    @property
+    def location_template_router(self):
+        return self._location_template("router").text
 
     def generate_host_config(self, path, destination, upstream, router_mode=False, https_only=False):
         https_only_template = ''
         if https_only:
             https_only_template = NGINX_HTTPS_ONLY
-        if router_mode:
-            return self.location_template_router.format(
-                path=path.rstrip('/') + '/',
-                host=destination,
-                upstream=upstream,
-                https_only=https_only_template
-            )
-        return self.location_template_default.format(
+        template = self._location_template("router" if router_mode else "default")
+        return template.render(
             path=path.rstrip('/') + '/',
             host=destination,
             upstream=upstream,
             https_only=https_only_template
         )
 
-    def _load_location_template(self, conf, mode):
-        mode = mode.upper()
-        template_txt = config.get_config('NGINX_LOCATION_TEMPLATE_{}_TXT'.format(mode), None, conf)
-        if template_txt:
-            return template_txt
-        template_url = config.get_config('NGINX_LOCATION_TEMPLATE_{}_URL'.format(mode), None, conf)
-        if template_url:
-            rsp = requests.get(template_url)
-            if rsp.status_code > 299:
-                raise NginxError("Error trying to load location template: {} - {}".
-                                 format(rsp.status_code, rsp.text))
-            return rsp.text
-        if mode == "DEFAULT":
-            return NGINX_LOCATION_TEMPLATE_DEFAULT
-        return NGINX_LOCATION_TEMPLATE_ROUTER
+    def _location_template(self, mode):
+        if mode in self.templates:
+            return self.templates[mode]
+        template_url = config.get_config('NGINX_LOCATION_TEMPLATE_{}_URL'.format(mode.upper()), None, self.conf)
+        template_txt = config.get_config('NGINX_LOCATION_TEMPLATE_{}_TXT'.format(mode.upper()), None, self.conf)
+        if template_url and not template_txt:
+            return load_location_template(template_url, self.template_ttl, self.template_timeout)
+        if not template_txt:
+            template_txt = NGINX_LOCATION_TEMPLATE_DEFAULT if mode == "default" else NGINX_LOCATION_TEMPLATE_ROUTER
+        self.templates[mode] = LocationTemplate(template_txt)
+        return self.templates[mode]
+
+
+class NginxAdminClient(object):
+    """
+    Long-lived HTTP client for the nginx admin endpoints. It keeps one
+    keep-alive session per (host, port, scheme), so purges, healthchecks and
+    session ticket pushes reuse connections instead of opening new ones.
+    """
+
+    def __init__(self, ca_cert=None, ca_path=None, pool_maxsize=4, max_hosts=256):
+        self.ca_cert = ca_cert
+        if ca_path is None and ca_cert:
+            digest = hashlib.sha1(ca_cert.encode("utf-8")).hexdigest()
+            ca_path = os.path.join(tempfile.gettempdir(), "rpaas_ca_{}.pem".format(digest))
+        self.ca_path = ca_path
+        self.pool_maxsize = int(pool_maxsize)
+        self.max_hosts = int(max_hosts)
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted_stats = {"requests": 0, "connections": 0, "evicted_hosts": 0}
+
+    def request(self, method, scheme, host, port, path, **params):
+        url = "{}://{}:{}/{}".format(scheme, host, port, path)
+        return self.session(host, port, scheme).request(method, url, **params)
+
+    def session(self, host, port, scheme):
+        key = (host, str(port), scheme)
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            if session is None:
+                session = self._new_session(scheme)
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_hosts:
+                # another thread may still be using the evicted session, its
+                # connections are closed once it is garbage collected
+                _, evicted = self.sessions.popitem(last=False)
+                self._add_stats(self.evicted_stats, evicted)
+                self.evicted_stats["evicted_hosts"] += 1
+        return session
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.evicted_stats)
+            for session in self.sessions.values():
+                self._add_stats(stats, session)
+        stats["hosts"] = len(self.sessions)
+        stats["max_hosts"] = self.max_hosts
+        stats["pool_maxsize"] = self.pool_maxsize
+        stats["reused_connections"] = max(0, stats["requests"] - stats["connections"])
+        return stats
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+    def _new_session(self, scheme):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount("{}://".format(scheme), adapter)
+        if scheme == "https":
+            session.verify = self._ca_file()
+        return session
+
+    def _ca_file(self):
+        if not self.ca_cert:
+            raise NginxError("CA_CERT should be set for nginx https internal requests")
+        # the path is named after the certificate, so an existing file always
+        # holds it, it is checked for each new session in case it was removed
+        if not os.path.exists(self.ca_path):
+            fd, tmp_path = tempfile.mkstemp(suffix=".pem", dir=os.path.dirname(self.ca_path))
+            with os.fdopen(fd, "w") as ca_file:
+                ca_file.write(self.ca_cert)
+            os.rename(tmp_path, self.ca_path)
+        return self.ca_path
+
+    def _add_stats(self, stats, session):
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    stats["requests"] += pool.num_requests
+                    stats["connections"] += pool.num_connections
+
+
+_admin_clients = {}
+_admin_clients_lock = threading.Lock()
+
+
+def get_admin_client(ca_cert=None, pool_maxsize=4, max_hosts=256):
+    key = (ca_cert, int(pool_maxsize), int(max_hosts))
+    with _admin_clients_lock:
+        client = _admin_clients.get(key)
+        if client is None:
+            client = _admin_clients[key] = NginxAdminClient(ca_cert=ca_cert, pool_maxsize=pool_maxsize,
+                                                            max_hosts=max_hosts)
+        return client
+
+
+def admin_clients_stats():
+    with _admin_clients_lock:
+        clients = list(_admin_clients.values())
+    return [client.stats() for client in clients]
 
 
 class Nginx(object):
@@ -131,33 +345,70 @@ class Nginx(object):
         self.nginx_app_expected_healthcheck = config.get_config('NGINX_HEALTHECK_APP_EXPECTED',
                                                                 'WORKING', conf)
         self.ca_cert = config.get_config('CA_CERT', None, conf)
-        self.ca_path = "/tmp/rpaas_ca.pem"
+        self.nginx_purge_concurrency = int(config.get_config('NGINX_PURGE_CONCURRENCY', 16, conf))
+        self.nginx_purge_timeout = float(config.get_config('NGINX_PURGE_TIMEOUT', 10, conf))
+        self.nginx_purge_bulk_timeout = float(config.get_config('NGINX_PURGE_BULK_TIMEOUT', 120, conf))
+        self.retry_min_interval = float(config.get_config('NGINX_RETRY_MIN_INTERVAL', 1, conf))
+        self.retry_max_interval = float(config.get_config('NGINX_RETRY_MAX_INTERVAL', 30, conf))
+        self.retry_fast_interval = float(config.get_config('NGINX_RETRY_FAST_INTERVAL', 0.2, conf))
         self.config_manager = ConfigManager(conf)
+        self.admin_client = get_admin_client(self.ca_cert,
+                                             config.get_config('NGINX_ADMIN_POOL_MAXSIZE', 4, conf),
+                                             config.get_config('NGINX_ADMIN_MAX_HOSTS', 256, conf))
 
     def purge_location(self, host, path, preserve_path=False):
+        return self.purge_location_hosts([host], path, preserve_path)[host]
+
+    def purge_location_hosts(self, hosts, path, preserve_path=False):
+        for _, purged in self.purge_locations(hosts, [(path, preserve_path)]):
+            return purged
+
+    def purge_locations(self, hosts, locations, timeout=None):
+        """
+        Purges every (path, preserve_path) in locations on every host through
+        a single pool, yielding ((path, preserve_path), {host: purged}) as
+        soon as all requests for a location are done.
+        """
+        if timeout is None:
+            timeout = self.nginx_purge_timeout
+        locations = list(locations)
+        results = [dict((host, False) for host in hosts) for _ in locations]
+        remaining = [0] * len(locations)
+        purges = []
+        for idx, (path, preserve_path) in enumerate(locations):
+            for host in hosts:
+                for purge_path, headers in self._purge_variants(path, preserve_path):
+                    purges.append((idx, host, purge_path, headers))
+                    remaining[idx] += 1
+        for idx, count in enumerate(remaining):
+            if count == 0:
+                yield locations[idx], results[idx]
+        for (idx, host, _, _), result in iter_concurrently(self._purge_request, purges,
+                                                           self.nginx_purge_concurrency, timeout):
+            if result is True:
+                results[idx][host] = True
+            remaining[idx] -= 1
+            if remaining[idx] == 0:
+                yield locations[idx], results[idx]
+
+    def _purge_variants(self, path, preserve_path=False):
         purge_path = self.nginx_purge_path.lstrip('/')
-        purged = False
         if preserve_path:
-            for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}".format(purge_path, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-            return purged
-        for scheme in ['http', 'https']:
-            for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}{}".format(purge_path, scheme, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-        return purged
+            paths = ["{}/{}".format(purge_path, path)]
+        else:
+            paths = ["{}/{}{}".format(purge_path, scheme, path) for scheme in ['http', 'https']]
+        return [(p, {'Accept-Encoding': encoding}) for p in paths for encoding in ['gzip', 'identity']]
+
+    def _purge_request(self, purge):
+        _, host, path, headers = purge
+        self._nginx_request(host, path, headers)
+        return True
 
     @retry_request
     def wait_healthcheck(self, host, timeout=30, manage_healthcheck=True):
+        self.healthcheck(host, manage_healthcheck=manage_healthcheck)
+
+    def healthcheck(self, host, manage_healthcheck=True):
         if manage_healthcheck:
             healthcheck_path = self.nginx_healthcheck_path.lstrip('/')
             expected_response = self.nginx_expected_healthcheck
@@ -168,6 +419,18 @@ class Nginx(object):
             port = self.nginx_app_port
         self._nginx_request(host, healthcheck_path, port=port, expected_response=expected_response)
 
+    def wait_healthchecks(self, hosts, **kwargs):
+        """
+        Waits for every host at the same time, yielding (host, error) as soon
+        as each one becomes healthy (error is None) or times out. Keyword
+        arguments are passed on to wait_healthcheck.
+        """
+        def wait(host):
+            self.wait_healthcheck(host, **kwargs)
+        hosts = list(hosts)
+        for host, error in iter_concurrently(wait, hosts, len(hosts)):
+            yield host, error
+
     @retry_request
     def add_session_ticket(self, host, data, timeout=30):
         self._nginx_request(host, 'session_ticket', data=data, method='POST', secure=True,
@@ -180,27 +443,18 @@ class Nginx(object):
             if not port:
                 port = self.nginx_manage_port_tls
             protocol = 'https'
-            self._ensure_ca_cert_file()
-            params['verify'] = self.ca_path
         else:
             if not port:
                 port = self.nginx_manage_port
             protocol = 'http'
-        url = "{}://{}:{}/{}".format(protocol, host, port, path)
         if method not in ['POST', 'PUT', 'GET']:
             raise NginxError("Unsupported method {}".format(method))
         if headers:
             params['headers'] = headers
         if data:
             params['data'] = data
-        rsp = requests.request(method.lower(), url, timeout=2, **params)
+        rsp = self.admin_client.request(method.lower(), protocol, host, port, path, timeout=2, **params)
         if rsp.status_code != 200 or (expected_response and expected_response not in rsp.text):
+            url = "{}://{}:{}/{}".format(protocol, host, port, path)
             raise NginxError(
                 "Error trying to access admin path in nginx: {}: {}".format(url, rsp.text))
-
-    def _ensure_ca_cert_file(self):
-        if not self.ca_cert:
-            raise NginxError("CA_CERT should be set for nginx https internal requests")
-        if not os.path.exists(self.ca_path):
-            with open(self.ca_path, "w") as ca_file:
-                ca_file.write(self.ca_cert)
@@ -161,8 +161,8 @@ def status(name):
 @router.route("/info", methods=["GET"])
 @auth.required
 def info():
-    plans = get_manager().storage.list_plans()
-    flavors = get_manager().storage.list_flavors()
+    plans = get_manager().catalog.plans()
+    flavors = get_manager().catalog.flavors()
     options_plans = ["{} - {}".format(p.name, p.description) for p in plans]
     options_flavors = ["{} - {}".format(f.name, f.description) for f in flavors]
     options = """
@@ -3,7 +3,10 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import logging
+import time
 
+import pymongo
 import pymongo.errors
 
 from hm import storage
@@ -37,6 +40,35 @@ class MongoDBStorage(storage.MongoDBStorage):
     quota_collection = "quota"
     le_certificates_collection = "le_certificates"
     healing_collection = "healing"
+    provisions_collection = "provisions"
+    warm_pool_stats_collection = "warm_pool_stats"
+    warm_pool_creations_collection = "warm_pool_creations"
+    desired_states_collection = "desired_states"
+    drift_reports_collection = "drift_reports"
+    scale_reports_collection = "scale_reports"
+
+    # indexes backing every query that does not filter on _id, as
+    # (collection attribute, keys, options)
+    indexes = [
+        ("healing_collection", [("start_time", pymongo.DESCENDING)], {}),
+        ("hosts_collection", [("dns_name", pymongo.ASCENDING)], {}),
+        ("hosts_collection", [("group", pymongo.ASCENDING), ("pool_state", pymongo.ASCENDING)], {}),
+        ("provisions_collection", [("instance", pymongo.ASCENDING), ("state", pymongo.ASCENDING)], {}),
+        ("quota_collection", [("used", pymongo.ASCENDING)], {}),
+        ("le_certificates_collection", [("created", pymongo.ASCENDING)], {}),
+        ("warm_pool_creations_collection", [("group", pymongo.ASCENDING)], {}),
+    ]
+
+    def ensure_indexes(self):
+        """
+        Creates the declared indexes, leaving the existing ones untouched. An
+        index that cannot be created is logged and does not stop the others.
+        """
+        for collection, keys, options in self.indexes:
+            try:
+                self.db[getattr(self, collection)].create_index(keys, background=True, **options)
+            except pymongo.errors.PyMongoError as e:
+                logging.error("Error creating index {} on {}: {}".format(keys, getattr(self, collection), e))
 
     def store_hc(self, hc):
         self.db[self.hcs_collections].update({"_id": hc["_id"]}, hc, upsert=True)
@@ -44,17 +76,26 @@ class MongoDBStorage(storage.MongoDBStorage):
     def retrieve_hc(self, name):
         return self.db[self.hcs_collections].find_one({"_id": name})
 
+    def add_hc_url(self, name, url):
+        self.db[self.hcs_collections].update({"_id": name}, {"$push": {"urls": url}})
+
+    def remove_hc_url(self, name, url):
+        self.db[self.hcs_collections].update({"_id": name}, {"$pull": {"urls": url}})
+
     def remove_hc(self, name):
         self.db[self.hcs_collections].remove({"_id": name})
 
+    def list_hcs(self):
+        return list(self.db[self.hcs_collections].find())
+
     def store_healing(self, instance, machine):
         return self.db[self.healing_collection].insert({"instance": instance, "machine": machine,
                                                         "start_time": datetime.datetime.utcnow()})
 
-    def update_healing(self, id, status):
-        self.db[self.healing_collection].update({"_id": id},
-                                                {"$set": {"status": status,
-                                                          "end_time": datetime.datetime.utcnow()}})
+    def update_healing(self, id, status, **timing):
+        spec = {"status": status, "end_time": datetime.datetime.utcnow()}
+        spec.update(timing)
+        self.db[self.healing_collection].update({"_id": id}, {"$set": spec})
 
     def list_healings(self, quantity):
         coll = self.healing_collection
@@ -66,7 +107,7 @@ class MongoDBStorage(storage.MongoDBStorage):
             if isinstance(name, dict):
                 self.db[self.tasks_collection].insert(name)
             else:
-                self.db[self.tasks_collection].insert({'_id': name})
+                self.db[self.tasks_collection].insert({'_id': name, 'created': datetime.datetime.utcnow()})
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateError(name)
 
@@ -85,6 +126,159 @@ class MongoDBStorage(storage.MongoDBStorage):
         else:
             return self.db[self.tasks_collection].find({"_id": query})
 
+    def find_task_status(self, name):
+        """
+        Returns the task holding name, with its status, task id and creation
+        time only, or None when there is none. It is a single primary key
+        lookup.
+        """
+        return self.db[self.tasks_collection].find_one({'_id': name}, {'status': 1, 'task_id': 1, 'created': 1})
+
+    def mark_task_failure(self, name, task_id=None):
+        """
+        Marks the task holding name as failed, unless it already belongs to
+        another task. The task id is stored once the task is enqueued, so a
+        task that fails before that finds it unset.
+        """
+        query = {'_id': name}
+        if task_id is not None:
+            query['task_id'] = {'$in': [task_id, None]}
+        self.db[self.tasks_collection].update(query, {'$set': {'status': 'failure'}})
+
+    def bulk_update_tasks(self, store=None, remove=None):
+        """
+        Stores the tasks that do not exist yet and removes the given task ids
+        in a single round trip. Existing tasks are left untouched.
+        """
+        requests = []
+        for task in store or []:
+            requests.append(pymongo.UpdateOne({'_id': task['_id']}, {'$setOnInsert': task}, upsert=True))
+        if remove:
+            requests.append(pymongo.DeleteMany({'_id': {'$in': list(remove)}}))
+        if requests:
+            self.db[self.tasks_collection].bulk_write(requests, ordered=False)
+
+    def store_provision(self, provision):
+        self.db[self.provisions_collection].insert(provision)
+
+    def update_provision(self, provision_id, spec):
+        self.db[self.provisions_collection].update({'_id': provision_id}, {'$set': spec})
+
+    def find_provision(self, provision_id):
+        return self.db[self.provisions_collection].find_one({'_id': provision_id})
+
+    def find_provisions(self, query):
+        return self.db[self.provisions_collection].find(query)
+
+    def remove_provisions(self, query):
+        self.db[self.provisions_collection].remove(query)
+
+    def update_pool_host(self, host_id, state):
+        self.db[self.hosts_collection].update({'_id': host_id}, {'$set': {'pool_state': state}})
+
+    def count_pool_hosts(self, group, state=None):
+        query = {'group': group}
+        if state:
+            query['pool_state'] = state
+        return self.db[self.hosts_collection].find(query).count()
+
+    def store_pool_entry(self, group, manager):
+        return self.db[self.warm_pool_creations_collection].insert({'group': group, 'manager': manager,
+                                                                    'created': datetime.datetime.utcnow()})
+
+    def list_pool_entries(self, group):
+        return list(self.db[self.warm_pool_creations_collection].find({'group': group}))
+
+    def remove_pool_entry(self, entry_id):
+        self.db[self.warm_pool_creations_collection].remove({'_id': entry_id})
+
+    def claim_pool_host(self, group, instance_name, alternative_id=None):
+        query = {'group': group, 'pool_state': 'ready'}
+        if alternative_id is not None:
+            query['alternative_id'] = alternative_id
+        return self.db[self.hosts_collection].find_and_modify(
+            query=query,
+            update={'$set': {'group': instance_name}, '$unset': {'pool_state': ''}},
+            new=True)
+
+    def inc_warm_pool_stats(self, key, **counters):
+        self.db[self.warm_pool_stats_collection].update({'_id': key}, {'$inc': counters}, upsert=True)
+
+    def list_warm_pool_stats(self):
+        return list(self.db[self.warm_pool_stats_collection].find())
+
+    def store_desired_state(self, instance_name, **spec):
+        """
+        Records the target state of an instance, bumping its generation so a
+        running reconcile can tell it has been superseded.
+        """
+        return self.db[self.desired_states_collection].find_and_modify(
+            query={'_id': instance_name},
+            update={'$set': spec, '$inc': {'generation': 1}},
+            upsert=True, new=True)
+
+    def find_desired_state(self, instance_name):
+        return self.db[self.desired_states_collection].find_one({'_id': instance_name})
+
+    def queue_reconcile(self, instance_name, task_id):
+        """
+        Flags the instance as queued for the reconcile task task_id and
+        returns whether the caller must enqueue it. The flag is held until
+        that task starts, however long it waits for the instance.
+        """
+        state = self.db[self.desired_states_collection].find_and_modify(
+            query={'_id': instance_name, 'queued': {'$ne': True}},
+            update={'$set': {'queued': True, 'queued_task_id': task_id}})
+        return state is not None
+
+    def requeue_reconcile(self, instance_name, lost_task_id, task_id):
+        """
+        Hands the queued flag held by lost_task_id, known to be gone, over to
+        task_id. Returns whether the caller must enqueue task_id.
+        """
+        state = self.db[self.desired_states_collection].find_and_modify(
+            query={'_id': instance_name, 'queued': True, 'queued_task_id': lost_task_id},
+            update={'$set': {'queued_task_id': task_id}})
+        return state is not None
+
+    def start_reconcile(self, instance_name):
+        return self.db[self.desired_states_collection].find_and_modify(
+            query={'_id': instance_name},
+            update={'$set': {'queued': False}, '$unset': {'queued_task_id': ''}},
+            new=True)
+
+    def finish_reconcile(self, instance_name, generation, error=None):
+        self.db[self.desired_states_collection].update({'_id': instance_name}, {'$set': {
+            'observed_generation': generation,
+            'last_error': error,
+            'reconciled_at': datetime.datetime.utcnow(),
+        }})
+
+    def remove_desired_state(self, instance_name):
+        self.db[self.desired_states_collection].remove({'_id': instance_name})
+
+    def store_scale_report(self, instance_name, report):
+        """
+        Keeps the progress of the last scale of the instance, which outlives
+        the task entry so a failed or partial scale can still be inspected.
+        """
+        data = dict(report, _id=instance_name, updated=datetime.datetime.utcnow())
+        self.db[self.scale_reports_collection].update({'_id': instance_name}, data, upsert=True)
+
+    def find_scale_report(self, instance_name):
+        return self.db[self.scale_reports_collection].find_one({'_id': instance_name})
+
+    def remove_scale_report(self, instance_name):
+        self.db[self.scale_reports_collection].remove({'_id': instance_name})
+
+    def replace_drift_reports(self, reports):
+        self.db[self.drift_reports_collection].remove({})
+        if reports:
+            self.db[self.drift_reports_collection].insert(reports)
+
+    def list_drift_reports(self):
+        return list(self.db[self.drift_reports_collection].find().sort("_id"))
+
     def store_instance_metadata(self, instance_name, **data):
         data['_id'] = instance_name
         self.db[self.instance_metadata_collection].update({'_id': instance_name},
@@ -93,9 +287,34 @@ class MongoDBStorage(storage.MongoDBStorage):
     def find_instance_metadata(self, instance_name):
         return self.db[self.instance_metadata_collection].find_one({'_id': instance_name})
 
+    def find_instances_metadata(self, instance_names):
+        metadata = self.db[self.instance_metadata_collection].find({'_id': {'$in': list(instance_names)}})
+        return dict((data['_id'], data) for data in metadata)
+
     def find_host_id(self, name):
         return self.db[self.hosts_collection].find_one({'dns_name': name})
 
+    def list_host_addresses(self):
+        return list(self.db[self.hosts_collection].find({}, {'dns_name': 1, 'group': 1}))
+
+    def find_hosts_by_dns_name(self, names):
+        hosts = self.db[self.hosts_collection].find({'dns_name': {'$in': list(names)}})
+        return dict((host['dns_name'], host) for host in hosts)
+
+    def count_hosts_by_group(self, groups):
+        counts = self.db[self.hosts_collection].aggregate([
+            {'$match': {'group': {'$in': list(groups)}}},
+            {'$group': {'_id': '$group', 'count': {'$sum': 1}}},
+        ])
+        return dict((count['_id'], count['count']) for count in counts)
+
+    def count_hosts_by_alternative(self, group):
+        counts = self.db[self.hosts_collection].aggregate([
+            {'$match': {'group': group}},
+            {'$group': {'_id': '$alternative_id', 'count': {'$sum': 1}}},
+        ])
+        return dict((count['_id'] or 0, count['count']) for count in counts)
+
     def remove_instance_metadata(self, instance_name):
         self.db[self.instance_metadata_collection].remove({'_id': instance_name})
 
@@ -104,6 +323,8 @@ class MongoDBStorage(storage.MongoDBStorage):
         d = plan.to_dict()
         d["_id"] = d["name"]
         del d["name"]
+        # a recreated plan must not reuse the versions of the removed one
+        d["version"] = int(time.time() * 1000)
         try:
             self.db[self.plans_collection].insert(d)
         except pymongo.errors.DuplicateKeyError:
@@ -117,7 +338,7 @@ class MongoDBStorage(storage.MongoDBStorage):
             update["config"] = config
         if update:
             result = self.db[self.plans_collection].update({"_id": name},
-                                                           {"$set": update})
+                                                           {"$set": update, "$inc": {"version": 1}})
             if not result.get("updatedExisting"):
                 raise PlanNotFoundError()
 
@@ -132,6 +353,16 @@ class MongoDBStorage(storage.MongoDBStorage):
             raise PlanNotFoundError()
         return self._plan_from_dict(plan_dict)
 
+    def find_plan_config(self, name):
+        """
+        Returns the version and config of the plan, the version is bumped
+        by every update.
+        """
+        plan_dict = self.db[self.plans_collection].find_one({'_id': name}, {'config': 1, 'version': 1})
+        if not plan_dict:
+            raise PlanNotFoundError()
+        return plan_dict.get("version", 0), plan_dict.get("config")
+
     def list_plans(self):
         plan_list = self.db[self.plans_collection].find()
         return [self._plan_from_dict(p) for p in plan_list]
@@ -139,6 +370,7 @@ class MongoDBStorage(storage.MongoDBStorage):
     def _plan_from_dict(self, dict):
         dict["name"] = dict["_id"]
         del dict["_id"]
+        dict.pop("version", None)
         return plan.Plan(**dict)
 
     def store_flavor(self, flavor):
@@ -146,6 +378,8 @@ class MongoDBStorage(storage.MongoDBStorage):
         d = flavor.to_dict()
         d["_id"] = d["name"]
         del d["name"]
+        # a recreated flavor must not reuse the versions of the removed one
+        d["version"] = int(time.time() * 1000)
         try:
             self.db[self.flavors_collection].insert(d)
         except pymongo.errors.DuplicateKeyError:
@@ -159,7 +393,7 @@ class MongoDBStorage(storage.MongoDBStorage):
             update["config"] = config
         if update:
             result = self.db[self.flavors_collection].update({"_id": name},
-                                                             {"$set": update})
+                                                             {"$set": update, "$inc": {"version": 1}})
             if not result.get("updatedExisting"):
                 raise FlavorNotFoundError()
 
@@ -174,6 +408,12 @@ class MongoDBStorage(storage.MongoDBStorage):
             raise FlavorNotFoundError()
         return self._flavor_from_dict(flavor_dict)
 
+    def find_flavor_config(self, name):
+        flavor_dict = self.db[self.flavors_collection].find_one({'_id': name}, {'config': 1, 'version': 1})
+        if not flavor_dict:
+            raise FlavorNotFoundError()
+        return flavor_dict.get("version", 0), flavor_dict.get("config")
+
     def list_flavors(self):
         flavor_list = self.db[self.flavors_collection].find()
         return [self._flavor_from_dict(p) for p in flavor_list]
@@ -181,6 +421,7 @@ class MongoDBStorage(storage.MongoDBStorage):
     def _flavor_from_dict(self, dict):
         dict["name"] = dict["_id"]
         del dict["_id"]
+        dict.pop("version", None)
         return flavor.Flavor(**dict)
 
     def store_binding(self, name, app_host, app_host_only=False):
@@ -264,7 +505,7 @@ class MongoDBStorage(storage.MongoDBStorage):
         return result['n'] == 1
 
     def decrement_quota(self, servicename):
-        self.db[self.quota_collection].update({}, {'$pull': {'used': servicename}}, multi=True)
+        self.db[self.quota_collection].update({'used': servicename}, {'$pull': {'used': servicename}}, multi=True)
 
     def store_le_certificate(self, name, domain):
         doc = {"_id": name, "domain": domain,
@@ -2,25 +2,35 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
 import copy
 import datetime
+import hashlib
+import ipaddress
+import json
 import logging
 import os
 import sys
+import threading
+import time
 from urlparse import urlparse
 
 from celery import Celery, Task
+from celery.signals import task_revoked, worker_process_init
+from celery.utils import uuid
 import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
 
-from hm import config
+from hm import config, managers
 from hm.model.host import Host
 from hm.model.load_balancer import LoadBalancer
+from requests.exceptions import RequestException
 
-from rpaas import (consul_manager, hc, nginx, sslutils, ssl_plugins,
+from rpaas import (consul_manager, config_resolver, hc, nginx, sslutils, ssl_plugins,
                    storage, celery_sentinel, acl, lock)
-from rpaas.misc import check_option_enable
+from rpaas.misc import check_option_enable, run_concurrently
+from rpaas.nginx import NginxError
 
 possible_redis_envs = ['SENTINEL_ENDPOINT', 'DBAAS_SENTINEL_ENDPOINT', 'REDIS_ENDPOINT']
 
@@ -84,6 +94,89 @@ def initialize_celery():
 app = initialize_celery()
 
 
+def config_hash(config):
+    # settings missing from config fall back to the environment, so both
+    # make up the effective config
+    effective = [config, sorted(os.environ.items())]
+    return hashlib.sha1(json.dumps(effective, sort_keys=True, default=str)).hexdigest()
+
+
+class WorkerRegistry(object):
+    """
+    Per worker process cache for the collaborators built by init_config, so
+    frequent tasks reuse connections and loaded templates. Entries are keyed
+    by factory and effective config, and the least recently used ones are
+    evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, factory, config, *args, **kwargs):
+        key = (factory, config_hash(config)) + args
+        with self._lock:
+            if key in self._items:
+                item = self._items.pop(key)
+                self._items[key] = item
+                return item
+        build = kwargs.get("build")
+        item = build() if build else factory(config, *args)
+        with self._lock:
+            self._items[key] = item
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return item
+
+    def invalidate(self, config=None):
+        with self._lock:
+            if config is None:
+                self._items.clear()
+                return
+            digest = config_hash(config)
+            for key in [k for k in self._items if k[1] == digest]:
+                del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+
+registry = WorkerRegistry(int(os.environ.get("RPAAS_WORKER_REGISTRY_SIZE", 32)))
+
+
+@worker_process_init.connect
+def reset_registry(**kwargs):
+    registry.invalidate()
+
+
+def mark_instance_failure(task, task_id, args, kwargs=None):
+    """
+    Keeps the failure of a task on the task entry of its instance, so status
+    polls do not have to query the result backend. Every task holding an
+    instance task entry takes the config and the instance name as its first
+    arguments, passed either by position or by keyword.
+    """
+    if not getattr(task, "holds_instance_task", False):
+        return
+    args = list(args or ())
+    kwargs = kwargs or {}
+    config = args[0] if len(args) > 0 else kwargs.get("config")
+    name = args[1] if len(args) > 1 else kwargs.get("name")
+    if name is None:
+        return
+    try:
+        registry.get(storage.MongoDBStorage, config).mark_task_failure(name, task_id)
+    except Exception as e:
+        logging.error("Error recording failure of task {} for {}: {}".format(task_id, name, e))
+
+
+@task_revoked.connect
+def mark_revoked(sender=None, request=None, **kwargs):
+    if request is not None:
+        mark_instance_failure(sender, request.id, request.args, request.kwargs)
+
+
 class NotReadyError(Exception):
     pass
 
@@ -92,14 +185,52 @@ class TaskNotFoundError(Exception):
     pass
 
 
+class ScaleInstanceError(Exception):
+    pass
+
+
+class DeleteHostsError(Exception):
+    pass
+
+
+class RestoreMachineError(Exception):
+    pass
+
+
+PROVISION_STEPS = ("create_lb", "create_host", "add_to_lb", "await_health", "apply_acls", "register_hc")
+
+
+def warm_pool_key(plan_name=None, flavor_name=None):
+    return "{}/{}".format(plan_name or "", flavor_name or "")
+
+
+def warm_pool_group(key):
+    return "rpaas-pool-{}".format(key.replace("/", "-"))
+
+
+def parse_warm_pools(value):
+    """
+    Parses RPAAS_WARM_POOLS, a comma separated list of <plan>[/<flavor>]=<size>
+    entries, into a dict of pool sizes keyed by warm_pool_key.
+    """
+    pools = {}
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        spec, _, size = entry.rpartition("=")
+        plan_name, _, flavor_name = spec.partition("/")
+        pools[warm_pool_key(plan_name, flavor_name)] = int(size)
+    return pools
+
+
 class TaskManager(object):
 
     def __init__(self, config=None):
         self.storage = storage.MongoDBStorage(config)
 
     def ensure_ready(self, name):
-        task = self.storage.find_task(name)
-        if task.count() >= 1:
+        if self.storage.find_task_status(name) is not None:
             raise NotReadyError("Async task still running")
 
     def remove(self, name):
@@ -123,16 +254,23 @@ class BaseManagerTask(Task):
 
     def init_config(self, config=None):
         self.config = config
-        self.nginx_manager = nginx.Nginx(config)
-        self.consul_manager = consul_manager.ConsulManager(config)
+        self.nginx_manager = registry.get(nginx.Nginx, config)
+        self.consul_manager = registry.get(consul_manager.ConsulManager, config)
         self.host_manager_name = self._get_conf("HOST_MANAGER", "cloudstack")
         self.lb_manager_name = self._get_conf("LB_MANAGER", "networkapi_cloudstack")
-        self.task_manager = TaskManager(config)
+        self.storage = registry.get(storage.MongoDBStorage, config)
+        self.config_resolver = registry.get(
+            config_resolver.ConfigResolver, config,
+            build=lambda: config_resolver.ConfigResolver(self.storage, config))
+        self.task_manager = registry.get(TaskManager, config)
         self.lock_manager = lock.Lock(app.backend.client)
         self.hc = hc.Dumb()
-        self.storage = storage.MongoDBStorage(config)
+        self.provision_lock = threading.RLock()
+        self.acl_lock = threading.Lock()
+        self.pending_alternatives = collections.Counter()
         self.acl_manager = acl.Dumb(self.consul_manager)
         if check_option_enable(self._get_conf("CHECK_ACL_API", None)):
+            # its lock bookkeeping is per run, so it is not kept in the registry
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(app.backend.client))
         hc_url = self._get_conf("HCAPI_URL", None)
         if hc_url:
@@ -145,98 +283,486 @@ class BaseManagerTask(Task):
     def _get_conf(self, key, default=config.undefined):
         return config.get_config(key, default, self.config)
 
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        mark_instance_failure(self, task_id, args, kwargs)
+
     def _add_host(self, name, lb=None):
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         created_lb = None
+        host = None
         try:
             if not lb:
                 lb = created_lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
                 self.hc.create(name)
-            config = copy.deepcopy(self.config)
-            if hasattr(lb, 'dsr') and lb.dsr:
-                config["HOST_TAGS"] = config["HOST_TAGS"] + ",dsr_ip:{}".format(lb.address)
-            host = Host.create(self.host_manager_name, name, config)
+            host = self._create_host(name, self._host_config(lb))
             lb.add_host(host)
             self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
-            acls = self.consul_manager.find_acl_network(name)
-            if acls:
-                acl_host = acls.pop()
-                for dst in acl_host['destination']:
-                    self.acl_manager.add_acl(name, host.dns_name, dst)
-            self.hc.add_url(name, host.dns_name)
+            self._register_host(name, host)
+            return host
         except:
             exc_info = sys.exc_info()
-            rollback = self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
-            if not rollback:
+            if not self._rollback_enabled():
                 raise
-            try:
-                if created_lb is not None:
-                    created_lb.destroy()
-            except Exception as e:
-                logging.error("Error in rollback trying to destroy load balancer: {}".format(e))
-            try:
-                if created_lb is not None:
-                    self._delete_host(name, host)
-                else:
-                    self._delete_host(name, host, lb)
-            except Exception as e:
-                logging.error("Error in rollback trying to destroy host: {}".format(e))
-            try:
-                if lb and len(lb.hosts) == 0:
-                    self.hc.destroy(name)
-            except Exception as e:
-                logging.error("Error in rollback trying to remove healthcheck: {}".format(e))
+            with self.provision_lock:
+                self._rollback_host(name, lb, created_lb, host)
             raise exc_info[0], exc_info[1], exc_info[2]
-        finally:
-            self.storage.remove_task(name)
 
-    def _delete_host(self, name, host, lb=None):
+    def _host_config(self, lb):
+        config = copy.deepcopy(self.config)
+        if hasattr(lb, 'dsr') and lb.dsr:
+            config["HOST_TAGS"] = config["HOST_TAGS"] + ",dsr_ip:{}".format(lb.address)
+        return config
+
+    def _register_host(self, name, host):
+        acls = self.consul_manager.find_acl_network(name)
+        if acls:
+            acl_host = acls.pop()
+            # acl changes take a non blocking per instance lock
+            with self.acl_lock:
+                for dst in acl_host['destination']:
+                    self.acl_manager.add_acl(name, host.dns_name, dst)
+        self.hc.add_url(name, host.dns_name)
+
+    def _create_host(self, name, config, alternative_id=None):
+        host = self._claim_pooled_host(name, config, alternative_id)
+        if host is None:
+            host = self._new_host(name, config, alternative_id)
+        return host
+
+    def _new_host(self, group, config, alternative_id=None):
+        """
+        Creates a host in the given alternative or, without one, in the
+        alternative with the fewest hosts of the group, counting the ones
+        still being created by this run, so hosts created concurrently are
+        spread the way Host.create spreads them one by one.
+        """
+        alternatives = int(self._get_conf("HM_ALTERNATIVE_CONFIG_COUNT", 1))
+        if alternatives <= 1:
+            return Host.create(self.host_manager_name, group, config)
+        if alternative_id is not None:
+            return self._store_new_host(group, config, alternative_id)
+        alternative_id = self._reserve_alternative(group, alternatives)
         try:
-            node_name = self.consul_manager.node_hostname(host.dns_name)
+            return self._store_new_host(group, config, alternative_id)
+        finally:
+            with self.provision_lock:
+                self.pending_alternatives[(group, alternative_id)] -= 1
+
+    def _store_new_host(self, group, config, alternative_id):
+        host = managers.by_name(self.host_manager_name, config).create_host(
+            name=group, alternative_id=alternative_id)
+        host.manager = self.host_manager_name
+        host.group = group
+        host.config = config
+        self.storage.store_host(host)
+        return host
+
+    def _reserve_alternative(self, group, alternatives):
+        with self.provision_lock:
+            counts = self.storage.count_hosts_by_alternative(group)
+            alternative_id = min(xrange(alternatives), key=lambda i: (
+                counts.get(i, 0) + self.pending_alternatives[(group, i)], i))
+            self.pending_alternatives[(group, alternative_id)] += 1
+            return alternative_id
+
+    def _claim_pooled_host(self, name, config, alternative_id=None):
+        pools = parse_warm_pools(self._get_conf("RPAAS_WARM_POOLS", None))
+        if not pools:
+            return None
+        metadata = self.storage.find_instance_metadata(name) or {}
+        key = warm_pool_key(metadata.get("plan_name"), metadata.get("flavor_name"))
+        if key not in pools:
+            return None
+        if alternative_id is not None:
+            host_data = self.storage.claim_pool_host(warm_pool_group(key), name, alternative_id)
+        else:
+            host_data = self._claim_least_used_alternative(warm_pool_group(key), name)
+        if host_data is None:
+            self.storage.inc_warm_pool_stats(key, misses=1)
+            return None
+        host = Host.from_dict(host_data, conf=config)
+        tags = config.get("HOST_TAGS")
+        try:
+            if tags:
+                host.tag_vm(tags.split(","), self._get_conf("CLOUDSTACK_PROJECT_ID", None))
+        except Exception as e:
+            logging.error("Error tagging pooled host {} for {}: {}".format(host.dns_name, name, e))
+            self.storage.inc_warm_pool_stats(key, claim_failures=1)
             host.destroy()
+            return None
+        self.storage.inc_warm_pool_stats(key, hits=1)
+        return host
+
+    def _claim_least_used_alternative(self, pool_group, name):
+        # a pooled host keeps the alternative it was created in, so claim the
+        # one in the alternative the instance uses the least
+        alternatives = int(self._get_conf("HM_ALTERNATIVE_CONFIG_COUNT", 1))
+        if alternatives <= 1:
+            return self.storage.claim_pool_host(pool_group, name)
+        with self.provision_lock:
+            counts = self.storage.count_hosts_by_alternative(name)
+            for alternative_id in sorted(xrange(alternatives), key=lambda i: (
+                    counts.get(i, 0) + self.pending_alternatives[(name, i)], i)):
+                host_data = self.storage.claim_pool_host(pool_group, name, alternative_id)
+                if host_data is not None:
+                    return host_data
+        return None
+
+    def _rollback_enabled(self):
+        return self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
+
+    def _rollback_host(self, name, lb, created_lb, host):
+        try:
+            if created_lb is not None:
+                created_lb.destroy()
+        except Exception as e:
+            logging.error("Error in rollback trying to destroy load balancer: {}".format(e))
+        try:
+            if host is not None and created_lb is not None:
+                self._delete_host(name, host)
+            elif host is not None:
+                self._delete_host(name, host, lb)
+        except Exception as e:
+            logging.error("Error in rollback trying to destroy host: {}".format(e))
+        try:
+            if created_lb is not None or (lb and len(lb.hosts) == 0):
+                self.hc.destroy(name)
+        except Exception as e:
+            logging.error("Error in rollback trying to remove healthcheck: {}".format(e))
+
+    def _add_hosts(self, name, lb, quantity):
+        max_parallelism = int(self._get_conf("RPAAS_SCALE_MAX_PARALLELISM", 5))
+        healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        report = {"requested": quantity, "added": [], "failed": []}
+        report_lock = threading.Lock()
+        self.storage.store_scale_report(name, report)
+
+        def record(key, value):
+            with report_lock:
+                report[key].append(value)
+                self.storage.store_scale_report(name, report)
+
+        def fail(host, error):
+            record("failed", repr(error))
+            if self._rollback_enabled():
+                with self.provision_lock:
+                    self._rollback_host(name, lb, None, host)
+
+        def create_host(_):
+            host = None
+            try:
+                host = self._create_host(name, self._host_config(lb))
+                lb.add_host(host)
+            except Exception as e:
+                fail(host, e)
+                raise
+            return host
+
+        created = [host for host in run_concurrently(create_host, xrange(quantity), max_parallelism)
+                   if not isinstance(host, Exception)]
+        # the new hosts boot at the same time, so wait for them as a group
+        pending = collections.defaultdict(list)
+        for host in created:
+            pending[host.dns_name].append(host)
+        added = []
+        for address, error in self.nginx_manager.wait_healthchecks([host.dns_name for host in created],
+                                                                   timeout=healthcheck_timeout):
+            host = pending[address].pop()
+            if error is None:
+                try:
+                    self._register_host(name, host)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                fail(host, error)
+                continue
+            record("added", address)
+            added.append(host)
+        if report["failed"]:
+            raise ScaleInstanceError("failed to add {} of {} hosts to {}: {}".format(
+                len(report["failed"]), quantity, name, "; ".join(report["failed"])))
+        return added
+
+    def _async_provisioning(self):
+        return check_option_enable(self._get_conf("RPAAS_ASYNC_PROVISIONING", None))
+
+    def _start_provisions(self, name, quantity, create_lb=False):
+        # the operation scopes the cleanup of its provisions and of the task
+        # gate, so it never touches the ones of a later operation
+        operation = uuid()
+        self.storage.update_task(name, {"operation": operation})
+        provision_ids = []
+        for _ in xrange(quantity):
+            provision_id = "{}:{}".format(name, uuid())
+            self.storage.store_provision({"_id": provision_id, "instance": name, "operation": operation,
+                                          "step": PROVISION_STEPS[0 if create_lb else 1],
+                                          "state": "running", "created": datetime.datetime.utcnow()})
+            provision_ids.append(provision_id)
+        # every provision must be stored before the first one runs, otherwise
+        # a fast one could find no sibling running and release the task early
+        for provision_id in provision_ids:
+            ProvisionHostTask().delay(self.config, provision_id)
+        return provision_ids
+
+    def _delete_host(self, name, host, lb=None, node_names=None):
+        if node_names is None:
+            node_name = self.consul_manager.node_hostnames([host.dns_name]).get(host.dns_name)
+        else:
+            node_name = node_names.get(host.dns_name)
+        host.destroy()
+        with self.provision_lock:
             if lb is not None:
                 lb.remove_host(host)
-            if node_name is not None:
-                self.consul_manager.remove_node(name, node_name, host.id)
+        if node_name is not None:
+            self.consul_manager.remove_node(name, node_name, host.id)
+        # acl changes take a non blocking per instance lock
+        with self.acl_lock:
             self.acl_manager.remove_acl(name, host.dns_name)
-            self.hc.remove_url(name, host.dns_name)
-        finally:
-            self.storage.remove_task(name)
+        self.hc.remove_url(name, host.dns_name)
+
+    def _delete_hosts(self, name, hosts, lb=None):
+        if not hosts:
+            return
+        max_parallelism = int(self._get_conf("RPAAS_DELETE_MAX_PARALLELISM", 5))
+        node_names = self.consul_manager.node_hostnames([host.dns_name for host in hosts])
+
+        def delete_host(host):
+            self._delete_host(name, host, lb, node_names=node_names)
+
+        results = run_concurrently(delete_host, hosts, max_parallelism)
+        failures = ["{}: {!r}".format(host.dns_name, result)
+                    for host, result in zip(hosts, results) if isinstance(result, Exception)]
+        for failure in failures:
+            logging.error("Error removing host from {}: {}".format(name, failure))
+        if failures:
+            raise DeleteHostsError("failed to remove {} of {} hosts from {}: {}".format(
+                len(failures), len(hosts), name, "; ".join(failures)))
 
 
 class NewInstanceTask(BaseManagerTask):
+    holds_instance_task = True
 
     def run(self, config, name):
+        release_task = True
+        try:
+            self.init_config(config)
+            if self._async_provisioning():
+                self._start_provisions(name, 1, create_lb=True)
+                release_task = False
+            else:
+                self._add_host(name)
+        finally:
+            if release_task:
+                self.storage.remove_task(name)
+
+
+class ProvisionHostTask(BaseManagerTask):
+    """
+    Adds a single host to an instance one persisted step at a time. While
+    the host is booting the task re-enqueues itself with a countdown instead
+    of holding the worker, and a redelivered message resumes from the last
+    completed step. The instance task is released once every provision of
+    the instance has finished.
+    """
+    acks_late = True
+
+    def run(self, config, provision_id):
         self.init_config(config)
-        self._add_host(name)
+        provision = self.storage.find_provision(provision_id)
+        if provision is None or provision["state"] != "running":
+            return
+        name = provision["instance"]
+        try:
+            while provision["step"] is not None:
+                step = provision["step"]
+                if not getattr(self, "_step_" + step)(provision):
+                    self._save_provision(provision)
+                    self._retry_later(config, provision_id)
+                    return
+                next_step = PROVISION_STEPS.index(step) + 1
+                provision["step"] = PROVISION_STEPS[next_step] if next_step < len(PROVISION_STEPS) else None
+                self._save_provision(provision)
+            provision["state"] = "done"
+            self._save_provision(provision)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            logging.error("Error provisioning host for {} at {}: {}".format(name, provision["step"], e))
+            provision["state"] = "failed"
+            provision["error"] = repr(e)
+            self._save_provision(provision)
+            if self._rollback_enabled():
+                self._rollback_provision(provision)
+            self._finish_provisions(provision)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._finish_provisions(provision)
+
+    def _retry_later(self, config, provision_id):
+        countdown = float(self._get_conf("RPAAS_PROVISION_POLL_INTERVAL", 5))
+        self.apply_async(args=(config, provision_id), countdown=countdown)
+
+    def _save_provision(self, provision):
+        spec = dict((k, v) for k, v in provision.items() if k != "_id")
+        spec["updated"] = datetime.datetime.utcnow()
+        self.storage.update_provision(provision["_id"], spec)
+
+    def _finish_provisions(self, provision):
+        name = provision["instance"]
+        operation = {"instance": name, "operation": provision.get("operation")}
+        running = self.storage.find_provisions(dict(operation, state="running"))
+        if running.count() > 0:
+            return
+        for failed in self.storage.find_provisions(dict(operation, state="failed")):
+            logging.error("Host provisioning for {} failed: {}".format(name, failed.get("error")))
+        self.storage.remove_provisions(operation)
+        self.storage.remove_task({"_id": name, "operation": operation["operation"]})
+
+    def _provision_lock(self, provision):
+        lock_name = "provision:{}".format(provision["instance"])
+        timeout = int(self._get_conf("RPAAS_PROVISION_LOCK_TIMEOUT", 300))
+        return self.lock_manager.lock(lock_name, timeout=timeout), lock_name
+
+    def _find_lb(self, provision):
+        lb = LoadBalancer.find(provision["instance"], self.config)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        return lb
+
+    def _find_host(self, provision):
+        if not provision.get("host_id"):
+            return None
+        return Host.find(provision["host_id"], conf=self.config)
+
+    def _step_create_lb(self, provision):
+        if LoadBalancer.find(provision["instance"], self.config) is None:
+            LoadBalancer.create(self.lb_manager_name, provision["instance"], self.config)
+            provision["created_lb"] = True
+            self.hc.create(provision["instance"])
+        return True
+
+    def _step_create_host(self, provision):
+        if provision.get("host_id"):
+            return True
+        lb = self._find_lb(provision)
+        if "alternative_id" not in provision and not self._reserve_provision_alternative(provision):
+            return False
+        host = self._create_host(provision["instance"], self._host_config(lb), provision["alternative_id"])
+        provision["host_id"] = host.id
+        provision["dns_name"] = host.dns_name
+        return True
+
+    def _reserve_provision_alternative(self, provision):
+        """
+        Saves on the provision the alternative its host is created in. Only
+        the choice is serialized between workers: it counts the alternatives
+        reserved by the provisions still creating their hosts, so the
+        creations themselves can overlap.
+        """
+        alternatives = int(self._get_conf("HM_ALTERNATIVE_CONFIG_COUNT", 1))
+        if alternatives <= 1:
+            provision["alternative_id"] = None
+            return True
+        name = provision["instance"]
+        locked, lock_name = self._provision_lock(provision)
+        if not locked:
+            return False
+        try:
+            counts = collections.Counter(self.storage.count_hosts_by_alternative(name))
+            creating = self.storage.find_provisions({"instance": name, "state": "running", "host_id": None,
+                                                     "alternative_id": {"$ne": None}})
+            for other in creating:
+                counts[other["alternative_id"]] += 1
+            provision["alternative_id"] = min(xrange(alternatives), key=lambda i: (counts[i], i))
+            self._save_provision(provision)
+        finally:
+            self.lock_manager.unlock(lock_name)
+        return True
+
+    def _step_add_to_lb(self, provision):
+        lb = self._find_lb(provision)
+        if provision["host_id"] not in [h.id for h in lb.hosts]:
+            lb.add_host(self._find_host(provision))
+        return True
+
+    def _step_await_health(self, provision):
+        if "health_deadline" not in provision:
+            healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+            provision["health_deadline"] = time.time() + healthcheck_timeout
+        try:
+            self.nginx_manager.healthcheck(provision["dns_name"])
+        except (NginxError, RequestException):
+            if time.time() >= provision["health_deadline"]:
+                raise
+            return False
+        return True
+
+    def _step_apply_acls(self, provision):
+        name = provision["instance"]
+        locked, lock_name = self._provision_lock(provision)
+        if not locked:
+            return False
+        try:
+            acls = self.consul_manager.find_acl_network(name)
+            if acls:
+                acl_host = acls.pop()
+                for dst in acl_host['destination']:
+                    self.acl_manager.add_acl(name, provision["dns_name"], dst)
+        finally:
+            self.lock_manager.unlock(lock_name)
+        return True
+
+    def _step_register_hc(self, provision):
+        locked, lock_name = self._provision_lock(provision)
+        if not locked:
+            return False
+        try:
+            self.hc.add_url(provision["instance"], provision["dns_name"])
+        finally:
+            self.lock_manager.unlock(lock_name)
+        return True
+
+    def _rollback_provision(self, provision):
+        name = provision["instance"]
+        lb = LoadBalancer.find(name, self.config)
+        created_lb = lb if provision.get("created_lb") else None
+        try:
+            host = self._find_host(provision)
+        except Exception as e:
+            logging.error("Error in rollback trying to find host: {}".format(e))
+            host = None
+        self._rollback_host(name, lb, created_lb, host)
 
 
 class RemoveInstanceTask(BaseManagerTask):
+    holds_instance_task = True
 
     def _should_destroy_lb(self):
         retain_lb = self._get_conf('RPAAS_RETAIN_LOAD_BALANCER', False) in ['True', 'true', 'Yes', 'yes', '1']
         return not retain_lb
 
     def run(self, config, name):
-        self.init_config(config)
-        lb = LoadBalancer.find(name, self.config)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            self._delete_host(name, host, lb)
-        self.consul_manager.destroy_instance(name)
-        if self._should_destroy_lb():
-            lb.destroy()
-        else:
-            logging.info('Skipping load balancer ({}/{}) removal', lb.id, lb.name)
-        for cert in self.storage.find_le_certificates({'name': name}):
-            self.storage.remove_le_certificate(name, cert['domain'])
-        self.hc.destroy(name)
+        try:
+            self.init_config(config)
+            lb = LoadBalancer.find(name, self.config)
+            if lb is None:
+                raise storage.InstanceNotFoundError()
+            self._delete_hosts(name, list(lb.hosts), lb)
+            self.consul_manager.destroy_instance(name)
+            if self._should_destroy_lb():
+                lb.destroy()
+            else:
+                logging.info('Skipping load balancer ({}/{}) removal', lb.id, lb.name)
+            for cert in self.storage.find_le_certificates({'name': name}):
+                self.storage.remove_le_certificate(name, cert['domain'])
+            self.hc.destroy(name)
+        finally:
+            self.storage.remove_task(name)
 
 
 class ScaleInstanceTask(BaseManagerTask):
+    holds_instance_task = True
 
     def run(self, config, name, quantity):
+        release_task = True
         try:
             self.init_config(config)
             lb = LoadBalancer.find(name, self.config)
@@ -245,14 +771,270 @@ class ScaleInstanceTask(BaseManagerTask):
             diff = int(quantity) - len(lb.hosts)
             if diff == 0:
                 return
-            for i in xrange(abs(diff)):
-                if diff > 0:
-                    self._add_host(name, lb=lb)
-                else:
-                    self._delete_host(name, lb.hosts[i], lb)
+            if diff > 0 and self._async_provisioning():
+                self._start_provisions(name, diff)
+                release_task = False
+                return
+            if diff > 0:
+                self._add_hosts(name, lb, diff)
+                return
+            self._delete_hosts(name, lb.hosts[:abs(diff)], lb)
+        finally:
+            if release_task:
+                self.storage.remove_task(name)
+
+
+class ReconcileInstanceTask(BaseManagerTask):
+    """
+    Converges an instance towards the desired state stored by the manager,
+    which only records its unit count. Besides the units it writes back the
+    routes of its bindings missing from Consul and the ACLs missing from
+    some of its hosts. Plan, flavor and upstream servers are not converged
+    and routes are never removed. Every step only touches what has drifted,
+    so the task can run any number of times. Requests arriving while it
+    runs just bump the desired state and queue a single follow up run.
+    """
+    holds_instance_task = True
+
+    def run(self, config, name):
+        self.init_config(config)
+        try:
+            self.storage.store_task(name)
+        except storage.DuplicateError:
+            countdown = float(self._get_conf("RPAAS_RECONCILE_RETRY_INTERVAL", 5))
+            # keeps its task id, which holds the queued flag of the instance
+            self.apply_async(args=(config, name), countdown=countdown, task_id=self.request.id)
+            return
+        try:
+            desired = self.storage.start_reconcile(name)
+            if desired is None:
+                return
+            error = None
+            try:
+                self._reconcile(name, desired)
+            except Exception as e:
+                logging.error("Error reconciling instance {}: {!r}".format(name, e))
+                error = repr(e)
+            self.storage.finish_reconcile(name, desired.get("generation"), error)
         finally:
             self.storage.remove_task(name)
 
+    def _reconcile(self, name, desired):
+        lb = LoadBalancer.find(name, self.config)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        units = desired.get("units")
+        if units is not None:
+            diff = int(units) - len(lb.hosts)
+            if diff > 0:
+                self._add_hosts(name, lb, diff)
+            elif diff < 0:
+                self._delete_hosts(name, lb.hosts[:abs(diff)], lb)
+        self._reconcile_routes(name)
+        self._reconcile_acls(name, lb)
+
+    def _reconcile_routes(self, name):
+        binding_data = self.storage.find_binding(name) or {}
+        existing = self.consul_manager.list_locations(name)
+        for path in binding_data.get("paths", []):
+            if path["path"] in existing:
+                continue
+            # the router mode of a bound root location is not persisted, so
+            # only locations added through add_route can be written back
+            if path["path"] == "/" and "content" not in path:
+                continue
+            self.consul_manager.write_location(name, path["path"], destination=path.get("destination"),
+                                               content=path.get("content"),
+                                               https_only=path.get("https_only", False))
+
+    def _reconcile_acls(self, name, lb):
+        acls = self.consul_manager.find_acl_network(name)
+        destinations = set()
+        for acl_host in acls:
+            destinations |= set(acl_host["destination"])
+        if not destinations:
+            return
+        applied = {acl_host["source"]: set(acl_host["destination"]) for acl_host in acls}
+        for host in lb.hosts:
+            src = str(ipaddress.ip_network(unicode(host.dns_name)))
+            for dst in destinations - applied.get(src, set()):
+                self.acl_manager.add_acl(name, host.dns_name, dst)
+
+
+class ReplenishWarmPoolTask(BaseManagerTask):
+
+    def run(self, config):
+        self.init_config(config)
+        pools = parse_warm_pools(self._get_conf("RPAAS_WARM_POOLS", None))
+        if not pools:
+            return
+        healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        service_name = self._get_conf("RPAAS_SERVICE_NAME", "rpaas")
+        lock_name = self.config.get("WARM_POOL_LOCK_NAME", "warm_pool:{}".format(service_name))
+        # a run may outlast any fixed timeout, so the lock is renewed while it
+        # runs and a later run never sweeps hosts that are still booting
+        leases = lock.Leases(app.backend.client, int(self._get_conf("WARM_POOL_LOCK_LEASE", 60)))
+        if not leases.acquire(lock_name):
+            return
+        try:
+            for key, size in pools.items():
+                if not leases.holds(lock_name):
+                    logging.error("Lost the warm pool lock, stopping the replenish run")
+                    return
+                self._replenish(key, size, healthcheck_timeout)
+        finally:
+            leases.stop()
+
+    def _replenish(self, key, size, healthcheck_timeout):
+        group = warm_pool_group(key)
+        config = self._pool_config(key)
+        # the replenish lock is held, so pool hosts that are not ready and
+        # creations still recorded were left behind by a run that did not finish
+        for entry in self.storage.list_pool_entries(group):
+            logging.error("A host creation for warm pool {} did not finish, a vm tagged "
+                          "rpaas_pool:{} may be left behind".format(key, key))
+            self.storage.remove_pool_entry(entry["_id"])
+        for host in Host.list({"group": group, "pool_state": {"$ne": "ready"}}, conf=config):
+            host.destroy()
+        missing = size - len(Host.list({"group": group}, conf=config))
+        if missing <= 0:
+            return
+        max_parallelism = int(self._get_conf("RPAAS_SCALE_MAX_PARALLELISM", 5))
+
+        def add_pool_host(_):
+            start_time = time.time()
+            # the entry is recorded before the vm is created, so a run that
+            # dies while creating it leaves a trace for the next one
+            entry_id = self.storage.store_pool_entry(group, self.host_manager_name)
+            try:
+                host = self._new_host(group, config)
+                self.storage.update_pool_host(host.id, "booting")
+            finally:
+                self.storage.remove_pool_entry(entry_id)
+            try:
+                self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
+            except:
+                host.destroy()
+                raise
+            self.storage.update_pool_host(host.id, "ready")
+            self.storage.inc_warm_pool_stats(key, replenished=1, replenish_seconds=time.time() - start_time)
+
+        for result in run_concurrently(add_pool_host, xrange(missing), max_parallelism):
+            if isinstance(result, Exception):
+                logging.error("Error replenishing warm pool {}: {}".format(key, result))
+                self.storage.inc_warm_pool_stats(key, replenish_failures=1)
+
+    def _pool_config(self, key):
+        plan_name, _, flavor_name = key.partition("/")
+        config = self.config_resolver.resolve(plan_name, flavor_name)
+        service_name = self._get_conf("RPAAS_SERVICE_NAME", "rpaas")
+        config["HOST_TAGS"] = "rpaas_service:{},rpaas_pool:{}".format(service_name, key)
+        return config
+
+
+class ScanDriftTask(BaseManagerTask):
+    """
+    Looks for state left behind by hosts that no longer exist: per host
+    certificates, node status and ACL keys in Consul, healthcheck urls and
+    restore tasks. Each store is read once in bulk and compared in memory,
+    the drift found is stored per instance and, when
+    DRIFT_SCANNER_DELETE_ORPHANS is enabled, removed in batches. Instances
+    with a running task are skipped, their hosts may still be provisioning.
+    """
+
+    def run(self, config):
+        self.init_config(config)
+        service_name = self._get_conf("RPAAS_SERVICE_NAME", "rpaas")
+        lock_name = self._get_conf("DRIFT_SCANNER_LOCK_NAME", "drift_scanner:{}".format(service_name))
+        timeout = int(self._get_conf("DRIFT_SCANNER_LOCK_TIMEOUT", 600))
+        if not self.lock_manager.lock(lock_name, timeout=timeout):
+            return
+        try:
+            reports, orphan_keys = self.scan()
+            delete = check_option_enable(self._get_conf("DRIFT_SCANNER_DELETE_ORPHANS", None))
+            if delete:
+                self._delete_orphans(reports, orphan_keys)
+            scanned_at = datetime.datetime.utcnow()
+            drift = []
+            for instance_name, report in sorted(reports.items()):
+                report.update({"_id": instance_name, "deleted": delete, "scanned_at": scanned_at})
+                drift.append(report)
+            self.storage.replace_drift_reports(drift)
+            return drift
+        finally:
+            self.lock_manager.unlock(lock_name)
+
+    def scan(self):
+        # tasks are read before hosts: a host created after the read belongs
+        # to an instance whose task gate is already seen as busy
+        instance_tasks = list(self.storage.find_task({}))
+        busy = set(task["_id"] for task in instance_tasks)
+        instance_hosts = collections.defaultdict(dict)
+        for host in self.storage.list_host_addresses():
+            instance_hosts[host.get("group")][host.get("dns_name")] = str(host["_id"])
+        known_hosts = set()
+        for hosts in instance_hosts.values():
+            known_hosts.update(hosts)
+        node_addresses = dict((node, address) for address, node in
+                              self.consul_manager.node_hostnames().items())
+        reports = {}
+        orphan_keys = collections.defaultdict(list)
+
+        def report(instance_name):
+            return reports.setdefault(instance_name, {"ssl": [], "status": [], "acl": [],
+                                                      "hc_urls": [], "restore_tasks": []})
+
+        for key in self.consul_manager.list_keys():
+            parts = key.split("/")
+            if len(parts) < 4 or parts[1] in busy:
+                continue
+            instance_name, kind, item = parts[1:4]
+            hosts = instance_hosts.get(instance_name, {})
+            if kind == "ssl" and len(parts) == 5 and item not in hosts.values():
+                if item not in report(instance_name)["ssl"]:
+                    report(instance_name)["ssl"].append(item)
+                orphan_keys[instance_name].append(key)
+            # an empty catalog most likely means the lookup failed, so node
+            # status is only checked against a populated one
+            elif kind == "status" and node_addresses and node_addresses.get(item) not in hosts:
+                report(instance_name)["status"].append(item)
+                orphan_keys[instance_name].append(key)
+            elif kind == "acl" and item.endswith("_32") and item[:-3] not in hosts:
+                report(instance_name)["acl"].append(item[:-3])
+        hc_format = self._get_conf("HCAPI_FORMAT", "http://{}:8080/")
+        for hc_doc in self.storage.list_hcs():
+            if hc_doc["_id"] in busy:
+                continue
+            expected = set(hc_format.format(dns_name) for dns_name in instance_hosts.get(hc_doc["_id"], {}))
+            for url in hc_doc.get("urls", []):
+                if url not in expected:
+                    report(hc_doc["_id"])["hc_urls"].append(url)
+        for task in instance_tasks:
+            if task["_id"].startswith("restore_") and task.get("host") not in known_hosts:
+                report(task.get("instance"))["restore_tasks"].append(task["_id"])
+        return reports, orphan_keys
+
+    def _delete_orphans(self, reports, orphan_keys):
+        batch_size = int(self._get_conf("DRIFT_SCANNER_BATCH_SIZE", 500))
+        keys = [key for instance_name in sorted(orphan_keys) for key in orphan_keys[instance_name]]
+        for i in xrange(0, len(keys), batch_size):
+            self.consul_manager.delete_keys(keys[i:i + batch_size])
+        restore_tasks = [task_id for report in reports.values() for task_id in report["restore_tasks"]]
+        for i in xrange(0, len(restore_tasks), batch_size):
+            self.storage.bulk_update_tasks(remove=restore_tasks[i:i + batch_size])
+        for instance_name, report in reports.items():
+            for address in report["acl"]:
+                try:
+                    self.acl_manager.remove_acl(instance_name, address)
+                except Exception as e:
+                    logging.error("Error removing orphan acl {} of {}: {}".format(address, instance_name, e))
+            for url in report["hc_urls"]:
+                try:
+                    self.hc.remove_url(instance_name, urlparse(url).hostname or url)
+                except Exception as e:
+                    logging.error("Error removing orphan healthcheck url {} of {}: {}".format(
+                        url, instance_name, e))
+
 
 class RestoreMachineTask(BaseManagerTask):
 
@@ -262,12 +1044,20 @@ class RestoreMachineTask(BaseManagerTask):
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         restore_delay = int(self.config.get("RESTORE_MACHINE_DELAY", 5))
         created_in = datetime.datetime.utcnow() - datetime.timedelta(minutes=restore_delay)
-        restore_query = {"_id": {"$regex": "restore_.+"}, "created": {"$lte": created_in}}
+        restore_query = {"_id": {"$regex": "^restore_."}, "created": {"$lte": created_in}}
+        max_parallelism = int(self.config.get("RESTORE_MACHINE_MAX_PARALLELISM", 1))
+        if max_parallelism > 1:
+            return self._restore_concurrently(config, lock_name, restore_query, healthcheck_timeout,
+                                              max_parallelism)
         if self.lock_manager.lock(lock_name, timeout=(healthcheck_timeout + 60)):
-            for task in self.storage.find_task(restore_query):
+            restore_tasks = list(self.storage.find_task(restore_query))
+            hosts = self.storage.find_hosts_by_dns_name(set(task['host'] for task in restore_tasks))
+            failure_instances = self._failure_instances()
+            for task in restore_tasks:
                 try:
                     start_time = datetime.datetime.utcnow()
-                    self._restore_machine(task, config, healthcheck_timeout)
+                    if task['instance'] not in failure_instances:
+                        self._restore_machine(task, hosts.get(task['host']), config, healthcheck_timeout)
                     elapsed_time = datetime.datetime.utcnow() - start_time
                     self.lock_manager.extend_lock(lock_name, extra_time=elapsed_time.seconds)
                 except Exception as e:
@@ -276,27 +1066,97 @@ class RestoreMachineTask(BaseManagerTask):
                     raise e
             self.lock_manager.unlock(lock_name)
 
-    def _restore_machine(self, task, config, healthcheck_timeout):
-        retry_failure_delay = int(self.config.get("RESTORE_MACHINE_FAILURE_DELAY", 5))
-        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
-        retry_failure_query = {"_id": {"$regex": "restore_.+"}, "last_attempt": {"$ne": None}}
-        if task['instance'] not in self._failure_instances(retry_failure_query, retry_failure_delay):
-            host = self.storage.find_host_id(task['host'])
-            if not restore_dry_mode:
-                healing_id = self.storage.store_healing(task['instance'], task['host'])
+    def _restore_concurrently(self, config, lock_name, restore_query, healthcheck_timeout, max_parallelism):
+        """
+        Restores up to max_parallelism machines at once. Each restore holds
+        one of the RESTORE_MACHINE_MAX_UNAVAILABLE share of slots of its
+        instance, so no instance loses more hosts than that at a time. The
+        run and slot locks are leases renewed while the restores run.
+        """
+        lease = int(self.config.get("RESTORE_LOCK_LEASE", 60))
+        max_unavailable = float(self.config.get("RESTORE_MACHINE_MAX_UNAVAILABLE", 0.5))
+        leases = lock.Leases(app.backend.client, lease)
+        if not leases.acquire(lock_name):
+            return
+        try:
+            restore_tasks = list(self.storage.find_task(restore_query))
+            hosts = self.storage.find_hosts_by_dns_name(set(task['host'] for task in restore_tasks))
+            host_counts = self.storage.count_hosts_by_group(set(task['instance'] for task in restore_tasks))
+            failure_instances = self._failure_instances()
+            failures_lock = threading.Lock()
+
+            def restore(task):
+                instance = task['instance']
+                slots = max(1, int(max_unavailable * host_counts.get(instance, 0)))
+                slot_names = ["{}:{}:{}".format(lock_name, instance, i) for i in xrange(slots)]
+                queued_at = time.time()
+                slot = leases.acquire_any(slot_names)
+                while slot is None and instance not in failure_instances:
+                    time.sleep(1)
+                    slot = leases.acquire_any(slot_names)
+                if slot is None:
+                    return
                 try:
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).restore()
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).start()
-                    self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
-                    self.storage.update_healing(healing_id, "success")
-                except Exception as e:
-                    self.storage.update_healing(healing_id, str(e.message))
-                    raise e
-            self.storage.remove_task({"_id": task['_id']})
+                    if instance in failure_instances:
+                        return
+                    self._restore_machine(task, hosts.get(task['host']), config, healthcheck_timeout,
+                                          queued_seconds=time.time() - queued_at)
+                except Exception:
+                    with failures_lock:
+                        failure_instances.add(instance)
+                    self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
+                    raise
+                finally:
+                    leases.release(slot)
 
-    def _failure_instances(self, retry_failure_query, retry_failure_delay):
+            results = run_concurrently(restore, self._interleave_instances(restore_tasks), max_parallelism)
+        finally:
+            leases.stop()
+        failures = ["{}: {!r}".format(task['host'], result)
+                    for task, result in zip(self._interleave_instances(restore_tasks), results)
+                    if isinstance(result, Exception)]
+        if failures:
+            raise RestoreMachineError("failed to restore {} of {} machines: {}".format(
+                len(failures), len(restore_tasks), "; ".join(failures)))
+
+    def _interleave_instances(self, restore_tasks):
+        # alternate between instances so workers are not all waiting on the
+        # slots of the same instance
+        by_instance = collections.OrderedDict()
+        for task in restore_tasks:
+            by_instance.setdefault(task['instance'], []).append(task)
+        queues = by_instance.values()
+        interleaved = []
+        while queues:
+            interleaved.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+        return interleaved
+
+    def _restore_machine(self, task, host, config, healthcheck_timeout, **timing):
+        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
+        if not restore_dry_mode:
+            healing_id = self.storage.store_healing(task['instance'], task['host'])
+            start = time.time()
+            try:
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).restore()
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).start()
+                timing["restore_seconds"] = time.time() - start
+                self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
+                timing["total_seconds"] = time.time() - start
+                self.storage.update_healing(healing_id, "success", **timing)
+            except Exception as e:
+                timing["total_seconds"] = time.time() - start
+                self.storage.update_healing(healing_id, str(e.message), **timing)
+                raise e
+        self.storage.remove_task({"_id": task['_id']})
+
+    def _failure_instances(self):
+        # a failed restore aborts the run, so the failures read at its start
+        # stay valid for every task of the run
+        retry_failure_delay = int(self.config.get("RESTORE_MACHINE_FAILURE_DELAY", 5))
+        retry_failure_query = {"_id": {"$regex": "^restore_."}, "last_attempt": {"$ne": None}}
         failure_instances = set()
         for task in self.storage.find_task(retry_failure_query):
             retry_failure = task['last_attempt'] + datetime.timedelta(minutes=retry_failure_delay)
@@ -307,12 +1167,17 @@ class RestoreMachineTask(BaseManagerTask):
 
 class CheckMachineTask(BaseManagerTask):
 
-    def run(self, config):
+    def run(self, config, nodes=None):
         self.init_config(config)
-        for node in self.consul_manager.service_healthcheck():
+        if nodes is None:
+            nodes = self.consul_manager.service_healthcheck()
+        hosts = self.storage.find_hosts_by_dns_name(set(node['Node']['Address'] for node in nodes))
+        store_tasks = []
+        remove_tasks = []
+        for node in nodes:
             node_fail = False
             address = node['Node']['Address']
-            if not self._check_machine_exists(address):
+            if address not in hosts:
                 logging.error("check_machine: machine {} not found".format(address))
                 continue
             service_instance = self.config['RPAAS_SERVICE_NAME']
@@ -326,27 +1191,16 @@ class CheckMachineTask(BaseManagerTask):
                     break
             task_name = "restore_{}".format(address)
             if node_fail:
-                try:
-                    self.task_manager.ensure_ready(task_name)
-                    self.task_manager.create({"_id": task_name, "host": address,
-                                              "instance": service_instance,
-                                              "created": datetime.datetime.utcnow()})
-                except:
-                    pass
+                store_tasks.append({"_id": task_name, "host": address,
+                                    "instance": service_instance,
+                                    "created": datetime.datetime.utcnow()})
             else:
-                try:
-                    self.task_manager.remove(task_name)
-                except:
-                    pass
-
-    def _check_machine_exists(self, address):
-        machine_data = self.storage.find_host_id(address)
-        if machine_data is None:
-            return False
-        return True
+                remove_tasks.append(task_name)
+        self.storage.bulk_update_tasks(store=store_tasks, remove=remove_tasks)
 
 
 class DownloadCertTask(BaseManagerTask):
+    holds_instance_task = True
 
     def run(self, config, name, plugin, csr, key, domain):
         try:
@@ -357,6 +1211,7 @@ class DownloadCertTask(BaseManagerTask):
 
 
 class RevokeCertTask(BaseManagerTask):
+    holds_instance_task = True
 
     def run(self, config, name, plugin, domain):
         try:
@@ -384,13 +1239,11 @@ class RenewCertsTask(BaseManagerTask):
         expires_in = int(self.config.get("LE_CERTIFICATE_EXPIRATION_DAYS", 90))
         limit = datetime.datetime.utcnow() - datetime.timedelta(days=expires_in - 3)
         query = {"created": {"$lte": limit}}
-        for cert in self.storage.find_le_certificates(query):
-            metadata = self.storage.find_instance_metadata(cert["name"])
-            config = copy.deepcopy(self.config)
-            if metadata and "plan_name" in metadata:
-                plan = self.storage.find_plan(metadata["plan_name"])
-                config.update(plan.config)
-            self.renew(cert, config)
+        certs = list(self.storage.find_le_certificates(query))
+        metadata = self.storage.find_instances_metadata(set(cert["name"] for cert in certs))
+        for cert in certs:
+            plan_name = metadata.get(cert["name"], {}).get("plan_name")
+            self.renew(cert, self.config_resolver.resolve(plan_name))
 
     def renew(self, cert, config):
         key = sslutils.generate_key(True)
@@ -0,0 +1,28 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import time
+from rpaas import scheduler, tasks
+
+
+class WarmPool(scheduler.JobScheduler):
+    """
+    WarmPool is a thread to keep the pools of unassigned hosts configured in
+    RPAAS_WARM_POOLS filled.
+
+    """
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(WarmPool, self).__init__(config, *args, **kwargs)
+        self.config = config or dict(os.environ)
+        self.interval = int(self.config.get("WARM_POOL_RUN_INTERVAL", 60))
+        self.last_run_key = self.get_last_run_key("WARM_POOL")
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if self.try_lock():
+                tasks.ReplenishWarmPoolTask().delay(self.config)
+            time.sleep(self.interval / 2)
@@ -4,7 +4,7 @@
 
 from collections import defaultdict
 
-from rpaas import storage, manager, consul_manager
+from rpaas import storage, manager, consul_manager, config_resolver, catalog
 
 
 class FakeInstance(object):
@@ -30,6 +30,8 @@ class FakeManager(object):
     def __init__(self, storage=None):
         self.instances = []
         self.storage = storage
+        self.config_resolver = config_resolver.ConfigResolver(storage)
+        self.catalog = catalog.Catalog(storage)
 
     def new_instance(self, name, state="running", team=None, plan_name=None, flavor_name=None):
         if plan_name:
@@ -164,6 +166,13 @@ class FakeManager(object):
             return 3
         return 4
 
+    def purge_locations(self, name, purges):
+        purged = []
+        for path, preserve_path in purges:
+            if (path, preserve_path) not in purged:
+                purged.append((path, preserve_path))
+        return iter([(path, self.purge_location(name, path, preserve_path)) for path, preserve_path in purged])
+
     def reset(self):
         self.instances = []
 
@@ -174,12 +183,14 @@ class FakeManager(object):
         if machine != 'foo':
             raise manager.InstanceMachineNotFoundError()
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
         if name in "invalid":
             yield "instance {} not found".format(name)
             return
         for machine in ["a", "b"]:
             yield "host {} restored".format(machine)
+        if max_unavailable:
+            yield " in batches of {}".format(max_unavailable)
         if name in "error":
             yield "host c failed to restore"
 
@@ -7,6 +7,8 @@ import json
 import unittest
 import os
 
+import mock
+
 from bson import json_util
 from rpaas import api, storage, admin_api
 from . import managers
@@ -52,6 +54,53 @@ class AdminAPITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertListEqual(healing_list[:20], json.loads(resp.data))
 
+    def test_list_warm_pools(self):
+        os.environ["RPAAS_WARM_POOLS"] = "small=2,small/vanilla=1"
+        self.addCleanup(os.environ.pop, "RPAAS_WARM_POOLS")
+        hosts = self.storage.db[self.storage.hosts_collection]
+        hosts.insert({"_id": "h1", "group": "rpaas-pool-small-", "pool_state": "ready"})
+        hosts.insert({"_id": "h2", "group": "rpaas-pool-small-", "pool_state": "booting"})
+        hosts.insert({"_id": "h3", "group": "x"})
+        self.storage.inc_warm_pool_stats("small/", hits=3, misses=1, replenished=2, replenish_seconds=90.0)
+        resp = self.api.get("/admin/warm-pools")
+        self.assertEqual(200, resp.status_code)
+        self.assertListEqual([
+            {"pool": "small/", "size": 2, "ready": 1, "booting": 1, "hits": 3, "misses": 1,
+             "replenished": 2, "replenish_seconds": 90.0, "avg_replenish_seconds": 45.0},
+            {"pool": "small/vanilla", "size": 1, "ready": 0, "booting": 0, "hits": 0, "misses": 0,
+             "replenished": 0, "replenish_seconds": 0},
+        ], json.loads(resp.data))
+
+    def test_consul_cache_stats(self):
+        consul_mngr = mock.Mock(kv_cache=None)
+        self.manager.consul_manager = consul_mngr
+        self.addCleanup(delattr, self.manager, "consul_manager")
+        resp = self.api.get("/admin/consul-cache")
+        self.assertEqual(404, resp.status_code)
+        consul_mngr.kv_cache = mock.Mock()
+        consul_mngr.kv_cache.stats.return_value = {"hits": 3, "misses": 1}
+        resp = self.api.get("/admin/consul-cache")
+        self.assertEqual(200, resp.status_code)
+        self.assertDictEqual({"hits": 3, "misses": 1}, json.loads(resp.data))
+
+    @mock.patch("rpaas.nginx.admin_clients_stats")
+    def test_nginx_admin_clients_stats(self, admin_clients_stats):
+        admin_clients_stats.return_value = [{"hosts": 2, "requests": 10, "connections": 3}]
+        resp = self.api.get("/admin/nginx-admin-clients")
+        self.assertEqual(200, resp.status_code)
+        self.assertListEqual([{"hosts": 2, "requests": 10, "connections": 3}], json.loads(resp.data))
+
+    def test_drift(self):
+        resp = self.api.get("/admin/drift")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([], json.loads(resp.data))
+        self.storage.replace_drift_reports([{"_id": "foo", "ssl": ["h9"], "status": [], "acl": [],
+                                             "hc_urls": [], "restore_tasks": [], "deleted": False}])
+        resp = self.api.get("/admin/drift")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([{"_id": "foo", "ssl": ["h9"], "status": [], "acl": [],
+                           "hc_urls": [], "restore_tasks": [], "deleted": False}], json.loads(resp.data))
+
     def test_list_plans(self):
         resp = self.api.get("/admin/plans")
         self.assertEqual(200, resp.status_code)
@@ -379,6 +428,11 @@ class AdminAPITestCase(unittest.TestCase):
         response = ["host a restored", "host b restored"]
         self.assertEqual("".join(response), resp.data)
 
+    def test_restore_instance_with_max_unavailable(self):
+        resp = self.api.post("/admin/restore", data={"instance_name": "blah", "max_unavailable": "25%"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("host a restoredhost b restored in batches of 25%", resp.data)
+
     def test_restore_invalid_instance_name(self):
         resp = self.api.post("/admin/restore", data={"instance_name": "invalid"})
         self.assertEqual(200, resp.status_code)
@@ -56,6 +56,23 @@ class APITestCase(unittest.TestCase):
         ]
         self.assertEqual(expected, json.loads(resp.data))
 
+    def test_plans_etag(self):
+        self.storage.db[self.storage.plans_collection].insert(
+            {"_id": "small",
+             "description": "some cool plan",
+             "config": {"serviceofferingid": "abcdef123456"}}
+        )
+        resp = self.api.get("/resources/plans")
+        self.assertEqual(200, resp.status_code)
+        etag = resp.headers["ETag"]
+        resp = self.api.get("/resources/plans", headers={"If-None-Match": etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual("", resp.data)
+        self.storage.update_plan("small", description="some cooler plan")
+        resp = self.api.get("/resources/plans", headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(etag, resp.headers["ETag"])
+
     def test_flavors(self):
         resp = self.api.get("/resources/flavors")
         self.assertEqual(200, resp.status_code)
@@ -713,6 +730,51 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(400, resp.status_code)
         self.assertEqual('missing required list of purges', resp.data)
 
+    def test_purge_bulk_location_duplicated_paths(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([
+            {'path': '/somewhere', 'preserve_path': True},
+            {'path': '/otherpath'},
+            {'path': '/somewhere', 'preserve_path': True},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([
+            {"path": "/somewhere", "instances_purged": 3},
+            {"path": "/otherpath", "instances_purged": 4}
+        ], json.loads(resp.data))
+
+    def test_purge_bulk_location_parses_preserve_path(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([
+            {'path': ' /somewhere ', 'preserve_path': 'false'},
+            {'path': '/otherpath', 'preserve_path': '0'},
+            {'path': '/thirdpath', 'preserve_path': 'true'},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([
+            {"path": " /somewhere ", "instances_purged": 4},
+            {"path": "/otherpath", "instances_purged": 4},
+            {"path": "/thirdpath", "instances_purged": 3}
+        ], json.loads(resp.data))
+
+    def test_purge_bulk_location_stream(self):
+        resp = self.api.post("/resources/someapp/purge/bulk?stream=true", data=json.dumps([
+            {'path': '/somewhere', 'preserve_path': True},
+            {'path': '/otherpath', 'preserve_path': False},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/x-ndjson', resp.mimetype)
+        self.assertEqual([
+            {"path": "/somewhere", "instances_purged": 3},
+            {"path": "/otherpath", "instances_purged": 4}
+        ], [json.loads(line) for line in resp.data.splitlines()])
+
+    def test_purge_bulk_location_missing_path(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([
+            {'path': '/somewhere'},
+            {'preserve_path': True},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual('missing required path', resp.data)
+
     def open_with_auth(self, url, method, user, password, data=None, headers=None):
         encoded = base64.b64encode(user + ":" + password)
         if not headers:
@@ -0,0 +1,102 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import time
+import unittest
+
+import mock
+import redis
+
+from rpaas import plan, storage
+from rpaas.catalog import Catalog
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.storage.list_plans.return_value = [
+            plan.Plan(name="small", description="small plan", config={"serviceofferingid": "abc"}),
+            plan.Plan(name="huge", description="huge plan", config={"serviceofferingid": "def"}),
+        ]
+        self.storage.list_flavors.return_value = []
+        self.config = {"RPAAS_CATALOG_CACHE": "1", "RPAAS_SERVICE_NAME": "test-catalog"}
+
+    def test_disabled(self):
+        catalog = Catalog(self.storage)
+        catalog.plans()
+        catalog.plans()
+        self.assertEqual(2, self.storage.list_plans.call_count)
+
+    def test_disabled_find_queries_storage(self):
+        catalog = Catalog(self.storage)
+        self.assertIs(self.storage.find_plan.return_value, catalog.find_plan("small"))
+        self.assertIs(self.storage.find_flavor.return_value, catalog.find_flavor("vanilla"))
+        self.storage.find_plan.assert_called_once_with("small")
+        self.storage.find_flavor.assert_called_once_with("vanilla")
+        self.storage.list_plans.assert_not_called()
+        self.storage.list_flavors.assert_not_called()
+
+    def test_plans_json(self):
+        catalog = Catalog(self.storage, self.config)
+        body, etag = catalog.plans_json()
+        self.assertEqual([{"name": "small", "description": "small plan", "config": {"serviceofferingid": "abc"}},
+                          {"name": "huge", "description": "huge plan", "config": {"serviceofferingid": "def"}}],
+                         json.loads(body))
+        self.assertEqual((body, etag), catalog.plans_json())
+        self.assertEqual(('[]', '97d170e1550eee4afc0af065b78cda302a97674c'), catalog.flavors_json())
+        self.assertEqual(1, self.storage.list_plans.call_count)
+
+    def test_find_plan(self):
+        catalog = Catalog(self.storage, self.config)
+        small = catalog.find_plan("small")
+        self.assertEqual("small plan", small.description)
+        small.config["serviceofferingid"] = "changed"
+        self.assertEqual({"serviceofferingid": "abc"}, catalog.find_plan("small").config)
+        with self.assertRaises(storage.PlanNotFoundError):
+            catalog.find_plan("medium")
+        with self.assertRaises(storage.FlavorNotFoundError):
+            catalog.find_flavor("vanilla")
+        self.assertEqual(1, self.storage.list_plans.call_count)
+
+    @mock.patch("rpaas.misc.time")
+    def test_expiration(self, time):
+        time.time.return_value = 100
+        catalog = Catalog(self.storage, dict(self.config, RPAAS_CATALOG_CACHE_TTL="10"))
+        catalog.plans()
+        time.time.return_value = 109
+        catalog.plans()
+        self.assertEqual(1, self.storage.list_plans.call_count)
+        time.time.return_value = 111
+        catalog.plans()
+        self.assertEqual(2, self.storage.list_plans.call_count)
+
+    def test_invalidate_publishes(self):
+        conn = mock.Mock()
+        catalog = Catalog(self.storage, self.config, conn)
+        catalog.listener = mock.Mock()
+        catalog.plans()
+        catalog.invalidate()
+        catalog.plans()
+        self.assertEqual(2, self.storage.list_plans.call_count)
+        conn.publish.assert_called_once_with("catalog:test-catalog", "invalidate")
+
+    def test_invalidated_by_other_process(self):
+        conn = redis.StrictRedis()
+        catalog = Catalog(self.storage, self.config, conn)
+        catalog.plans()
+        timeout = time.time() + 5
+        while conn.pubsub_numsub("catalog:test-catalog")[0][1] == 0 and time.time() < timeout:
+            time.sleep(0.1)
+        time.sleep(0.2)
+        catalog.plans()
+        self.assertIn("plans", catalog.snapshots.entries)
+        other = Catalog(self.storage, self.config, conn)
+        other.listener = mock.Mock()
+        timeout = time.time() + 5
+        while catalog.snapshots.entries and time.time() < timeout:
+            other.invalidate()
+            time.sleep(0.1)
+        self.assertEqual({}, catalog.snapshots.entries)
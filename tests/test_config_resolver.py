@@ -0,0 +1,66 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from rpaas import storage
+from rpaas.config_resolver import ConfigResolver
+
+
+class ConfigResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.storage.find_plan_config.return_value = (1, {"serviceofferingid": "abc", "NGINX_PORT": "8080"})
+        self.storage.find_flavor_config.return_value = (1, {"nginx_version": "1.10"})
+        self.config = {"NGINX_PORT": "80", "RPAAS_SERVICE_NAME": "rpaas"}
+
+    def test_resolve(self):
+        resolver = ConfigResolver(self.storage, self.config)
+        self.assertEqual(self.config, resolver.resolve())
+        config = resolver.resolve("small", "vanilla")
+        self.assertEqual({"NGINX_PORT": "8080", "RPAAS_SERVICE_NAME": "rpaas",
+                          "serviceofferingid": "abc", "nginx_version": "1.10"}, config)
+        self.storage.find_plan_config.assert_called_once_with("small")
+        self.storage.find_flavor_config.assert_called_once_with("vanilla")
+        self.assertEqual({"NGINX_PORT": "80", "RPAAS_SERVICE_NAME": "rpaas"}, self.config)
+
+    def test_resolve_returns_copies(self):
+        resolver = ConfigResolver(self.storage, self.config)
+        config = resolver.resolve("small")
+        config["HOST_TAGS"] = "rpaas_instance:x"
+        self.config["NGINX_PORT"] = "81"
+        self.assertNotIn("HOST_TAGS", resolver.resolve("small"))
+        self.assertEqual("80", resolver.resolve()["NGINX_PORT"])
+
+    @mock.patch("rpaas.misc.time")
+    def test_resolve_caches_documents(self, time):
+        time.time.return_value = 100
+        resolver = ConfigResolver(self.storage, dict(self.config, RPAAS_CONFIG_CACHE_TTL="10"))
+        resolver.resolve("small", "vanilla")
+        resolver.resolve("small", "vanilla")
+        resolver.resolve("small")
+        self.assertEqual(1, self.storage.find_plan_config.call_count)
+        self.assertEqual(1, self.storage.find_flavor_config.call_count)
+        time.time.return_value = 111
+        self.storage.find_plan_config.return_value = (2, {"serviceofferingid": "def"})
+        self.assertEqual("def", resolver.resolve("small", "vanilla")["serviceofferingid"])
+        self.assertEqual(2, self.storage.find_plan_config.call_count)
+
+    def test_invalidate(self):
+        resolver = ConfigResolver(self.storage, self.config)
+        resolver.resolve("small", "vanilla")
+        self.storage.find_plan_config.return_value = (2, {"serviceofferingid": "def"})
+        resolver.invalidate(plan_name="small")
+        self.assertEqual("def", resolver.resolve("small", "vanilla")["serviceofferingid"])
+        self.assertEqual(2, self.storage.find_plan_config.call_count)
+        self.assertEqual(1, self.storage.find_flavor_config.call_count)
+
+    def test_resolve_not_found(self):
+        self.storage.find_plan_config.side_effect = storage.PlanNotFoundError()
+        resolver = ConfigResolver(self.storage, self.config)
+        with self.assertRaises(storage.PlanNotFoundError):
+            resolver.resolve("huge")
@@ -4,7 +4,10 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import base64
+import json
 import os
+import time
 import unittest
 import mock
 
@@ -92,6 +95,31 @@ class ConsulManagerTestCase(unittest.TestCase):
         node_hostname = self.manager.node_hostname(host)
         self.assertEqual(None, node_hostname)
 
+    def test_node_hostnames(self):
+        node_hostnames = self.manager.node_hostnames()
+        self.assertEqual('rpaas-test', node_hostnames['127.0.0.1'])
+        self.assertNotIn('10.0.0.1', node_hostnames)
+
+    def test_node_hostnames_bulk(self):
+        node_hostnames = self.manager.node_hostnames(['127.0.0.1', '10.0.0.1'])
+        self.assertDictEqual({'127.0.0.1': 'rpaas-test'}, node_hostnames)
+
+    def test_node_hostnames_single_catalog_fetch(self):
+        catalog = consul_manager.CatalogIndex(self.consul)
+        with mock.patch.object(catalog, "_watch"):
+            with mock.patch.object(self.consul.catalog, "nodes", wraps=self.consul.catalog.nodes) as nodes:
+                for _ in range(10):
+                    self.assertEqual({'127.0.0.1': 'rpaas-test'}, catalog.lookup(['127.0.0.1']))
+        nodes.assert_called_once_with()
+
+    def test_node_hostnames_refetch_stale_catalog(self):
+        catalog = consul_manager.CatalogIndex(self.consul, max_stale=0)
+        with mock.patch.object(catalog, "_watch"):
+            with mock.patch.object(self.consul.catalog, "nodes", wraps=self.consul.catalog.nodes) as nodes:
+                catalog.lookup()
+                catalog.lookup()
+        self.assertEqual(2, nodes.call_count)
+
     def test_node_status(self):
         self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-1", "service OK")
         self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-2", "service DEAD")
@@ -362,18 +390,14 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1"]), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\nserver1\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("server1", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_add_existing_server_to_upstream(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1"]), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\nserver1\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("server1", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_add_bulk_to_existing_upstream(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
@@ -395,18 +419,14 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.manager.remove_server_upstream("myrpaas", "upstream1", "server2")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1", "server3"]), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\nserver1,server3\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("server1,server3", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_remove_delete_empty_upstream_after_last_server_removed(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         self.manager.remove_server_upstream("myrpaas", "upstream1", "server1")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_remove_delete_empty_upstream_and_create_new_one_same_item(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
@@ -414,18 +434,14 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(['server1']), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\nserver1\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("server1", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_remove_server_not_found_on_upstream(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         self.manager.remove_server_upstream("myrpaas", "upstream1", "server2")
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1"]), servers)
-        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
-        block = '## Begin custom RpaaS upstream block ##\nserver1\n## End custom RpaaS upstream block ##'
-        self.assertEqual(item[1]['Value'], block)
+        self.assertEqual("server1", self.manager.render_upstream("myrpaas", "upstream1"))
 
     def test_upstream_remove_bulk_to_existing_upstream(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", ["server1", "server2", "server3"])
@@ -441,6 +457,67 @@ class ConsulManagerTestCase(unittest.TestCase):
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1:123"]), servers)
 
+    def test_upstream_servers_stored_as_individual_keys(self):
+        self.manager.add_server_upstream("myrpaas", "upstream1", ["http://server1:123", "server2"])
+        _, keys = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream_servers/upstream1/", recurse=True)
+        self.assertEqual(["test-suite-rpaas/myrpaas/upstream_servers/upstream1/server1:123",
+                          "test-suite-rpaas/myrpaas/upstream_servers/upstream1/server2"],
+                         sorted(k["Key"] for k in keys))
+        self.manager.remove_server_upstream("myrpaas", "upstream1", "server2")
+        _, keys = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream_servers/upstream1/", recurse=True)
+        self.assertEqual(["test-suite-rpaas/myrpaas/upstream_servers/upstream1/server1:123"],
+                         [k["Key"] for k in keys])
+
+    def test_upstream_add_server_with_weight_and_metadata(self):
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server2", weight=3, metadata={"unit": "u2"})
+        self.assertEqual("server1,server2 weight=3", self.manager.render_upstream("myrpaas", "upstream1"))
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream_servers/upstream1/server2")
+        self.assertEqual({"weight": 3, "metadata": {"unit": "u2"}}, json.loads(item[1]["Value"]))
+        self.assertEqual(set(["server1", "server2"]), self.manager.list_upstream("myrpaas", "upstream1"))
+
+    def test_upstream_migrates_legacy_value(self):
+        block = '## Begin custom RpaaS upstream block ##\nserver1,server2\n## End custom RpaaS upstream block ##'
+        self.consul.kv.put("test-suite-rpaas/myrpaas/upstream/upstream1", block)
+        self.assertEqual(set(["server1", "server2"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        self.manager.remove_server_upstream("myrpaas", "upstream1", "server2")
+        _, keys = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream_servers/upstream1/", recurse=True)
+        self.assertEqual(["test-suite-rpaas/myrpaas/upstream_servers/upstream1/server1"],
+                         [k["Key"] for k in keys])
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
+        self.assertIsNone(item[1])
+        self.assertEqual("server1", self.manager.render_upstream("myrpaas", "upstream1"))
+
+    def test_upstream_add_keeps_concurrent_servers(self):
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        other = consul_manager.ConsulManager(os.environ)
+        other.add_server_upstream("myrpaas", "upstream1", "server2")
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server3")
+        self.assertEqual(set(["server1", "server2", "server3"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        self.assertEqual("server1,server2,server3", self.manager.render_upstream("myrpaas", "upstream1"))
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
+        self.assertIsNone(item[1])
+
+    def test_upstream_migrates_legacy_value_once_on_concurrent_change(self):
+        block = '## Begin custom RpaaS upstream block ##\nserver1\n## End custom RpaaS upstream block ##'
+        self.consul.kv.put("test-suite-rpaas/myrpaas/upstream/upstream1", block)
+        original = self.manager.client.kv.get
+        calls = []
+
+        def concurrent_get(key, *args, **kwargs):
+            result = original(key, *args, **kwargs)
+            if not calls and key == "test-suite-rpaas/myrpaas/upstream/upstream1":
+                calls.append(True)
+                other = consul_manager.ConsulManager(os.environ)
+                other.add_server_upstream("myrpaas", "upstream1", "server2")
+            return result
+
+        with mock.patch.object(self.manager.client.kv, "get", side_effect=concurrent_get):
+            self.manager.add_server_upstream("myrpaas", "upstream1", "server3")
+        self.assertEqual(set(["server1", "server2", "server3"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")
+        self.assertIsNone(item[1])
+
     def test_find_acl_networks_return_empty(self):
         acls = self.manager.find_acl_network("myrpaas", "10.0.0.1/32")
         self.assertEqual([], acls)
@@ -498,6 +575,30 @@ class ConsulManagerTestCase(unittest.TestCase):
         acls = self.manager.find_acl_network("myrpaas")
         self.assertEqual([{'source': '10.0.0.2/32', 'destination': ['192.168.1.0/24']}], acls)
 
+    def test_swap_instances_concurrent_change(self):
+        swap_items = self.manager._swap_items
+
+        def changed_after_read(src, dst):
+            items = swap_items(src, dst)
+            self.consul.kv.put("test-suite-rpaas/myrpaas-2/swap", "myrpaas-3")
+            return items
+
+        with mock.patch.object(self.manager, "_swap_items", side_effect=changed_after_read):
+            with self.assertRaises(consul_manager.InstanceAlreadySwappedError):
+                self.manager.swap_instances("myrpaas-1", "myrpaas-2")
+        self.assertIsNone(self.consul.kv.get("test-suite-rpaas/myrpaas-1/swap")[1])
+        myrpaas_2_swap = self.consul.kv.get("test-suite-rpaas/myrpaas-2/swap")[1]['Value']
+        self.assertEqual(myrpaas_2_swap, "myrpaas-3")
+
+    def test_write_location_bind_mode_single_transaction(self):
+        with mock.patch.object(self.manager.client.kv, "put") as kv_put:
+            self.manager.write_location("myrpaas", "/", destination="http://myapp.host.com", bind_mode=True)
+        kv_put.assert_not_called()
+        location = self.consul.kv.get("test-suite-rpaas/myrpaas/locations/ROOT")[1]
+        self.assertIn("proxy_pass http://rpaas_default_upstream/;", location["Value"])
+        servers = self.manager.list_upstream("myrpaas", "rpaas_default_upstream")
+        self.assertEqual(set(["myapp.host.com"]), servers)
+
     def test_swap_empty_instances_successfully(self):
         self.manager.swap_instances("myrpaas-1", "myrpaas-2")
         myrpaas_1_swap = self.consul.kv.get("test-suite-rpaas/myrpaas-1/swap")[1]['Value']
@@ -544,3 +645,148 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.manager.swap_instances("myrpaas-1", "myrpaas-2")
         with self.assertRaises(consul_manager.InstanceAlreadySwappedError):
             self.manager.swap_instances("myrpaas-1", "myrpaas-3")
+
+
+class KVTransactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock(token="my-token", dc=None)
+        self.client.http.put.return_value = []
+
+    def _sent_operations(self):
+        return [json.loads(c[1]["data"]) for c in self.client.http.put.call_args_list]
+
+    def test_commit_sends_operations_in_one_request(self):
+        txn = consul_manager.KVTransaction(self.client)
+        txn.put("a/b", "value")
+        txn.put("a/c", u"valu\xe9", cas=0)
+        txn.delete("a/d")
+        txn.delete("a/e", recurse=True)
+        txn.delete("a/f", cas=10)
+        txn.commit()
+        self.client.http.put.assert_called_once_with(txn._response, "/v1/txn", params={"token": "my-token"},
+                                                     data=mock.ANY)
+        self.assertEqual([[
+            {"KV": {"Verb": "set", "Key": "a/b", "Value": base64.b64encode("value")}},
+            {"KV": {"Verb": "cas", "Key": "a/c", "Value": base64.b64encode("valu\xc3\xa9"), "Index": 0}},
+            {"KV": {"Verb": "delete", "Key": "a/d"}},
+            {"KV": {"Verb": "delete-tree", "Key": "a/e"}},
+            {"KV": {"Verb": "delete-cas", "Key": "a/f", "Index": 10}},
+        ]], self._sent_operations())
+        self.assertEqual([], txn.operations)
+
+    def test_commit_splits_chunks_by_operations(self):
+        txn = consul_manager.KVTransaction(self.client, max_ops=2)
+        for i in range(5):
+            txn.put("key/{}".format(i), "v")
+        txn.commit()
+        self.assertEqual([2, 2, 1], [len(ops) for ops in self._sent_operations()])
+
+    def test_commit_splits_chunks_by_size(self):
+        txn = consul_manager.KVTransaction(self.client, max_bytes=300)
+        for i in range(3):
+            txn.put("key/{}".format(i), "x" * 150)
+        txn.commit()
+        self.assertEqual([1, 1, 1], [len(ops) for ops in self._sent_operations()])
+
+    def test_context_manager_commits_only_on_success(self):
+        with consul_manager.KVTransaction(self.client) as txn:
+            txn.put("a", "b")
+        self.assertEqual(1, self.client.http.put.call_count)
+        with self.assertRaises(ValueError):
+            with consul_manager.KVTransaction(self.client) as txn:
+                txn.put("a", "b")
+                raise ValueError()
+        self.assertEqual(1, self.client.http.put.call_count)
+
+    def test_response_errors(self):
+        txn = consul_manager.KVTransaction(self.client)
+        ok = mock.Mock(code=200, body=json.dumps({"Results": [{"KV": {"Key": "a"}}], "Errors": None}))
+        self.assertEqual([{"KV": {"Key": "a"}}], txn._response(ok))
+        rolled_back = mock.Mock(code=409, body=json.dumps({"Results": None,
+                                                           "Errors": [{"OpIndex": 0, "What": "cas failed"}]}))
+        with self.assertRaises(consul_manager.TransactionError) as cm:
+            txn._response(rolled_back)
+        self.assertEqual([{"OpIndex": 0, "What": "cas failed"}], cm.exception.errors)
+        with self.assertRaises(consul_manager.TransactionError) as cm:
+            txn._response(mock.Mock(code=403, body="Permission denied"))
+        self.assertEqual([], cm.exception.errors)
+
+
+class KVCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("RPAAS_SERVICE_NAME", "test-suite-rpaas")
+        os.environ.setdefault("CONSUL_HOST", "127.0.0.1")
+        os.environ.setdefault("CONSUL_TOKEN", "rpaas-test")
+        self.consul = consul.Consul(token="rpaas-test")
+        self.consul.kv.delete("test-suite-rpaas", recurse=True)
+        config = dict(os.environ, CONSUL_KV_CACHE="true", CONSUL_KV_CACHE_WAIT="1s")
+        self.manager = consul_manager.ConsulManager(config)
+        self.cache = self.manager.kv_cache
+        self.cache.trees.clear()
+        self.cache.counters.update(hits=0, misses=0, stale_hits=0, invalidations=0, watch_errors=0)
+        self.cache.idle_timeout = 300.0
+        patcher = mock.patch.object(self.cache, "_start_watch")
+        self.start_watch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(consul_manager.ConsulManager(os.environ).kv_cache)
+
+    def test_cache_shared_by_managers(self):
+        config = dict(os.environ, CONSUL_KV_CACHE="true")
+        self.assertIs(self.cache, consul_manager.ConsulManager(config).kv_cache)
+
+    def test_reads_hit_cache(self):
+        self.manager.write_block("myrpaas", "server", "location /x {}")
+        self.assertEqual(1, len(self.manager.list_blocks("myrpaas")))
+        with mock.patch.object(self.cache.client.kv, "get") as get:
+            self.assertEqual(1, len(self.manager.list_blocks("myrpaas")))
+            self.assertEqual({}, self.manager.node_status("myrpaas"))
+            self.assertTrue(self.manager.check_swap_state("myrpaas", None))
+        get.assert_not_called()
+        stats = self.cache.stats()
+        self.assertEqual(1, stats["misses"])
+        self.assertEqual(3, stats["hits"])
+        self.assertEqual(1, stats["instances"])
+
+    def test_own_writes_invalidate_cache(self):
+        self.assertEqual([], self.manager.list_lua_modules("myrpaas"))
+        self.manager.write_lua("myrpaas", "my_module", "server", "content")
+        modules = self.manager.list_lua_modules("myrpaas")
+        self.assertEqual(["my_module"], [m["module_name"] for m in modules])
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        self.assertEqual(set(["server1"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        self.assertEqual(2, self.cache.stats()["invalidations"])
+
+    def test_watch_picks_up_external_writes(self):
+        self.start_watch.side_effect = lambda instance_name, tree: consul_manager.KVCache._start_watch(
+            self.cache, instance_name, tree)
+        with self.assertRaises(consul_manager.CertificateNotFoundError):
+            self.manager.get_certificate("myrpaas")
+        self.consul.kv.put("test-suite-rpaas/myrpaas/ssl/cert", "cert")
+        self.consul.kv.put("test-suite-rpaas/myrpaas/ssl/key", "key")
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                self.assertEqual(("cert", "key"), self.manager.get_certificate("myrpaas"))
+                break
+            except consul_manager.CertificateNotFoundError:
+                time.sleep(0.1)
+        else:
+            self.fail("cache did not see the external write")
+        self.assertEqual(1, self.cache.stats()["misses"])
+        self.cache.idle_timeout = 0
+
+    def test_serves_stale_data_while_consul_fails(self):
+        self.manager.write_block("myrpaas", "server", "location /x {}")
+        self.manager.list_blocks("myrpaas")
+        tree = self.cache.trees["myrpaas"]
+        tree.healthy = False
+        self.assertEqual(1, len(self.manager.list_blocks("myrpaas")))
+        self.assertEqual(1, self.cache.stats()["stale_hits"])
+        tree.synced_at -= self.cache.max_stale
+        with mock.patch.object(self.cache.client.kv, "get", side_effect=consul.ConsulException("down")):
+            with self.assertRaises(consul.ConsulException):
+                self.manager.list_blocks("myrpaas")
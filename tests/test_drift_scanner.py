@@ -0,0 +1,82 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import consul
+import redis
+
+from mock import patch
+from rpaas import consul_manager, storage, tasks
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class DriftScannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "MONGO_DATABASE": "drift_scanner_test",
+            "RPAAS_SERVICE_NAME": "test_rpaas_drift",
+            "CONSUL_HOST": "127.0.0.1",
+            "CONSUL_TOKEN": "rpaas-test",
+        }
+        self.storage = storage.MongoDBStorage(self.config)
+        colls = self.storage.db.collection_names(False)
+        for coll in colls:
+            self.storage.db.drop_collection(coll)
+        redis.StrictRedis().flushall()
+        self.consul = consul.Consul(token="rpaas-test")
+        self.consul.kv.delete("test_rpaas_drift", recurse=True)
+        self.addCleanup(self.consul.kv.delete, "test_rpaas_drift", recurse=True)
+        hosts = self.storage.db[self.storage.hosts_collection]
+        hosts.insert({"_id": "h1", "dns_name": "10.0.0.1", "group": "foo"})
+        hosts.insert({"_id": "h2", "dns_name": "10.0.0.2", "group": "foo"})
+        for key in ["foo/ssl/cert", "foo/ssl/key", "foo/ssl/h1/cert", "foo/ssl/h1/key",
+                    "foo/ssl/h9/cert", "foo/ssl/h9/key", "foo/status/node-1", "foo/status/node-9",
+                    "foo/acl/10.0.0.1_32", "foo/acl/10.0.0.9_32", "bar/status/node-8"]:
+            self.consul.kv.put("test_rpaas_drift/" + key, "value")
+        self.storage.store_task("bar")
+        self.storage.store_task({"_id": "restore_10.0.0.1", "host": "10.0.0.1", "instance": "foo"})
+        self.storage.store_task({"_id": "restore_10.0.0.7", "host": "10.0.0.7", "instance": "foo"})
+        self.storage.store_hc({"_id": "foo", "urls": ["http://10.0.0.1:8080/", "http://10.0.0.5:8080/"]})
+        node_hostnames = patch.object(consul_manager.ConsulManager, "node_hostnames",
+                                      return_value={"10.0.0.1": "node-1", "10.0.0.8": "node-8"})
+        node_hostnames.start()
+        self.addCleanup(node_hostnames.stop)
+
+    def keys(self):
+        return sorted(k.split("/", 1)[1] for k in self.consul.kv.get("test_rpaas_drift/", keys=True)[1])
+
+    def test_scan_reports_drift(self):
+        drift = tasks.ScanDriftTask().run(self.config)
+        self.assertEqual(1, len(drift))
+        report = self.storage.list_drift_reports()[0]
+        self.assertEqual("foo", report["_id"])
+        self.assertEqual(["h9"], report["ssl"])
+        self.assertEqual(["node-9"], report["status"])
+        self.assertEqual(["10.0.0.9"], report["acl"])
+        self.assertEqual(["http://10.0.0.5:8080/"], report["hc_urls"])
+        self.assertEqual(["restore_10.0.0.7"], report["restore_tasks"])
+        self.assertFalse(report["deleted"])
+        self.assertEqual(11, len(self.keys()))
+        self.assertEqual(3, self.storage.find_task({}).count())
+
+    @patch("rpaas.tasks.hc")
+    def test_scan_deletes_orphans(self, hc):
+        config = dict(self.config, DRIFT_SCANNER_DELETE_ORPHANS="1", DRIFT_SCANNER_BATCH_SIZE="2")
+        tasks.ScanDriftTask().run(config)
+        self.assertEqual(["bar/status/node-8", "foo/acl/10.0.0.1_32", "foo/ssl/cert", "foo/ssl/h1/cert",
+                          "foo/ssl/h1/key", "foo/ssl/key", "foo/status/node-1"], self.keys())
+        self.assertEqual(["bar", "restore_10.0.0.1"],
+                         sorted(task["_id"] for task in self.storage.find_task({})))
+        hc.Dumb.return_value.remove_url.assert_called_once_with("foo", "10.0.0.5")
+        self.assertTrue(self.storage.list_drift_reports()[0]["deleted"])
+
+    def test_scan_skips_when_already_running(self):
+        lock = redis.StrictRedis().lock("drift_scanner:test_rpaas_drift", timeout=60)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        self.assertIsNone(tasks.ScanDriftTask().run(self.config))
+        self.assertEqual([], self.storage.list_drift_reports())
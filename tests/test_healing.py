@@ -3,14 +3,16 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import threading
 import time
 import unittest
 import redis
 
+from pymongo.collection import Collection
 from freezegun import freeze_time
 from mock import patch, call
 from rpaas import storage, tasks
-from rpaas import healing, consul_manager
+from rpaas import healing, consul_manager, lock
 from hm import managers, log
 from hm.model.host import Host
 from requests.exceptions import ConnectionError
@@ -291,6 +293,52 @@ class RestoreMachineTestCase(unittest.TestCase):
                 bar_instances_healings.append(event)
             self.assertListEqual(bar_instances_healings, expected_healings)
 
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_concurrently_respects_instance_slots(self, log, nginx):
+        self.config.update(RESTORE_MACHINE_MAX_PARALLELISM=4, RESTORE_MACHINE_MAX_UNAVAILABLE=0.5)
+        instances = {'10.1.1.1': 'foo', '10.3.3.3': 'foo', '10.4.4.4': 'foo', '10.5.5.5': 'bar'}
+        running = []
+        max_running = {}
+        running_lock = threading.Lock()
+
+        def wait_healthcheck(host, timeout):
+            with running_lock:
+                running.append(instances[host])
+                for instance in set(running):
+                    max_running[instance] = max(max_running.get(instance, 0), running.count(instance))
+            time.sleep(0.2)
+            with running_lock:
+                running.remove(instances[host])
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        tasks.RestoreMachineTask().run(self.config)
+        self.assertDictEqual({'foo': 1, 'bar': 1}, max_running)
+        self.assertItemsEqual([call("Machine 0 restored"), call("Machine 2 restored"),
+                               call("Machine 3 restored"), call("Machine 4 restored")], log.info.call_args_list)
+        restore_tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(restore_tasks, ['restore_10.2.2.2'])
+        healings = list(self.storage.db[self.storage.healing_collection].find())
+        self.assertEqual(4, len(healings))
+        for healing_event in healings:
+            self.assertEqual("success", healing_event["status"])
+            self.assertIn("restore_seconds", healing_event)
+            self.assertIn("queued_seconds", healing_event)
+            self.assertIn("total_seconds", healing_event)
+        self.assertTrue(redis.StrictRedis().lock("restore_lock", timeout=1).acquire(blocking=False))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_concurrently_skips_failed_instance(self, log, nginx):
+        self.config.update(RESTORE_MACHINE_MAX_PARALLELISM=4, RESTORE_MACHINE_MAX_UNAVAILABLE=0.5)
+        FakeManager.fail_ids = [0]
+        with self.assertRaises(tasks.RestoreMachineError):
+            tasks.RestoreMachineTask().run(self.config)
+        self.assertItemsEqual([call("Machine 4 restored")], log.info.call_args_list)
+        restore_tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(['restore_10.1.1.1', 'restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'],
+                             restore_tasks)
+        self.assertIsNotNone(self.storage.find_task("restore_10.1.1.1")[0].get("last_attempt"))
+
 
 class CheckMachineTestCase(unittest.TestCase):
 
@@ -321,7 +369,8 @@ class CheckMachineTestCase(unittest.TestCase):
         FakeManager.host_id = 0
         FakeManager.hosts = ['10.1.1.1', '10.2.2.2', '10.3.3.3']
 
-        redis.StrictRedis().delete("check_machine:test_rpaas_check_machine:last_run")
+        redis.StrictRedis().delete("check_machine:test_rpaas_check_machine:last_run",
+                                   "check_machine:test_rpaas_check_machine:leader")
 
     def tearDown(self):
         self.storage.db[self.storage.tasks_collection].remove()
@@ -363,3 +412,94 @@ class CheckMachineTestCase(unittest.TestCase):
         checker.stop()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
         self.assertListEqual(tasks, [])
+
+    def _node(self, address, status, tag):
+        return {'Node': {'Address': address},
+                'Checks': [{'CheckId': 1, 'Status': 'passing'}, {'CheckId': 2, 'Status': status}],
+                'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', tag]}}
+
+    def test_check_machine_changed_nodes_debounce(self):
+        checker = healing.CheckMachine(dict(self.config, CHECK_MACHINE_DEBOUNCE=10))
+        nodes = [self._node('10.1.1.1', 'passing', 'rpaas_01'), self._node('10.2.2.2', 'critical', 'rpaas_02')]
+        self.assertEqual([], checker.changed_nodes(nodes, 100))
+        self.assertItemsEqual(nodes, checker.changed_nodes(nodes, 110))
+        self.assertEqual([], checker.changed_nodes(nodes, 200))
+        flapping = [self._node('10.1.1.1', 'critical', 'rpaas_01'), nodes[1]]
+        self.assertEqual([], checker.changed_nodes(flapping, 210))
+        self.assertEqual([], checker.changed_nodes(nodes, 215))
+        self.assertEqual([], checker.changed_nodes(flapping, 218))
+        self.assertEqual([], checker.changed_nodes(flapping, 227))
+        self.assertEqual([flapping[0]], checker.changed_nodes(flapping, 228))
+        self.assertEqual([], checker.changed_nodes([nodes[1]], 300))
+        self.assertEqual({'10.2.2.2': True}, checker.states)
+
+    @patch.object(consul_manager.ConsulManager, "watch_service_healthcheck")
+    def test_check_machine_watch_mode(self, watch_service_healthcheck):
+        nodes = [self._node('10.1.1.1', 'critical', 'rpaas_01'), self._node('10.2.2.2', 'passing', 'rpaas_02'),
+                 self._node('10.3.3.3', 'critical', 'rpaas_02')]
+        responses = [(10, nodes[:2]), (11, nodes)]
+
+        def watch(index, wait):
+            if responses:
+                return responses.pop(0)
+            time.sleep(0.1)
+            return index, nodes
+        watch_service_healthcheck.side_effect = watch
+        checker = healing.CheckMachine(dict(self.config, CHECK_MACHINE_WATCH="true", CHECK_MACHINE_DEBOUNCE=0))
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1', 'restore_10.3.3.3'])
+        self.assertEqual(call(None, "30s"), watch_service_healthcheck.call_args_list[0])
+        self.assertEqual(call(10, "30s"), watch_service_healthcheck.call_args_list[1])
+
+    @patch.object(consul_manager.ConsulManager, "watch_service_healthcheck")
+    def test_check_machine_watch_mode_only_leader_watches(self, watch_service_healthcheck):
+        leader = lock.Leases(redis.StrictRedis(), 30)
+        self.assertTrue(leader.acquire("check_machine:test_rpaas_check_machine:leader"))
+        self.addCleanup(leader.stop)
+        checker = healing.CheckMachine(dict(self.config, CHECK_MACHINE_WATCH="true", CHECK_MACHINE_DEBOUNCE=0))
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+        watch_service_healthcheck.assert_not_called()
+
+    def test_check_machine_due_nodes_kept_until_sent(self):
+        checker = healing.CheckMachine(dict(self.config, CHECK_MACHINE_DEBOUNCE=0))
+        nodes = [self._node('10.1.1.1', 'critical', 'rpaas_01')]
+        self.assertEqual(nodes, checker.due_nodes(nodes, 100))
+        self.assertEqual(nodes, checker.due_nodes(nodes, 101))
+        checker.mark_sent(nodes)
+        self.assertEqual([], checker.due_nodes(nodes, 102))
+        self.assertEqual({'10.1.1.1': True}, checker.states)
+
+    def test_check_machine_round_trips_independent_of_fleet_size(self):
+        hosts = self.storage.db[self.storage.hosts_collection]
+        calls = []
+
+        def counting(method):
+            def count(self, *args, **kwargs):
+                calls.append(method.__name__)
+                return method(self, *args, **kwargs)
+            return count
+        for size in (1000, 10000):
+            hosts.remove()
+            self.storage.db[self.storage.tasks_collection].remove()
+            addresses = ["10.0.{}.{}".format(i / 256, i % 256) for i in range(size)]
+            hosts.insert_many([{"_id": i, "dns_name": address, "manager": "fake"}
+                               for i, address in enumerate(addresses)])
+            nodes = [self._node(address, 'critical' if i % 10 == 0 else 'passing', 'rpaas_01')
+                     for i, address in enumerate(addresses)]
+            del calls[:]
+            with patch.object(Collection, "find", counting(Collection.find)), \
+                    patch.object(Collection, "find_one", counting(Collection.find_one)), \
+                    patch.object(Collection, "insert", counting(Collection.insert)), \
+                    patch.object(Collection, "remove", counting(Collection.remove)), \
+                    patch.object(Collection, "bulk_write", counting(Collection.bulk_write)):
+                start = time.time()
+                tasks.CheckMachineTask().run(self.config, nodes)
+                elapsed = time.time() - start
+            self.assertListEqual(["find", "bulk_write"], calls, "{} nodes".format(size))
+            self.assertLess(elapsed, 30, "{} nodes".format(size))
+            self.assertEqual(size / 10, self.storage.find_task({"_id": {"$regex": "restore_.+"}}).count())
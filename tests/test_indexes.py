@@ -0,0 +1,137 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import unittest
+
+import pymongo
+from pymongo import monitoring
+
+from rpaas import storage
+
+
+class CommandRecorder(monitoring.CommandListener):
+
+    def __init__(self):
+        self.queries = []
+
+    def started(self, event):
+        command = event.command
+        name = event.command_name
+        if name == "find":
+            self.queries.append((command["find"], command.get("filter", {}), command.get("sort")))
+        elif name == "count":
+            self.queries.append((command["count"], command.get("query", {}), None))
+        elif name == "findAndModify":
+            self.queries.append((command["findAndModify"], command.get("query", {}), command.get("sort")))
+        elif name == "aggregate":
+            match = command["pipeline"][0].get("$match", {})
+            self.queries.append((command["aggregate"], match, None))
+        elif name == "update":
+            for update in command["updates"]:
+                self.queries.append((command["update"], update["q"], None))
+        elif name == "delete":
+            for delete in command["deletes"]:
+                self.queries.append((command["delete"], delete["q"], None))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            for stage in stages(value):
+                yield stage
+    elif isinstance(plan, list):
+        for value in plan:
+            for stage in stages(value):
+                yield stage
+
+
+class IndexesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MongoDBStorage({"MONGO_DATABASE": "indexes_test"})
+        for coll in self.storage.db.collection_names(False):
+            self.storage.db.drop_collection(coll)
+        self.storage.ensure_indexes()
+        self.recorder = CommandRecorder()
+        client = pymongo.MongoClient(self.storage.mongo_uri, event_listeners=[self.recorder])
+        self.addCleanup(client.close)
+        self.audited = storage.MongoDBStorage({"MONGO_DATABASE": "indexes_test"})
+        self.audited.db = client[self.storage.mongo_database]
+
+    def seed(self):
+        db = self.storage.db
+        now = datetime.datetime.utcnow()
+        for i in xrange(20):
+            db[self.storage.tasks_collection].insert({"_id": "restore_10.0.0.{}".format(i),
+                                                      "host": "10.0.0.{}".format(i),
+                                                      "instance": "inst{}".format(i % 3), "created": now,
+                                                      "last_attempt": None})
+            db[self.storage.tasks_collection].insert({"_id": "inst{}".format(i), "task_id": "task{}".format(i)})
+            db[self.storage.hosts_collection].insert({"_id": "h{}".format(i), "dns_name": "10.0.0.{}".format(i),
+                                                      "group": "inst{}".format(i % 3), "pool_state": "ready"})
+            db[self.storage.provisions_collection].insert({"instance": "inst{}".format(i), "state": "running"})
+            db[self.storage.quota_collection].insert({"_id": "team{}".format(i), "used": ["inst{}".format(i)],
+                                                      "quota": 5})
+            db[self.storage.le_certificates_collection].insert({"_id": "inst{}".format(i), "domain": "x.com",
+                                                                "created": now})
+            self.storage.store_healing("inst{}".format(i), "m{}".format(i))
+
+    def exercise(self):
+        s = self.audited
+        limit = datetime.datetime.utcnow()
+        list(s.find_task({"_id": {"$regex": "^restore_."}, "created": {"$lte": limit}}))
+        list(s.find_task({"_id": {"$regex": "^restore_."}, "last_attempt": {"$ne": None}}))
+        s.find_task_status("inst1")
+        s.mark_task_failure("inst1", "task1")
+        s.list_healings(10)
+        s.find_host_id("10.0.0.1")
+        s.find_hosts_by_dns_name(["10.0.0.1", "10.0.0.2"])
+        s.count_hosts_by_group(["inst1", "inst2"])
+        s.count_hosts_by_alternative("inst1")
+        s.count_pool_hosts("inst1")
+        s.count_pool_hosts("inst1", "ready")
+        s.claim_pool_host("inst1", "newinst")
+        s.list_pool_entries("inst1")
+        list(s.find_provisions({"instance": "inst1", "state": "running"}))
+        s.remove_provisions({"instance": "inst2"})
+        s.increment_quota("team1", ["inst1"], "other")
+        s.decrement_quota("inst3")
+        list(s.find_le_certificates({"created": {"$lte": limit}}))
+        list(s.find_le_certificates({"name": "inst1"}))
+        s.remove_le_certificate("inst4", "x.com")
+        s.store_desired_state("inst1", units=2)
+        s.queue_reconcile("inst1", "task1")
+        s.requeue_reconcile("inst1", "task1", "task2")
+        s.find_instances_metadata(["inst1"])
+        s.add_hc_url("inst1", "http://10.0.0.1:8080/")
+        s.remove_hc_url("inst1", "http://10.0.0.1:8080/")
+
+    def test_ensure_indexes_is_idempotent(self):
+        self.storage.ensure_indexes()
+        for collection, keys, _ in self.storage.indexes:
+            info = self.storage.db[getattr(self.storage, collection)].index_information()
+            self.assertIn(keys, [index["key"] for index in info.values()])
+
+    def test_queries_do_not_scan_collections(self):
+        self.seed()
+        self.exercise()
+        self.assertTrue(self.recorder.queries)
+        scans = []
+        for collection, query, sort in self.recorder.queries:
+            cursor = self.storage.db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(list(sort.items()))
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            if "COLLSCAN" in stages(plan):
+                scans.append((collection, query, sort))
+        self.assertEqual([], scans)
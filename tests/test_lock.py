@@ -81,3 +81,15 @@ class LockManagerTestCase(unittest.TestCase):
         lock_manager.extend_lock("lock1", 30)
         time.sleep(3)
         self.assertFalse(lock_1.acquire(blocking=False))
+
+    def test_leases_renewed_while_held(self):
+        leases = lock.Leases(self.redis_conn, lease=1, interval=0.2)
+        self.assertTrue(leases.acquire("lease1"))
+        self.assertFalse(lock.Leases(self.redis_conn, lease=1).acquire("lease1"))
+        time.sleep(1.5)
+        self.assertTrue(self.redis_conn.exists("lease1"))
+        self.assertEqual("lease2", leases.acquire_any(["lease1", "lease2"]))
+        leases.release("lease1")
+        self.assertFalse(self.redis_conn.exists("lease1"))
+        leases.stop()
+        self.assertFalse(self.redis_conn.exists("lease2"))
@@ -6,19 +6,33 @@
 
 import copy
 import consul
+import datetime
+import json
+import threading
+import time
 import unittest
 import os
 
 import mock
+from hm.model.host import Host
 
 import rpaas.manager
-from rpaas.manager import Manager, ScaleError, QuotaExceededError
+from rpaas.manager import (Manager, ScaleError, QuotaExceededError, LoadBalancerCache,
+                           restore_batch_size)
 from rpaas import tasks, storage, nginx
+from rpaas.nginx import Nginx
 from rpaas.consul_manager import InstanceAlreadySwappedError, CertificateNotFoundError
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
 
 
+def wait_healthchecks_concurrently(nginx_module):
+    # keeps the real group wait on top of the mocked wait_healthcheck
+    nginx_manager = nginx_module.Nginx.return_value
+    nginx_manager.wait_healthchecks.side_effect = lambda hosts, **kwargs: Nginx.wait_healthchecks.__func__(
+        nginx_manager, hosts, **kwargs)
+
+
 class ManagerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -87,6 +101,154 @@ class ManagerTestCase(unittest.TestCase):
         nginx_manager.wait_healthcheck.assert_called_once_with(host.dns_name, timeout=600)
         manager.consul_manager.write_healthcheck.assert_called_once_with("x")
 
+    def _async_provisioning_lb(self, hosts=None):
+        lb = mock.Mock()
+        lb.dsr = False
+        lb.hosts = list(hosts or [])
+        lb.add_host.side_effect = lb.hosts.append
+
+        def remove_host(host):
+            lb.hosts.remove(host)
+
+        lb.remove_host.side_effect = remove_host
+        return lb
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_new_instance_async_provisioning(self, nginx):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ASYNC_PROVISIONING"] = "1"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        lb = self._async_provisioning_lb()
+        self.LoadBalancer.create.return_value = lb
+        self.LoadBalancer.find.side_effect = lambda name, conf: lb if self.LoadBalancer.create.called else None
+        host = self.Host.create.return_value
+        host.id = "h-1"
+        host.dns_name = "10.0.0.1"
+        self.Host.find.return_value = host
+        manager.new_instance("x")
+        config["HOST_TAGS"] = "rpaas_service:test-suite-rpaas,rpaas_instance:x,consul_token:abc-123"
+        self.LoadBalancer.create.assert_called_once_with("my-lb-manager", "x", config)
+        self.Host.create.assert_called_once_with("my-host-manager", "x", config)
+        lb.add_host.assert_called_once_with(host)
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.healthcheck.assert_called_once_with("10.0.0.1")
+        nginx_manager.wait_healthcheck.assert_not_called()
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+        self.assertEqual(self.storage.find_provisions({"instance": "x"}).count(), 0)
+
+    @mock.patch.object(tasks.ProvisionHostTask, "_retry_later")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_async_provisioning_resumes(self, nginx, retry_later):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ASYNC_PROVISIONING"] = "1"
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        lb = self._async_provisioning_lb([mock.Mock(id="h-0")])
+        self.LoadBalancer.find.return_value = lb
+        host = self.Host.create.return_value
+        host.id = "h-1"
+        host.dns_name = "10.0.0.1"
+        self.Host.find.return_value = host
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.healthcheck.side_effect = rpaas.nginx.NginxError("booting")
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.scale_instance("x", 2)
+        self.assertEqual(1, retry_later.call_count)
+        provision_id = retry_later.call_args[0][1]
+        provision = self.storage.find_provision(provision_id)
+        self.assertEqual("await_health", provision["step"])
+        self.assertEqual("running", provision["state"])
+        self.assertEqual("h-1", provision["host_id"])
+        self.assertEqual(self.storage.find_task("x").count(), 1)
+        lb.add_host.assert_called_once_with(host)
+        nginx_manager.healthcheck.side_effect = None
+        tasks.ProvisionHostTask().run(retry_later.call_args[0][0], provision_id)
+        self.Host.create.assert_called_once()
+        lb.add_host.assert_called_once_with(host)
+        self.assertEqual(2, nginx_manager.healthcheck.call_count)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+        self.assertEqual(self.storage.find_provisions({"instance": "x"}).count(), 0)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_async_provisioning_timeout_and_rollback(self, nginx, hc):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ASYNC_PROVISIONING"] = "1"
+        config["RPAAS_ROLLBACK_ON_ERROR"] = "1"
+        config["RPAAS_HEALTHCHECK_TIMEOUT"] = "0"
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        lb = self._async_provisioning_lb([mock.Mock(id="h-0")])
+        self.LoadBalancer.find.return_value = lb
+        host = self.Host.create.return_value
+        host.id = "h-1"
+        host.dns_name = "10.0.0.1"
+        self.Host.find.return_value = host
+        nginx.Nginx.return_value.healthcheck.side_effect = rpaas.nginx.NginxError("booting")
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.scale_instance("x", 2)
+        host.destroy.assert_called_once_with()
+        lb.remove_host.assert_called_once_with(host)
+        lb.destroy.assert_not_called()
+        hc.return_value.add_url.assert_not_called()
+        hc.return_value.destroy.assert_not_called()
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+        self.assertEqual(self.storage.find_provisions({"instance": "x"}).count(), 0)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_new_instance_async_provisioning_creates_healthcheck(self, nginx, hc):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ASYNC_PROVISIONING"] = "1"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        lb = self._async_provisioning_lb()
+        self.LoadBalancer.create.return_value = lb
+        self.LoadBalancer.find.side_effect = lambda name, conf: lb if self.LoadBalancer.create.called else None
+        host = self.Host.create.return_value
+        host.id = "h-1"
+        host.dns_name = "10.0.0.1"
+        self.Host.find.return_value = host
+        manager.new_instance("x")
+        hc.return_value.create.assert_called_once_with("x")
+        hc.return_value.add_url.assert_called_once_with("x", "10.0.0.1")
+
+    def test_provisions_reserve_alternatives_without_holding_the_lock(self):
+        config = copy.deepcopy(self.config)
+        config["HM_ALTERNATIVE_CONFIG_COUNT"] = "2"
+        task = tasks.ProvisionHostTask()
+        task.init_config(config)
+        for provision_id in ["x:1", "x:2", "x:3"]:
+            self.storage.store_provision({"_id": provision_id, "instance": "x", "operation": "op-1",
+                                          "step": "create_host", "state": "running"})
+        reserved = []
+        for provision_id in ["x:1", "x:2", "x:3"]:
+            provision = self.storage.find_provision(provision_id)
+            self.assertTrue(task._reserve_provision_alternative(provision))
+            reserved.append(self.storage.find_provision(provision_id)["alternative_id"])
+        self.assertEqual([0, 1, 0], reserved)
+        self.assertTrue(task.lock_manager.lock("provision:x", timeout=1))
+        task.lock_manager.unlock("provision:x")
+
+    def test_finish_provisions_keeps_later_operation(self):
+        task = tasks.ProvisionHostTask()
+        task.init_config(self.config)
+        self.storage.store_task({"_id": "x", "operation": "op-2"})
+        self.storage.store_provision({"_id": "x:1", "instance": "x", "operation": "op-1", "state": "done"})
+        self.storage.store_provision({"_id": "x:2", "instance": "x", "operation": "op-2", "state": "running"})
+        task._finish_provisions(self.storage.find_provision("x:1"))
+        self.assertEqual(1, self.storage.find_task("x").count())
+        self.assertEqual(["x:2"], [p["_id"] for p in self.storage.find_provisions({"instance": "x"})])
+        self.storage.update_provision("x:2", {"state": "done"})
+        task._finish_provisions(self.storage.find_provision("x:2"))
+        self.assertEqual(0, self.storage.find_task("x").count())
+        self.assertEqual(0, self.storage.find_provisions({"instance": "x"}).count())
+
     @mock.patch("rpaas.tasks.nginx")
     def test_new_instance_host_create_fail_and_raises(self, nginx):
         manager = Manager(self.config)
@@ -395,6 +557,31 @@ class ManagerTestCase(unittest.TestCase):
         manager.remove_instance("x")
         self.assertEquals(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.tasks.consul_manager")
+    def test_remove_instance_aggregates_host_failures(self, consul_manager):
+        self.storage.store_instance_metadata("x", plan_name="small")
+        consul = consul_manager.ConsulManager.return_value
+        consul.node_hostnames.return_value = {"10.0.0.1": "vm-1", "10.0.0.2": "vm-2", "10.0.0.3": "vm-3"}
+        lb = self.LoadBalancer.find.return_value
+        hosts = [mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host in enumerate(hosts):
+            host.dns_name = "10.0.0.{}".format(idx + 1)
+            host.id = str(idx + 1)
+        hosts[1].destroy.side_effect = Exception("vm stuck")
+        lb.hosts = hosts
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.remove_instance("x")
+        for host in hosts:
+            host.destroy.assert_called_once_with()
+        self.assertItemsEqual([mock.call(hosts[0]), mock.call(hosts[2])], lb.remove_host.call_args_list)
+        self.assertItemsEqual([mock.call("x", "vm-1", "1"), mock.call("x", "vm-3", "3")],
+                              consul.remove_node.call_args_list)
+        consul.node_hostnames.assert_called_once_with(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        consul.destroy_instance.assert_not_called()
+        lb.destroy.assert_not_called()
+        self.assertEquals(self.storage.find_task("x").count(), 0)
+
     def test_remove_instance_on_swap_error(self):
         self.storage.store_instance_metadata("x", plan_name="small")
         manager = Manager(self.config)
@@ -477,19 +664,24 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         lb.hosts[1].id = 'yyy'
         self.storage.store_instance_metadata("x", plan_name="huge", consul_token="abc-123")
+        wait_healthchecks_concurrently(nginx)
         manager = Manager(self.config)
-        responses = [response for response in manager.restore_instance("x")]
+        responses = [json.loads(response) for response in manager.restore_instance("x")]
         lb.hosts[0].stop.assert_called_once()
         lb.hosts[0].scale.assert_called_once()
-        lb.hosts[0].restore.assert_called_once()
+        lb.hosts[0].restore.assert_called_once_with(reset_template=True, reset_tags=True)
         lb.hosts[1].scale.assert_called_once()
         lb.hosts[1].stop.assert_called_once()
-        lb.hosts[1].restore.assert_called_once()
-        while "." in responses:
-            responses.remove(".")
-        expected_responses = ["Restoring host (1/2) xxx ", ": successfully restored\n",
-                              "Restoring host (2/2) yyy ", ": successfully restored\n"]
-        self.assertListEqual(responses, expected_responses)
+        lb.hosts[1].restore.assert_called_once_with(reset_template=True, reset_tags=True)
+        events = [(r.get("host"), r.get("batch"), r.get("step"), r["status"]) for r in responses]
+        steps = ["stop", "scale", "restore", "start", "healthcheck"]
+        expected_events = [("xxx", 1, None, "restoring")] + [("xxx", 1, step, "done") for step in steps] + \
+            [("xxx", 1, None, "restored"), ("yyy", 2, None, "restoring")] + \
+            [("yyy", 2, step, "done") for step in steps] + \
+            [("yyy", 2, None, "restored"), (None, None, None, "finished")]
+        self.assertListEqual(events, expected_events)
+        self.assertEqual("1/2", responses[0]["position"])
+        self.assertDictEqual({"status": "finished", "restored": 2, "failed": 0, "total": 2}, responses[-1])
         self.assertDictContainsSubset(LoadBalancer.find.call_args[1],
                                       {'CLOUDSTACK_TEMPLATE_ID': u'1234', 'HOST_TAGS': u'a:b,c:d'})
         self.assertEqual(self.storage.find_task("x").count(), 0)
@@ -512,17 +704,15 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         lb.hosts[1].id = 'yyy'
         self.storage.store_instance_metadata("x", plan_name="huge", consul_token="abc-123")
+        wait_healthchecks_concurrently(nginx)
         manager = Manager(self.config)
         nginx_manager = nginx.Nginx.return_value
         nginx_manager.wait_healthcheck.side_effect = ["OK", Exception("timeout to response")]
-        responses = [response for response in manager.restore_instance("x")]
-        while "." in responses:
-            responses.remove(".")
-        nginx_manager.wait_healthcheck.assert_called_with(host='10.2.2.2', timeout=600,
-                                                          manage_healthcheck=False)
-        expected_responses = ["Restoring host (1/2) xxx ", ": successfully restored\n",
-                              "Restoring host (2/2) yyy ", ": failed to restore - 'timeout to response'\n"]
-        self.assertListEqual(responses, expected_responses)
+        responses = [json.loads(response) for response in manager.restore_instance("x")]
+        nginx_manager.wait_healthcheck.assert_called_with('10.2.2.2', timeout=600, manage_healthcheck=False)
+        self.assertDictContainsSubset({"host": "yyy", "step": "healthcheck", "status": "failed",
+                                       "error": "'timeout to response'"}, responses[-2])
+        self.assertDictEqual({"status": "failed", "restored": 1, "failed": 1, "total": 2}, responses[-1])
         self.assertDictContainsSubset(LoadBalancer.find.call_args[1],
                                       {'CLOUDSTACK_TEMPLATE_ID': u'1234', 'HOST_TAGS': u'a:b,c:d'})
         self.assertEqual(self.storage.find_task("x").count(), 0)
@@ -546,17 +736,136 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].id = 'yyy'
         lb.hosts[1].scale.side_effect = Exception("failed to resize instance")
         self.storage.store_instance_metadata("x", plan_name="huge", consul_token="abc-123")
+        wait_healthchecks_concurrently(nginx)
         manager = Manager(self.config)
-        responses = [response for response in manager.restore_instance("x")]
-        while "." in responses:
-            responses.remove(".")
-        expected_responses = ["Restoring host (1/2) xxx ", ": successfully restored\n",
-                              "Restoring host (2/2) yyy ", ": failed to restore - 'failed to resize instance'\n"]
-        self.assertListEqual(responses, expected_responses)
+        responses = [json.loads(response) for response in manager.restore_instance("x")]
+        self.assertDictContainsSubset({"host": "yyy", "step": "scale", "status": "failed",
+                                       "error": "'failed to resize instance'"}, responses[-2])
+        self.assertDictEqual({"status": "failed", "restored": 1, "failed": 1, "total": 2}, responses[-1])
+        lb.hosts[1].restore.assert_not_called()
         self.assertDictContainsSubset(LoadBalancer.find.call_args[1],
                                       {'CLOUDSTACK_TEMPLATE_ID': u'1234', 'HOST_TAGS': u'a:b,c:d'})
         self.assertEqual(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.manager.nginx")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_restore_instance_in_concurrent_batches(self, LoadBalancer, nginx):
+        self.config["RPAAS_RESTORE_DELAY"] = 0
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock() for _ in range(5)]
+        for idx, host in enumerate(lb.hosts):
+            host.id = "h{}".format(idx)
+            host.dns_name = "10.0.0.{}".format(idx)
+        running = []
+        max_running = []
+        running_lock = threading.Lock()
+
+        def wait_healthcheck(host, timeout, manage_healthcheck):
+            with running_lock:
+                running.append(host)
+                max_running.append(len(running))
+            time.sleep(0.1)
+            with running_lock:
+                running.remove(host)
+            if host == "10.0.0.3":
+                raise Exception("timeout to response")
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        wait_healthchecks_concurrently(nginx)
+        manager = Manager(self.config)
+        responses = [json.loads(response) for response in manager.restore_instance("x", "40%")]
+        self.assertEqual(2, max(max_running))
+        batches = dict((r["host"], r["batch"]) for r in responses if r.get("status") == "restoring")
+        self.assertDictEqual({"h0": 1, "h1": 1, "h2": 2, "h3": 2}, batches)
+        lb.hosts[4].stop.assert_not_called()
+        self.assertDictEqual({"status": "failed", "restored": 3, "failed": 1, "total": 5}, responses[-1])
+
+    def test_restore_batch_size(self):
+        self.assertEqual(1, restore_batch_size(1, 10))
+        self.assertEqual(3, restore_batch_size("3", 10))
+        self.assertEqual(2, restore_batch_size("25%", 10))
+        self.assertEqual(1, restore_batch_size("5%", 10))
+        self.assertEqual(4, restore_batch_size(10, 4))
+        self.assertEqual(1, restore_batch_size("50%", 0))
+
+    @mock.patch("rpaas.misc.time")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache(self, LoadBalancer, time):
+        time.time.return_value = 100
+        lb = mock.Mock()
+        LoadBalancer.find.side_effect = lambda name: lb if name == "x" else None
+        cache = LoadBalancerCache(10, negative_ttl=2)
+        self.assertIs(lb, cache.find("x"))
+        self.assertIs(lb, cache.find("x"))
+        self.assertIsNone(cache.find("y"))
+        self.assertIsNone(cache.find("y"))
+        self.assertEqual(2, LoadBalancer.find.call_count)
+        time.time.return_value = 105
+        self.assertIs(lb, cache.find("x"))
+        self.assertIsNone(cache.find("y"))
+        self.assertEqual(3, LoadBalancer.find.call_count)
+        cache.invalidate("x")
+        self.assertIs(lb, cache.find("x"))
+        self.assertEqual(4, LoadBalancer.find.call_count)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_disabled(self, LoadBalancer):
+        cache = LoadBalancerCache(0)
+        cache.find("x")
+        cache.find("x")
+        self.assertEqual(2, LoadBalancer.find.call_count)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_invalidated_during_lookup(self, LoadBalancer):
+        cache = LoadBalancerCache(10)
+
+        def find(name):
+            cache.invalidate(name)
+            return mock.Mock()
+
+        LoadBalancer.find.side_effect = find
+        cache.find("x")
+        cache.find("x")
+        self.assertEqual(2, LoadBalancer.find.call_count)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_instance_lookups_use_load_balancer_cache(self, LoadBalancer):
+        self.config["RPAAS_INSTANCE_CACHE_TTL"] = 30
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.list_blocks.return_value = []
+        manager.consul_manager.check_swap_state.return_value = True
+        manager.list_blocks("x")
+        manager.list_blocks("x")
+        LoadBalancer.find.assert_called_once_with("x")
+        manager.remove_instance("x")
+        self.assertNotIn("x", manager.lb_cache.entries)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_skips_busy_instances(self, LoadBalancer):
+        busy = set(["x"])
+        cache = LoadBalancerCache(10, busy=lambda name: name in busy)
+        LoadBalancer.find.return_value = None
+        self.assertIsNone(cache.find("x"))
+        lb = LoadBalancer.find.return_value = mock.Mock()
+        busy.clear()
+        self.assertIs(lb, cache.find("x"))
+        self.assertIs(lb, cache.find("x"))
+        self.assertEqual(2, LoadBalancer.find.call_count)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_remove_instance_does_not_cache_lookups_while_removing(self, LoadBalancer):
+        self.config["RPAAS_INSTANCE_CACHE_TTL"] = 30
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.check_swap_state.return_value = True
+        lb = self.LoadBalancer.find.return_value
+        lb.hosts = []
+        lb.destroy.side_effect = lambda: manager.lb_cache.find("x")
+        manager.remove_instance("x")
+        lb.destroy.assert_called_once_with()
+        self.assertNotIn("x", manager.lb_cache.entries)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
     @mock.patch("rpaas.manager.nginx")
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_restore_instance_service_instance_not_found(self, LoadBalancer, nginx):
@@ -565,8 +874,8 @@ class ManagerTestCase(unittest.TestCase):
         self.config["RPAAS_RESTORE_DELAY"] = 1
         LoadBalancer.find.return_value = None
         manager = Manager(self.config)
-        responses = [host for host in manager.restore_instance("x")]
-        self.assertListEqual(responses, ["instance x not found\n"])
+        responses = [json.loads(host) for host in manager.restore_instance("x")]
+        self.assertListEqual(responses, [{"status": "error", "error": "instance x not found"}])
         self.assertEqual(self.storage.find_task("x").count(), 0)
 
     @mock.patch("rpaas.manager.LoadBalancer")
@@ -577,10 +886,11 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
-        manager.consul_manager.node_hostname.side_effect = ['vm-1', 'vm-2']
+        manager.consul_manager.node_hostnames.return_value = {'10.1.1.1': 'vm-1', '10.2.2.2': 'vm-2'}
         manager.consul_manager.node_status.return_value = {'vm-1': 'OK', 'vm-2': 'DEAD'}
         node_status = manager.node_status("x")
         LoadBalancer.find.assert_called_with("x")
+        manager.consul_manager.node_hostnames.assert_called_once_with(['10.1.1.1', '10.2.2.2'])
         self.assertDictEqual(node_status, {'vm-1': {'status': 'OK', 'address': '10.1.1.1'},
                                            'vm-2': {'status': 'DEAD', 'address': '10.2.2.2'}})
 
@@ -592,7 +902,7 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
-        manager.consul_manager.node_hostname.side_effect = ['vm-1', None]
+        manager.consul_manager.node_hostnames.return_value = {'10.1.1.1': 'vm-1'}
         manager.consul_manager.node_status.return_value = {'vm-1': 'OK', 'vm-2': 'DEAD'}
         node_status = manager.node_status("x")
         LoadBalancer.find.assert_called_with("x")
@@ -655,12 +965,9 @@ destination = app1.host.com (https only)"""},
         ])
         self.assertEqual(manager.status("inst"), "192.168.1.1")
 
-    @mock.patch("rpaas.manager.tasks")
-    def test_info_status_pending(self, tasks):
+    def test_info_status_pending(self):
         self.storage.store_task("x")
         self.storage.update_task("x", "something-id")
-        async_init = tasks.NewInstanceTask.return_value.AsyncResult
-        async_init.return_value.status = "PENDING"
         manager = Manager(self.config)
         info = manager.info("x")
         self.assertItemsEqual(info, [
@@ -668,15 +975,12 @@ destination = app1.host.com (https only)"""},
             {"label": "Instances", "value": "0"},
             {"label": "Routes", "value": ""},
         ])
-        async_init.assert_called_with("something-id")
         self.assertEqual(manager.status("x"), "pending")
 
-    @mock.patch("rpaas.manager.tasks")
-    def test_info_status_failure(self, tasks):
+    def test_info_status_failure(self):
         self.storage.store_task("x")
         self.storage.update_task("x", "something-id")
-        async_init = tasks.NewInstanceTask.return_value.AsyncResult
-        async_init.return_value.status = "FAILURE"
+        self.storage.mark_task_failure("x", "something-id")
         manager = Manager(self.config)
         info = manager.info("x")
         self.assertItemsEqual(info, [
@@ -684,9 +988,56 @@ destination = app1.host.com (https only)"""},
             {"label": "Instances", "value": "0"},
             {"label": "Routes", "value": ""},
         ])
-        async_init.assert_called_with("something-id")
         self.assertEqual(manager.status("x"), "failure")
 
+    def test_failed_task_records_status(self):
+        self.storage.store_task("x")
+        manager = Manager(self.config)
+        tasks.RestoreMachineTask().on_failure(Exception("boom"), "other-id", (self.config,), {}, None)
+        self.assertEqual(manager.status("x"), "pending")
+        tasks.ScaleInstanceTask().on_failure(Exception("boom"), "something-id", (self.config, "x", 2), {}, None)
+        self.assertEqual(manager.status("x"), "failure")
+        with self.assertRaises(tasks.NotReadyError):
+            manager.task_manager.ensure_ready("x")
+
+    def test_failed_task_keeps_status_of_another_task(self):
+        self.storage.store_task("x")
+        self.storage.update_task("x", "other-id")
+        manager = Manager(self.config)
+        tasks.ScaleInstanceTask().on_failure(Exception("boom"), "something-id", (self.config, "x", 2), {}, None)
+        self.assertEqual(manager.status("x"), "pending")
+
+    def test_revoked_task_records_status(self):
+        self.storage.store_task("x")
+        self.storage.update_task("x", "something-id")
+        manager = Manager(self.config)
+        request = mock.Mock(id="something-id", args=(self.config, "x", 2), kwargs={})
+        tasks.mark_revoked(sender=tasks.ScaleInstanceTask(), request=request, terminated=True)
+        self.assertEqual(manager.status("x"), "failure")
+
+    def test_failed_task_with_keyword_arguments_records_status(self):
+        self.storage.store_task("x")
+        self.storage.update_task("x", "something-id")
+        manager = Manager(self.config)
+        kwargs = {"config": self.config, "name": "x", "plugin": "le", "csr": None, "key": None, "domain": "x.com"}
+        tasks.DownloadCertTask().on_failure(Exception("boom"), "something-id", (), kwargs, None)
+        self.assertEqual(manager.status("x"), "failure")
+
+    @mock.patch.object(tasks.NewInstanceTask, "AsyncResult")
+    def test_lost_task_falls_back_to_result_backend(self, AsyncResult):
+        created = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        self.storage.store_task({"_id": "x", "task_id": "something-id", "created": created})
+        AsyncResult.return_value.status = "STARTED"
+        manager = Manager(self.config)
+        self.assertEqual(manager.status("x"), "pending")
+        AsyncResult.return_value.status = "FAILURE"
+        self.assertEqual(manager.status("x"), "failure")
+        AsyncResult.assert_called_with("something-id")
+        self.storage.remove_task("x")
+        self.storage.store_task("x")
+        self.storage.update_task("x", "other-id")
+        self.assertEqual(manager.status("x"), "pending")
+
     @mock.patch("rpaas.tasks.nginx")
     def test_scale_instance_up(self, nginx):
         lb = self.LoadBalancer.find.return_value
@@ -703,16 +1054,17 @@ destination = app1.host.com (https only)"""},
         for idx, host in enumerate(hosts):
             host.dns_name = "10.0.0.{}".format(idx + 1)
         self.Host.create.side_effect = hosts
+        wait_healthchecks_concurrently(nginx)
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
         self.assertEqual(self.Host.create.call_count, 3)
-        lb.add_host.assert_has_calls([mock.call(host) for host in hosts])
+        lb.add_host.assert_has_calls([mock.call(host) for host in hosts], any_order=True)
         self.assertEqual(lb.add_host.call_count, 3)
         nginx_manager = nginx.Nginx.return_value
         expected_calls = [mock.call("10.0.0.1", timeout=600),
                           mock.call("10.0.0.2", timeout=600),
                           mock.call("10.0.0.3", timeout=600)]
-        self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        self.assertItemsEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
         acls = manager.consul_manager.find_acl_network("x")
         expected_acls = [{'destination': ['192.168.0.0/24'], 'source': '10.0.0.1/32'},
                          {'destination': ['192.168.0.0/24'], 'source': '10.0.0.2/32'},
@@ -731,6 +1083,7 @@ destination = app1.host.com (https only)"""},
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
         manager.consul_manager.generate_token.return_value = "abc-123"
+        wait_healthchecks_concurrently(nginx)
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
         self.assertEqual(self.Host.create.call_count, 3)
@@ -756,6 +1109,7 @@ destination = app1.host.com (https only)"""},
         config.update(self.plan["config"])
         config.update(self.flavor["config"])
         config["HOST_TAGS"] = "rpaas_service:test-suite-rpaas,rpaas_instance:x,consul_token:abc-123"
+        wait_healthchecks_concurrently(nginx)
         manager = Manager(self.config)
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
@@ -769,6 +1123,230 @@ destination = app1.host.com (https only)"""},
                           mock.call(created_host.dns_name, timeout=600)]
         self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
 
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_reconciler(self, nginx):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_RECONCILER"] = "1"
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        manager = Manager(config)
+        manager.scale_instance("x", 5)
+        self.assertEqual(self.Host.create.call_count, 3)
+        self.assertEqual(lb.add_host.call_count, 3)
+        desired = self.storage.find_desired_state("x")
+        self.assertEqual(5, desired["units"])
+        self.assertEqual(1, desired["generation"])
+        self.assertEqual(1, desired["observed_generation"])
+        self.assertIsNone(desired["last_error"])
+        self.assertFalse(desired["queued"])
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.ReconcileInstanceTask.apply_async")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_reconciler_coalesces_requests(self, nginx, apply_async):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_RECONCILER"] = "1"
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        self.storage.store_task("x")
+        manager = Manager(config)
+        manager.scale_instance("x", 3)
+        manager.scale_instance("x", 4)
+        self.Host.create.assert_not_called()
+        self.assertEqual(1, apply_async.call_count)
+        desired = self.storage.find_desired_state("x")
+        self.assertEqual(4, desired["units"])
+        self.assertEqual(2, desired["generation"])
+        self.assertTrue(desired["queued"])
+        args = apply_async.call_args[1]["args"]
+        task_id = apply_async.call_args[1]["task_id"]
+        self.assertEqual(task_id, desired["queued_task_id"])
+        tasks.ReconcileInstanceTask().run(*args)
+        apply_async.assert_called_with(args=args, countdown=5.0, task_id=None)
+        manager.scale_instance("x", 4)
+        self.assertEqual(2, apply_async.call_count)
+        self.Host.create.assert_not_called()
+        self.storage.remove_task("x")
+        tasks.ReconcileInstanceTask().run(*args)
+        self.assertEqual(self.Host.create.call_count, 2)
+        desired = self.storage.find_desired_state("x")
+        self.assertEqual(2, desired["observed_generation"])
+        self.assertFalse(desired["queued"])
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.ReconcileInstanceTask.AsyncResult")
+    @mock.patch("rpaas.tasks.ReconcileInstanceTask.apply_async")
+    def test_reconcile_instance_takes_over_flag_of_failed_task(self, apply_async, async_result):
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        self.addCleanup(self.storage.remove_desired_state, "x")
+        self.storage.store_desired_state("x", units=3)
+        self.assertTrue(self.storage.queue_reconcile("x", "waiting-task"))
+        manager = Manager(self.config)
+        async_result.return_value.status = "PENDING"
+        manager.reconcile_instance("x")
+        apply_async.assert_not_called()
+        async_result.assert_called_with("waiting-task")
+        async_result.return_value.status = "FAILURE"
+        manager.reconcile_instance("x")
+        self.assertEqual(1, apply_async.call_count)
+        task_id = apply_async.call_args[1]["task_id"]
+        self.assertNotEqual("waiting-task", task_id)
+        self.assertEqual(task_id, self.storage.find_desired_state("x")["queued_task_id"])
+
+    def test_scale_instance_reconciler_negative(self):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_RECONCILER"] = "1"
+        manager = Manager(config)
+        with self.assertRaises(ScaleError):
+            manager.scale_instance("x", -1)
+        self.assertIsNone(self.storage.find_desired_state("x"))
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_reconcile_instance_restores_routes_and_acls(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2")]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        self.storage.replace_binding_path("x", "/somewhere", destination="my.other.host")
+        self.storage.replace_binding_path("x", "/custom", content="return 204;")
+        manager = Manager(self.config)
+        manager.consul_manager.store_acl_network("x", "10.0.0.1/32", "192.168.0.0/24")
+        manager.consul_manager.write_location("x", "/custom", content="return 204;")
+        manager.reconcile_instance("x")
+        self.Host.create.assert_not_called()
+        self.assertEqual(set(["/somewhere", "/custom"]), manager.consul_manager.list_locations("x"))
+        self.assertEqual(set(["my.other.host"]), manager.consul_manager.list_upstream("x", "my.other.host"))
+        acls = manager.consul_manager.find_acl_network("x")
+        expected_acls = [{'destination': ['192.168.0.0/24'], 'source': '10.0.0.1/32'},
+                         {'destination': ['192.168.0.0/24'], 'source': '10.0.0.2/32'}]
+        self.assertEqual(expected_acls, acls)
+        desired = self.storage.find_desired_state("x")
+        self.assertNotIn("units", desired)
+        self.assertEqual(1, desired["observed_generation"])
+        self.assertIsNone(desired["last_error"])
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_max_parallelism(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = []
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_SCALE_MAX_PARALLELISM"] = "2"
+        running = {"create": [0, 0], "healthcheck": [0, 0]}
+        running_lock = threading.Lock()
+
+        def track(kind, result):
+            def call(*args, **kwargs):
+                with running_lock:
+                    running[kind][0] += 1
+                    running[kind][1] = max(running[kind])
+                time.sleep(0.1)
+                with running_lock:
+                    running[kind][0] -= 1
+                return result
+            return call
+
+        self.Host.create.side_effect = track("create", mock.DEFAULT)
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.wait_healthcheck.side_effect = track("healthcheck", None)
+        wait_healthchecks_concurrently(nginx)
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.scale_instance("x", 5)
+        self.assertEqual(self.Host.create.call_count, 5)
+        self.assertEqual(len(nginx_manager.wait_healthcheck.call_args_list), 5)
+        self.assertEqual(running["create"][1], 2)
+        self.assertEqual(running["healthcheck"][1], 5)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.managers")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_spreads_alternatives_concurrently(self, nginx, managers):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.hosts = []
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_SCALE_MAX_PARALLELISM"] = "4"
+        config["HM_ALTERNATIVE_CONFIG_COUNT"] = "2"
+        running = [0, 0, 0]
+        running_lock = threading.Lock()
+
+        def create_host(name, alternative_id):
+            with running_lock:
+                running[0] += 1
+                running[1] = max(running[:2])
+                running[2] += 1
+                host_id = running[2]
+            time.sleep(0.1)
+            with running_lock:
+                running[0] -= 1
+            return Host(id="h-{}".format(host_id), dns_name="10.0.0.{}".format(host_id), alternative_id=alternative_id)
+
+        managers.by_name.return_value.create_host.side_effect = create_host
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.scale_instance("x", 4)
+        self.Host.create.assert_not_called()
+        self.assertEqual(4, running[1])
+        self.assertEqual({0: 2, 1: 2}, self.storage.count_hosts_by_alternative("x"))
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_partial_failure_and_rollback(self, nginx, hc):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ROLLBACK_ON_ERROR"] = "1"
+        hosts = [mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host in enumerate(hosts):
+            host.dns_name = "10.0.0.{}".format(idx + 1)
+        self.Host.create.side_effect = hosts
+
+        def wait_healthcheck(host, timeout):
+            if host == "10.0.0.2":
+                raise Exception("Nginx timeout")
+
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.wait_healthcheck.side_effect = wait_healthcheck
+        wait_healthchecks_concurrently(nginx)
+        dumb_hc = hc.return_value
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.scale_instance("x", 4)
+        self.assertEqual(lb.add_host.call_count, 3)
+        hosts[1].destroy.assert_called_once_with()
+        hosts[0].destroy.assert_not_called()
+        hosts[2].destroy.assert_not_called()
+        lb.remove_host.assert_called_once_with(hosts[1])
+        self.assertItemsEqual([mock.call("x", "10.0.0.1"), mock.call("x", "10.0.0.3")],
+                              dumb_hc.add_url.call_args_list)
+        dumb_hc.destroy.assert_not_called()
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+        report = self.storage.find_scale_report("x")
+        self.assertEqual(3, report["requested"])
+        self.assertItemsEqual(["10.0.0.1", "10.0.0.3"], report["added"])
+        self.assertEqual(["Exception('Nginx timeout',)"], report["failed"])
+
     def test_scale_instance_error_task_running(self):
         self.storage.store_task("x")
         manager = Manager(self.config)
@@ -795,15 +1373,38 @@ destination = app1.host.com (https only)"""},
         lb.hosts[0].id = '1234'
         self.storage.store_instance_metadata("x", consul_token="abc-123")
         self.addCleanup(self.storage.remove_instance_metadata, "x")
-        consul.node_hostname.return_value = 'rpaas-2'
+        consul.node_hostnames.return_value = {'10.2.2.2': 'rpaas-2', '10.3.3.3': 'rpaas-3'}
         manager = Manager(config)
         manager.consul_manager = mock.Mock()
         manager.consul_manager.generate_token.return_value = "abc-123"
         manager.scale_instance("x", 1)
         lb.hosts[0].destroy.assert_called_once
         lb.remove_host.assert_called_once_with(lb.hosts[0])
+        consul.node_hostnames.assert_called_once_with(['10.2.2.2'])
+        consul.node_hostname.assert_not_called()
         consul.remove_node.assert_called_once_with('x', 'rpaas-2', '1234')
 
+    def test_scale_instance_down_multiple_hosts(self):
+        lb = self.LoadBalancer.find.return_value
+        hosts = [mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host in enumerate(hosts):
+            host.dns_name = "10.0.0.{}".format(idx + 1)
+        lb.hosts = list(hosts)
+
+        def remove_host(host):
+            lb.hosts = [h for h in lb.hosts if h is not host]
+
+        lb.remove_host.side_effect = remove_host
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        manager = Manager(self.config)
+        manager.scale_instance("x", 1)
+        for host in hosts[:3]:
+            host.destroy.assert_called_once_with()
+        hosts[3].destroy.assert_not_called()
+        self.assertEqual([hosts[3]], lb.hosts)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
     def test_scale_instance_error(self):
         lb = self.LoadBalancer.find.return_value
         lb.hosts = [mock.Mock(), mock.Mock()]
@@ -1457,16 +2058,64 @@ destination = app1.host.com (https only)"""},
         lb = LoadBalancer.find.return_value
         lb.hosts = [mock.Mock(), mock.Mock()]
 
+        lb.hosts[0].dns_name = "host-1"
+        lb.hosts[1].dns_name = "host-2"
+
         manager = Manager(self.config)
         manager.nginx_manager = mock.Mock()
-        manager.nginx_manager.purge_location.side_effect = [True, True]
+        manager.nginx_manager.purge_location_hosts.return_value = {"host-1": True, "host-2": True}
         purged_hosts = manager.purge_location("inst", "/foo/bar", True)
 
         LoadBalancer.find.assert_called_with("inst")
 
         self.assertEqual(purged_hosts, 2)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[0].dns_name, "/foo/bar", True)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[1].dns_name, "/foo/bar", True)
+        manager.nginx_manager.purge_location_hosts.assert_called_once_with(["host-1", "host-2"], "/foo/bar", True)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_location_partial_failure(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        lb.hosts[0].dns_name = "host-1"
+        lb.hosts[1].dns_name = "host-2"
+
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_location_hosts.return_value = {"host-1": False, "host-2": True}
+        purged_hosts = manager.purge_location("inst", "/foo/bar")
+
+        self.assertEqual(purged_hosts, 1)
+        manager.nginx_manager.purge_location_hosts.assert_called_once_with(["host-1", "host-2"], "/foo/bar", False)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_locations(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        lb.hosts[0].dns_name = "host-1"
+        lb.hosts[1].dns_name = "host-2"
+
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.nginx_purge_bulk_timeout = 120
+        manager.nginx_manager.purge_locations.return_value = iter([
+            (("/foo/bar", False), {"host-1": True, "host-2": True}),
+            (("http://example.com/x", True), {"host-1": False, "host-2": True}),
+        ])
+        purged = manager.purge_locations("inst", [(" /foo/bar ", False), ("/foo/bar", False),
+                                                  ("http://example.com/x", True)])
+
+        self.assertEqual([(" /foo/bar ", 2), ("/foo/bar", 2), ("http://example.com/x", 1)], list(purged))
+        LoadBalancer.find.assert_called_once_with("inst")
+        manager.nginx_manager.purge_locations.assert_called_once_with(
+            ["host-1", "host-2"], [("/foo/bar", False), ("http://example.com/x", True)], 120)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_locations_instance_not_found(self, LoadBalancer):
+        LoadBalancer.find.return_value = None
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        with self.assertRaises(storage.InstanceNotFoundError):
+            manager.purge_locations("inst", [("/foo/bar", False)])
+        manager.nginx_manager.purge_locations.assert_not_called()
 
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_add_lua_with_content(self, LoadBalancer):
@@ -0,0 +1,107 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import multiprocessing
+import time
+import unittest
+
+import mock
+
+from rpaas import misc
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+
+    def test_run_concurrently_keeps_order(self):
+        def double(x):
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+
+        self.assertEqual([0, 2, 4, 6, 8], misc.run_concurrently(double, range(5), 5))
+
+    def test_run_concurrently_returns_exceptions(self):
+        def fail_on_odd(x):
+            if x % 2:
+                raise ValueError("odd {}".format(x))
+            return x
+
+        results = misc.run_concurrently(fail_on_odd, range(4), 2)
+        self.assertEqual(0, results[0])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(2, results[2])
+        self.assertIsInstance(results[3], ValueError)
+
+    def test_run_concurrently_respects_max_workers(self):
+        running = [0]
+        max_running = [0]
+        lock = multiprocessing.Lock()
+
+        def work(x):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        misc.run_concurrently(work, range(10), 3)
+        self.assertLessEqual(max_running[0], 3)
+        self.assertGreater(max_running[0], 1)
+
+    def test_run_concurrently_timeout(self):
+        def work(x):
+            time.sleep(x)
+            return x
+
+        t0 = time.time()
+        results = misc.run_concurrently(work, [0, 3], 2, timeout=0.3)
+        self.assertLess(time.time() - t0, 2)
+        self.assertEqual(0, results[0])
+        self.assertIsInstance(results[1], multiprocessing.TimeoutError)
+
+    def test_iter_concurrently_yields_as_completed(self):
+        def work(x):
+            time.sleep(x)
+            return x
+
+        results = list(misc.iter_concurrently(work, [0.2, 0], 2))
+        self.assertEqual([(0, 0), (0.2, 0.2)], results)
+
+    def test_iter_concurrently_empty(self):
+        self.assertEqual([], list(misc.iter_concurrently(lambda x: x, [], 2)))
+
+
+class ExpiringCacheTestCase(unittest.TestCase):
+
+    @mock.patch("rpaas.misc.time")
+    def test_get_keeps_values_for_ttl(self, time):
+        time.time.return_value = 100
+        load = mock.Mock(return_value="value")
+        cache = misc.ExpiringCache()
+        self.assertEqual("value", cache.get("key", load, 10))
+        time.time.return_value = 109
+        self.assertEqual("value", cache.get("key", load, 10))
+        self.assertEqual(1, load.call_count)
+        time.time.return_value = 111
+        cache.get("key", load, 10)
+        self.assertEqual(2, load.call_count)
+
+    def test_get_ttl_of_value(self):
+        cache = misc.ExpiringCache()
+        cache.get("found", lambda: "value", lambda value: 10 if value else 0)
+        cache.get("missing", lambda: None, lambda value: 10 if value else 0)
+        self.assertEqual(["found"], cache.entries.keys())
+
+    def test_invalidated_during_load(self):
+        cache = misc.ExpiringCache()
+
+        def load():
+            cache.invalidate("key")
+            return "value"
+
+        self.assertEqual("value", cache.get("key", load, 10))
+        self.assertEqual({}, cache.entries)
+        cache.get("key", lambda: "value", 10)
+        cache.clear()
+        self.assertEqual({}, cache.entries)
@@ -2,16 +2,25 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import BaseHTTPServer
+import os
+import threading
+import time
 import unittest
 
 import mock
+from requests.exceptions import ConnectionError
 
-from rpaas.nginx import Nginx, NginxError
+from rpaas import nginx as nginx_module
+from rpaas.nginx import ConfigManager, Nginx, NginxError, NginxAdminClient
 
 
 class NginxTestCase(unittest.TestCase):
 
     def setUp(self):
+        nginx_module._admin_clients.clear()
+        nginx_module._location_templates.clear()
+        nginx_module._location_template_refreshes.clear()
         self.cache_headers = [{'Accept-Encoding': 'gzip'}, {'Accept-Encoding': 'identity'}]
 
     def test_init_default(self):
@@ -19,6 +28,9 @@ class NginxTestCase(unittest.TestCase):
         self.assertEqual(nginx.nginx_manage_port, '8089')
         self.assertEqual(nginx.nginx_purge_path, '/purge')
         self.assertEqual(nginx.nginx_healthcheck_path, '/healthcheck')
+        self.assertEqual(nginx.nginx_purge_concurrency, 16)
+        self.assertEqual(nginx.nginx_purge_timeout, 10)
+        self.assertEqual(nginx.nginx_purge_bulk_timeout, 120)
 
     def test_init_config(self):
         nginx = Nginx({
@@ -41,6 +53,7 @@ class NginxTestCase(unittest.TestCase):
                 def __init__(self, text, status_code):
                     self.text = text
                     self.status_code = status_code
+                    self.headers = {}
             if args[0] == 'http://my.com/default':
                 return MockResponse("my result default", 200)
             elif args[0] == 'http://my.com/router':
@@ -53,13 +66,119 @@ class NginxTestCase(unittest.TestCase):
             })
         self.assertEqual(nginx.config_manager.location_template_default, 'my result default')
         self.assertEqual(nginx.config_manager.location_template_router, 'my result router')
-        expected_calls = [mock.call('http://my.com/default'),
-                          mock.call('http://my.com/router')]
+        expected_calls = [mock.call('http://my.com/default', headers={}, timeout=5),
+                          mock.call('http://my.com/router', headers={}, timeout=5)]
         requests_get.assert_has_calls(expected_calls)
 
+    def _template_response(self, text, status_code=200, headers=None):
+        rsp = mock.Mock()
+        rsp.text = text
+        rsp.status_code = status_code
+        rsp.headers = headers or {}
+        return rsp
+
+    def _wait_template_refreshes(self):
+        for refresh in list(nginx_module._location_template_refreshes.values()):
+            refresh.join()
+
+    @mock.patch('rpaas.nginx.requests.get')
+    def test_location_template_url_is_cached(self, requests_get):
+        requests_get.return_value = self._template_response('location {path} {{ proxy_pass http://{upstream}; }}')
+        conf = {'NGINX_LOCATION_TEMPLATE_DEFAULT_URL': 'http://my.com/default'}
+        ConfigManager(conf)
+        config_manager = ConfigManager(conf)
+        self.assertEqual(config_manager.generate_host_config('/x', 'dst', 'up'),
+                         'location /x/ { proxy_pass http://up; }')
+        requests_get.assert_called_once_with('http://my.com/default', headers={}, timeout=5)
+
+    @mock.patch('rpaas.nginx.time')
+    @mock.patch('rpaas.nginx.requests.get')
+    def test_location_template_url_revalidates_after_ttl(self, requests_get, time):
+        time.time.return_value = 1000
+        headers = {'ETag': '"v1"', 'Last-Modified': 'yesterday'}
+        requests_get.return_value = self._template_response('{path}', headers=headers)
+        conf = {'NGINX_LOCATION_TEMPLATE_DEFAULT_URL': 'http://my.com/default',
+                'NGINX_LOCATION_TEMPLATE_TTL': '60'}
+        config_manager = ConfigManager(conf)
+        time.time.return_value = 1061
+        requests_get.return_value = self._template_response('', status_code=304)
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self._wait_template_refreshes()
+        requests_get.assert_called_with('http://my.com/default', timeout=5,
+                                        headers={'If-None-Match': '"v1"', 'If-Modified-Since': 'yesterday'})
+        self.assertEqual(requests_get.call_count, 2)
+        time.time.return_value = 1100
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self.assertEqual(requests_get.call_count, 2)
+        time.time.return_value = 1200
+        requests_get.return_value = self._template_response('{path} v2', headers={'ETag': '"v2"'})
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self._wait_template_refreshes()
+        self.assertEqual(config_manager.location_template_default, '{path} v2')
+        self.assertEqual(requests_get.call_count, 3)
+
+    @mock.patch('rpaas.nginx.time')
+    @mock.patch('rpaas.nginx.requests.get')
+    def test_location_template_url_revalidates_once_in_background(self, requests_get, time):
+        time.time.return_value = 1000
+        requests_get.return_value = self._template_response('{path}')
+        conf = {'NGINX_LOCATION_TEMPLATE_DEFAULT_URL': 'http://my.com/default'}
+        config_manager = ConfigManager(conf)
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_get(*args, **kwargs):
+            fetching.set()
+            release.wait()
+            return self._template_response('{path} v2')
+
+        requests_get.side_effect = slow_get
+        time.time.return_value = 2000
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        fetching.wait()
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self.assertEqual(config_manager.generate_host_config('/x', 'dst', 'up'), '/x/')
+        release.set()
+        self._wait_template_refreshes()
+        self.assertEqual(requests_get.call_count, 2)
+        self.assertEqual(config_manager.location_template_default, '{path} v2')
+
+    @mock.patch('rpaas.nginx.time')
+    @mock.patch('rpaas.nginx.requests.get')
+    def test_location_template_url_serves_stale_on_errors(self, requests_get, time):
+        time.time.return_value = 1000
+        requests_get.return_value = self._template_response('{path}')
+        conf = {'NGINX_LOCATION_TEMPLATE_DEFAULT_URL': 'http://my.com/default'}
+        config_manager = ConfigManager(conf)
+        time.time.return_value = 2000
+        requests_get.side_effect = ConnectionError('down')
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self._wait_template_refreshes()
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        requests_get.side_effect = None
+        requests_get.return_value = self._template_response('{unknown}')
+        time.time.return_value = 3000
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self._wait_template_refreshes()
+        self.assertEqual(config_manager.location_template_default, '{path}')
+        self.assertEqual(requests_get.call_count, 3)
+
+    @mock.patch('rpaas.nginx.requests.get')
+    def test_location_template_url_error_without_cache(self, requests_get):
+        requests_get.return_value = self._template_response('not found', status_code=404)
+        with self.assertRaises(NginxError):
+            ConfigManager({'NGINX_LOCATION_TEMPLATE_DEFAULT_URL': 'http://my.com/default'})
+
+    def test_location_template_invalid(self):
+        with self.assertRaises(NginxError):
+            ConfigManager({'NGINX_LOCATION_TEMPLATE_ROUTER_TXT': 'location {path} { }'})
+        with self.assertRaises(NginxError):
+            ConfigManager({'NGINX_LOCATION_TEMPLATE_ROUTER_TXT': 'location {path} {{ {other} }}'})
+
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_successfully(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
 
         response = mock.Mock()
         response.status_code = 200
@@ -69,57 +188,134 @@ class NginxTestCase(unittest.TestCase):
         side_effect.status_code = 404
         side_effect.text = "Not Found"
 
-        requests.request.side_effect = [response, side_effect, response, side_effect]
+        session.request.side_effect = [response, side_effect, response, side_effect]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(len(session.request.call_args_list), 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
                                        headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+        session.request.assert_has_calls(expec_responses, any_order=True)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_preserve_path_successfully(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
 
         response = mock.Mock()
         response.status_code = 200
         response.text = 'purged'
 
-        requests.request.side_effect = [response]
+        session.request.side_effect = [response]
         purged = nginx.purge_location('myhost', 'http://example.com/foo/bar', True)
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 2)
+        self.assertEqual(len(session.request.call_args_list), 2)
         expected_responses = []
         for header in self.cache_headers:
             expected_responses.append(mock.call('get', 'http://myhost:8089/purge/http://example.com/foo/bar',
                                       headers=header, timeout=2))
-        requests.request.assert_has_calls(expected_responses)
+        session.request.assert_has_calls(expected_responses, any_order=True)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_not_found(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
 
         response = mock.Mock()
         response.status_code = 404
         response.text = 'Not Found'
 
-        requests.request.side_effect = [response, response, response, response]
+        session.request.side_effect = [response, response, response, response]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertFalse(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(len(session.request.call_args_list), 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
                                        headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+        session.request.assert_has_calls(expec_responses, any_order=True)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_location_hosts(self, requests):
+        nginx = Nginx()
+        session = requests.Session.return_value
+
+        def side_effect(method, url, timeout, **params):
+            response = mock.Mock()
+            response.status_code = 200
+            response.text = 'purged'
+            if url.startswith('http://host-2:'):
+                raise Exception('connection refused')
+            if url.startswith('http://host-3:') and 'https' not in url:
+                response.status_code = 404
+            return response
+
+        session.request.side_effect = side_effect
+        purged = nginx.purge_location_hosts(['host-1', 'host-2', 'host-3'], '/foo/bar')
+        self.assertDictEqual({'host-1': True, 'host-2': False, 'host-3': True}, purged)
+        self.assertEqual(len(session.request.call_args_list), 12)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_location_hosts_deadline(self, requests):
+        nginx = Nginx({'NGINX_PURGE_TIMEOUT': '0.5', 'NGINX_PURGE_CONCURRENCY': '8'})
+        session = requests.Session.return_value
+
+        def side_effect(method, url, timeout, **params):
+            if url.startswith('http://slow-host:'):
+                time.sleep(2)
+            response = mock.Mock()
+            response.status_code = 200
+            response.text = 'purged'
+            return response
+
+        session.request.side_effect = side_effect
+        t0 = time.time()
+        purged = nginx.purge_location_hosts(['host-1', 'slow-host'], '/foo/bar')
+        self.assertLess(time.time() - t0, 1.5)
+        self.assertDictEqual({'host-1': True, 'slow-host': False}, purged)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_locations(self, requests):
+        nginx = Nginx()
+        session = requests.Session.return_value
+
+        def side_effect(method, url, timeout, **params):
+            response = mock.Mock()
+            response.status_code = 200
+            response.text = 'purged'
+            if '/other' in url and url.startswith('http://host-2:'):
+                response.status_code = 404
+            return response
+
+        session.request.side_effect = side_effect
+        purged = list(nginx.purge_locations(['host-1', 'host-2'], [('/foo', False),
+                                                                   ('http://example.com/other', True)]))
+        self.assertEqual(len(session.request.call_args_list), 12)
+        self.assertItemsEqual([
+            (('/foo', False), {'host-1': True, 'host-2': True}),
+            (('http://example.com/other', True), {'host-1': True, 'host-2': False}),
+        ], purged)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_locations_without_hosts(self, requests):
+        nginx = Nginx()
+        purged = list(nginx.purge_locations([], [('/foo', False), ('/bar', False)]))
+        self.assertEqual([(('/foo', False), {}), (('/bar', False), {})], purged)
+        requests.Session.return_value.request.assert_not_called()
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_location_hosts_empty(self, requests):
+        nginx = Nginx()
+        self.assertDictEqual({}, nginx.purge_location_hosts([], '/foo/bar'))
+        requests.Session.return_value.request.assert_not_called()
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
         count = [0]
         response = mock.Mock()
         response.status_code = 200
@@ -128,17 +324,18 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise ConnectionError('connection refused')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
         count = [0]
         response = mock.Mock()
         response.status_code = 200
@@ -147,17 +344,18 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise ConnectionError('connection refused')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        self.assertEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck_invalid_response(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
         count = [0]
         response = mock.Mock()
         response.status_code = 200
@@ -166,43 +364,218 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise ConnectionError('connection refused')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         with self.assertRaises(NginxError):
             nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 6)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        self.assertGreaterEqual(session.request.call_count, 6)
+        session.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck_timeout(self, requests):
         nginx = Nginx()
+        session = requests.Session.return_value
 
         def side_effect(method, url, timeout, **params):
-            raise Exception('some error')
+            raise ConnectionError('connection refused')
 
-        requests.request.side_effect = side_effect
-        with self.assertRaises(Exception):
+        session.request.side_effect = side_effect
+        with self.assertRaises(ConnectionError):
             nginx.wait_healthcheck('myhost.com', timeout=2)
-        self.assertGreaterEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertGreaterEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
 
-    @mock.patch('os.path')
     @mock.patch('rpaas.nginx.requests')
-    def test_add_session_ticket_success(self, requests, os_path):
+    def test_healthcheck_does_not_retry(self, requests):
+        nginx = Nginx()
+        session = requests.Session.return_value
+        response = mock.Mock()
+        response.status_code = 200
+        response.text = 'STARTING'
+        session.request.return_value = response
+        with self.assertRaises(NginxError):
+            nginx.healthcheck('myhost.com')
+        session.request.assert_called_once_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        response.text = 'WORKING'
+        nginx.healthcheck('myhost.com')
+        self.assertEqual(session.request.call_count, 2)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthcheck_does_not_retry_unexpected_errors(self, requests):
+        nginx = Nginx()
+        session = requests.Session.return_value
+        session.request.side_effect = ValueError('unexpected')
+        with self.assertRaises(ValueError):
+            nginx.wait_healthcheck('myhost.com', timeout=5)
+        self.assertEqual(session.request.call_count, 1)
+
+    @mock.patch('rpaas.nginx.time')
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthcheck_backoff(self, requests, time):
+        nginx = Nginx({'NGINX_RETRY_MIN_INTERVAL': '1', 'NGINX_RETRY_MAX_INTERVAL': '4',
+                       'NGINX_RETRY_FAST_INTERVAL': '0.2'})
+        session = requests.Session.return_value
+        response = mock.Mock()
+        response.status_code = 200
+        response.text = 'WORKING'
+        failing = mock.Mock()
+        failing.status_code = 500
+        failing.text = 'starting'
+        refused = ConnectionError('connection refused')
+        session.request.side_effect = [refused, refused, refused, refused, failing, failing, response]
+        time.time.return_value = 0
+        nginx.wait_healthcheck('myhost.com', timeout=600)
+        delays = [c[0][0] for c in time.sleep.call_args_list]
+        self.assertEqual(6, len(delays))
+        for delay, (low, high) in zip(delays, [(0.5, 1), (1, 2), (2, 4), (2, 4), (0.1, 0.2), (0.2, 0.4)]):
+            self.assertGreaterEqual(delay, low)
+            self.assertLessEqual(delay, high)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthchecks(self, requests):
+        nginx = Nginx({'NGINX_RETRY_MIN_INTERVAL': '0.1', 'NGINX_RETRY_FAST_INTERVAL': '0.1'})
+        session = requests.Session.return_value
+        attempts = {}
+        lock = threading.Lock()
+
+        def side_effect(method, url, timeout, **params):
+            host = url.split('/')[2].split(':')[0]
+            with lock:
+                attempts[host] = attempts.get(host, 0) + 1
+                count = attempts[host]
+            if host == 'dead-host' or (host == 'slow-host' and count < 3):
+                raise ConnectionError('connection refused')
+            response = mock.Mock()
+            response.status_code = 200
+            response.text = 'WORKING'
+            return response
+
+        session.request.side_effect = side_effect
+        results = list(nginx.wait_healthchecks(['slow-host', 'dead-host', 'fast-host'], timeout=1))
+        self.assertEqual(['fast-host', 'slow-host', 'dead-host'], [host for host, _ in results])
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][1])
+        self.assertIsInstance(results[2][1], ConnectionError)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_add_session_ticket_success(self, requests):
         nginx = Nginx({'CA_CERT': 'cert data'})
-        os_path.exists.return_value = True
+        session = requests.Session.return_value
         response = mock.Mock()
         response.status_code = 200
         response.text = '\n\nticket was succsessfully added'
-        requests.request.return_value = response
+        session.request.return_value = response
+        ca_path = nginx.admin_client.ca_path
+        self.addCleanup(os.remove, ca_path)
+        nginx.add_session_ticket('host-1', 'random data', timeout=2)
         nginx.add_session_ticket('host-1', 'random data', timeout=2)
-        requests.request.assert_called_once_with('post', 'https://host-1:8090/session_ticket', timeout=2,
-                                                 data='random data', verify='/tmp/rpaas_ca.pem')
+        self.assertEqual(ca_path, session.verify)
+        with open(ca_path) as ca_file:
+            self.assertEqual('cert data', ca_file.read())
+        session.request.assert_called_with('post', 'https://host-1:8090/session_ticket', timeout=2,
+                                           data='random data')
+        self.assertEqual(2, session.request.call_count)
+        requests.Session.assert_called_once_with()
 
     @mock.patch('rpaas.nginx.requests')
     def test_missing_ca_cert(self, requests):
         nginx = Nginx()
         with self.assertRaises(NginxError):
             nginx.add_session_ticket('host-1', 'random data', timeout=2)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '7')
+        self.end_headers()
+        self.wfile.write('WORKING')
+
+    def log_message(self, *args):
+        pass
+
+
+class NginxAdminClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        nginx_module._admin_clients.clear()
+
+    def test_nginx_shares_admin_client(self):
+        nginx1 = Nginx({'CA_CERT': 'cert'})
+        nginx2 = Nginx({'CA_CERT': 'cert'})
+        nginx3 = Nginx({'CA_CERT': 'cert', 'NGINX_ADMIN_POOL_MAXSIZE': '8'})
+        self.assertIs(nginx1.admin_client, nginx2.admin_client)
+        self.assertIsNot(nginx1.admin_client, nginx3.admin_client)
+        self.assertEqual(4, nginx1.admin_client.pool_maxsize)
+        self.assertEqual(8, nginx3.admin_client.pool_maxsize)
+
+    def test_session_per_host_port_and_scheme(self):
+        client = NginxAdminClient(ca_cert='cert')
+        self.addCleanup(os.remove, client.ca_path)
+        session = client.session('host-1', 8089, 'http')
+        self.assertIs(session, client.session('host-1', '8089', 'http'))
+        self.assertIsNot(session, client.session('host-1', 8090, 'https'))
+        self.assertIsNot(session, client.session('host-2', 8089, 'http'))
+        self.assertEqual(3, len(client.sessions))
+
+    def test_ca_file_per_certificate(self):
+        client1 = NginxAdminClient(ca_cert='cert1')
+        client2 = NginxAdminClient(ca_cert='cert2')
+        self.assertNotEqual(client1.ca_path, client2.ca_path)
+        self.assertEqual(client1.ca_path, NginxAdminClient(ca_cert='cert1').ca_path)
+        self.addCleanup(os.remove, client1.ca_path)
+        self.addCleanup(os.remove, client2.ca_path)
+        self.assertEqual(client1.ca_path, client1.session('host-1', 8090, 'https').verify)
+        self.assertEqual(client2.ca_path, client2.session('host-1', 8090, 'https').verify)
+        os.remove(client1.ca_path)
+        client1.session('host-2', 8090, 'https')
+        for ca_path, cert in [(client1.ca_path, 'cert1'), (client2.ca_path, 'cert2')]:
+            with open(ca_path) as ca_file:
+                self.assertEqual(cert, ca_file.read())
+
+    def test_evicts_least_recently_used_session(self):
+        client = NginxAdminClient(max_hosts=2)
+        session1 = client.session('host-1', 8089, 'http')
+        session2 = client.session('host-2', 8089, 'http')
+        client.session('host-1', 8089, 'http')
+        with mock.patch.object(session2, 'close') as close:
+            client.session('host-3', 8089, 'http')
+        close.assert_not_called()
+        self.assertEqual([('host-1', '8089', 'http'), ('host-3', '8089', 'http')], client.sessions.keys())
+        self.assertIs(session1, client.session('host-1', 8089, 'http'))
+        self.assertEqual(1, client.stats()['evicted_hosts'])
+
+    def test_https_without_ca_cert(self):
+        client = NginxAdminClient()
+        with self.assertRaises(NginxError):
+            client.session('host-1', 8090, 'https')
+
+    def test_reuses_connections(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = NginxAdminClient()
+        try:
+            port = server.server_address[1]
+            for _ in range(3):
+                rsp = client.request('get', 'http', '127.0.0.1', port, 'healthcheck', timeout=2)
+                self.assertEqual('WORKING', rsp.text)
+            stats = client.stats()
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual({'hosts': 1, 'max_hosts': 256, 'pool_maxsize': 4, 'evicted_hosts': 0,
+                          'requests': 3, 'connections': 1, 'reused_connections': 2}, stats)
+
+    def test_admin_clients_stats(self):
+        client = nginx_module.get_admin_client(max_hosts=2)
+        client.session('host-1', 8089, 'http')
+        self.assertEqual([{'hosts': 1, 'max_hosts': 2, 'pool_maxsize': 4, 'evicted_hosts': 0,
+                           'requests': 0, 'connections': 0, 'reused_connections': 0}],
+                         nginx_module.admin_clients_stats())
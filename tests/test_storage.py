@@ -92,6 +92,18 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual("wat?", p.description)
         self.assertEqual({"serviceofferingid": "abcdef123459"}, p.config)
 
+    def test_find_plan_config(self):
+        p = plan.Plan(name="super_huge", description="very huge thing",
+                      config={"serviceofferingid": "abcdef123"})
+        self.storage.store_plan(p)
+        version, config = self.storage.find_plan_config(p.name)
+        self.assertEqual({"serviceofferingid": "abcdef123"}, config)
+        self.storage.update_plan(p.name, config={"serviceofferingid": "abcdef123459"})
+        self.assertEqual((version + 1, {"serviceofferingid": "abcdef123459"}),
+                         self.storage.find_plan_config(p.name))
+        with self.assertRaises(storage.PlanNotFoundError):
+            self.storage.find_plan_config("huge")
+
     def test_update_plan_partial(self):
         p = plan.Plan(name="super_huge", description="very huge thing",
                       config={"serviceofferingid": "abcdef123"})
@@ -270,3 +282,44 @@ class MongoDBStorageTestCase(unittest.TestCase):
         expected.reverse()
         healing_list = self.storage.list_healings(3)
         self.assertListEqual(healing_list, expected)
+
+    def test_store_update_find_remove_provisions(self):
+        self.storage.store_provision({"_id": "x:1", "instance": "x", "step": "create_host", "state": "running"})
+        self.storage.store_provision({"_id": "x:2", "instance": "x", "step": "create_host", "state": "running"})
+        self.storage.store_provision({"_id": "y:1", "instance": "y", "step": "create_lb", "state": "running"})
+        self.storage.update_provision("x:1", {"step": "add_to_lb", "host_id": "h-1"})
+        self.assertDictEqual({"_id": "x:1", "instance": "x", "step": "add_to_lb", "state": "running",
+                              "host_id": "h-1"}, self.storage.find_provision("x:1"))
+        running = self.storage.find_provisions({"instance": "x", "state": "running"})
+        self.assertEqual(["x:1", "x:2"], sorted([p["_id"] for p in running]))
+        self.storage.remove_provisions({"instance": "x"})
+        self.assertIsNone(self.storage.find_provision("x:1"))
+        self.assertEqual(1, self.storage.find_provisions({}).count())
+
+    def test_bulk_update_tasks(self):
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1", "created": "old"})
+        self.storage.store_task("restore_10.2.2.2")
+        self.storage.bulk_update_tasks(store=[{"_id": "restore_10.1.1.1", "host": "10.1.1.1", "created": "new"},
+                                              {"_id": "restore_10.3.3.3", "host": "10.3.3.3", "created": "new"}],
+                                       remove=["restore_10.2.2.2", "restore_10.4.4.4"])
+        tasks = list(self.storage.find_task({}).sort("_id"))
+        self.assertListEqual([{"_id": "restore_10.1.1.1", "host": "10.1.1.1", "created": "old"},
+                              {"_id": "restore_10.3.3.3", "host": "10.3.3.3", "created": "new"}], tasks)
+        self.storage.bulk_update_tasks()
+
+    def test_find_hosts_by_dns_name(self):
+        hosts = self.storage.db[self.storage.hosts_collection]
+        hosts.insert({"_id": 1, "dns_name": "10.1.1.1"})
+        hosts.insert({"_id": 2, "dns_name": "10.2.2.2"})
+        hosts.insert({"_id": 3, "dns_name": "10.3.3.3"})
+        found = self.storage.find_hosts_by_dns_name(["10.1.1.1", "10.3.3.3", "10.4.4.4"])
+        self.assertDictEqual({"10.1.1.1": {"_id": 1, "dns_name": "10.1.1.1"},
+                              "10.3.3.3": {"_id": 3, "dns_name": "10.3.3.3"}}, found)
+
+    def test_count_hosts_by_group(self):
+        hosts = self.storage.db[self.storage.hosts_collection]
+        hosts.insert({"_id": 1, "group": "foo"})
+        hosts.insert({"_id": 2, "group": "foo"})
+        hosts.insert({"_id": 3, "group": "bar"})
+        hosts.insert({"_id": 4, "group": "baz"})
+        self.assertDictEqual({"foo": 2, "bar": 1}, self.storage.count_hosts_by_group(["foo", "bar", "qux"]))
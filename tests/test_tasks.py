@@ -7,6 +7,8 @@ import os
 import redis
 import time
 
+import mock
+
 from rpaas import tasks
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
@@ -115,3 +117,89 @@ class TasksTestCase(unittest.TestCase):
                              'sentinel_connection_shared_{}'.format(x))
         self.assertEqual(id(app_client[0].connection_pool), id(app_client[9].connection_pool))
         self.assertEqual(self.redis_clients_manager(), 1)
+
+
+class WorkerRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = tasks.WorkerRegistry(max_size=2)
+
+    def test_get_reuses_instances_for_same_config(self):
+        factory = mock.Mock(side_effect=lambda config: object())
+        first = self.registry.get(factory, {"a": "1", "b": "2"})
+        second = self.registry.get(factory, {"b": "2", "a": "1"})
+        self.assertIs(first, second)
+        factory.assert_called_once_with({"a": "1", "b": "2"})
+        third = self.registry.get(factory, {"a": "2"})
+        self.assertIsNot(first, third)
+        self.assertEqual(2, factory.call_count)
+
+    def test_get_keys_on_factory_and_args(self):
+        factory = mock.Mock(side_effect=lambda config, *args: object())
+        other = mock.Mock(side_effect=lambda config, *args: object())
+        self.assertIsNot(self.registry.get(factory, {}), self.registry.get(other, {}))
+        self.assertIsNot(self.registry.get(factory, {}), self.registry.get(factory, {}, "x"))
+        built = object()
+        self.assertIs(built, self.registry.get(factory, {}, "y", build=lambda: built))
+        self.assertIs(built, self.registry.get(factory, {}, "y"))
+
+    def test_get_considers_environment(self):
+        factory = mock.Mock(side_effect=lambda config: object())
+        first = self.registry.get(factory, {})
+        os.environ["RPAAS_REGISTRY_TEST"] = "1"
+        self.addCleanup(os.environ.pop, "RPAAS_REGISTRY_TEST")
+        self.assertIsNot(first, self.registry.get(factory, {}))
+
+    def test_lru_eviction(self):
+        factory = mock.Mock(side_effect=lambda config: object())
+        first = self.registry.get(factory, {"n": 1})
+        self.registry.get(factory, {"n": 2})
+        self.assertIs(first, self.registry.get(factory, {"n": 1}))
+        self.registry.get(factory, {"n": 3})
+        self.assertEqual(2, len(self.registry))
+        self.assertIs(first, self.registry.get(factory, {"n": 1}))
+        self.assertEqual(3, factory.call_count)
+        self.registry.get(factory, {"n": 2})
+        self.assertEqual(4, factory.call_count)
+
+    def test_invalidate(self):
+        factory = mock.Mock(side_effect=lambda config: object())
+        first = self.registry.get(factory, {"n": 1})
+        second = self.registry.get(factory, {"n": 2})
+        self.registry.invalidate({"n": 1})
+        self.assertIsNot(first, self.registry.get(factory, {"n": 1}))
+        self.assertIs(second, self.registry.get(factory, {"n": 2}))
+        self.registry.invalidate()
+        self.assertEqual(0, len(self.registry))
+
+    @mock.patch("rpaas.tasks.registry", tasks.WorkerRegistry())
+    @mock.patch("rpaas.tasks.consul_manager")
+    @mock.patch("rpaas.tasks.storage")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_init_config_reuses_collaborators(self, nginx, storage, consul_manager):
+        config = {"RPAAS_SERVICE_NAME": "test-registry"}
+        first = tasks.CheckMachineTask()
+        first.init_config(config)
+        second = tasks.SessionResumptionTask()
+        second.init_config(dict(config))
+        nginx.Nginx.assert_called_once_with(config)
+        consul_manager.ConsulManager.assert_called_once_with(config)
+        self.assertIs(first.nginx_manager, second.nginx_manager)
+        self.assertIs(first.consul_manager, second.consul_manager)
+        self.assertIs(first.storage, second.storage)
+        self.assertIs(first.task_manager, second.task_manager)
+        self.assertIsNot(first.lock_manager, second.lock_manager)
+
+    @mock.patch("rpaas.tasks.registry", tasks.WorkerRegistry())
+    @mock.patch("rpaas.tasks.consul_manager")
+    @mock.patch("rpaas.tasks.storage")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_init_config_builds_acl_manager_per_run(self, nginx, storage, consul_manager):
+        config = {"RPAAS_SERVICE_NAME": "test-registry", "CHECK_ACL_API": "1"}
+        first = tasks.ScaleInstanceTask()
+        first.init_config(config)
+        second = tasks.ScaleInstanceTask()
+        second.init_config(dict(config))
+        self.assertIs(first.consul_manager, second.consul_manager)
+        self.assertIsNot(first.acl_manager, second.acl_manager)
+        self.assertIsNot(first.acl_manager.lock_manager, second.acl_manager.lock_manager)
@@ -0,0 +1,200 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import time
+import unittest
+import redis
+
+from mock import patch
+from rpaas import storage, tasks, warm_pool
+from rpaas.nginx import NginxError
+from hm import managers
+from hm.model.host import Host
+
+tasks.app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class FakeManager(managers.BaseManager):
+
+    host_id = 0
+    tags = {}
+    destroyed = []
+
+    def __init__(self, config=None):
+        super(FakeManager, self).__init__(config)
+
+    def create_host(self, name=None, alternative_id=0):
+        FakeManager.host_id += 1
+        id = "vm-{}".format(FakeManager.host_id)
+        FakeManager.tags[id] = self.get_conf("HOST_TAGS", "").split(",")
+        return Host(id=id, dns_name="10.0.0.{}".format(FakeManager.host_id), alternative_id=alternative_id)
+
+    def tag_vm(self, tags, id, project_id=None):
+        FakeManager.tags[id] = tags
+
+    def destroy_host(self, id):
+        FakeManager.destroyed.append(id)
+
+
+managers.register('fake-pool', FakeManager)
+
+
+class WarmPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            "MONGO_DATABASE": "warm_pool_test",
+            "RPAAS_SERVICE_NAME": "test_rpaas_warm_pool",
+            "HOST_MANAGER": "fake-pool",
+            "RPAAS_WARM_POOLS": "small=2",
+        }
+        self.storage = storage.MongoDBStorage(self.config)
+        colls = self.storage.db.collection_names(False)
+        for coll in colls:
+            self.storage.db.drop_collection(coll)
+        self.storage.db[self.storage.plans_collection].insert(
+            {"_id": "small", "description": "small plan", "config": {"serviceofferingid": "abcdef123456"}}
+        )
+        FakeManager.host_id = 0
+        FakeManager.tags = {}
+        FakeManager.destroyed = []
+        redis.StrictRedis().flushall()
+
+    def pool_hosts(self, state=None):
+        query = {"group": "rpaas-pool-small-"}
+        if state:
+            query["pool_state"] = state
+        return sorted(h["_id"] for h in self.storage.db[self.storage.hosts_collection].find(query))
+
+    def add_pool_host(self, state):
+        host = Host.create("fake-pool", "rpaas-pool-small-", self.config)
+        self.storage.update_pool_host(host.id, state)
+        return host
+
+    def test_parse_warm_pools(self):
+        self.assertEqual({}, tasks.parse_warm_pools(None))
+        self.assertEqual({"small/": 2, "small/vanilla": 1, "/": 3},
+                         tasks.parse_warm_pools("small=2, small/vanilla=1,=3,"))
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_fills_pool(self, nginx):
+        tasks.ReplenishWarmPoolTask().run(self.config)
+        self.assertEqual(["vm-1", "vm-2"], self.pool_hosts("ready"))
+        self.assertEqual(["rpaas_service:test_rpaas_warm_pool", "rpaas_pool:small/"], FakeManager.tags["vm-1"])
+        self.assertEqual(2, nginx.Nginx.return_value.wait_healthcheck.call_count)
+        stats = self.storage.list_warm_pool_stats()
+        self.assertEqual(1, len(stats))
+        self.assertEqual("small/", stats[0]["_id"])
+        self.assertEqual(2, stats[0]["replenished"])
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_tops_up_and_discards_stale_booting_hosts(self, nginx):
+        self.add_pool_host("ready")
+        self.add_pool_host("booting")
+        tasks.ReplenishWarmPoolTask().run(self.config)
+        self.assertEqual(["vm-2"], FakeManager.destroyed)
+        self.assertEqual(["vm-1", "vm-3"], self.pool_hosts("ready"))
+        self.assertEqual(["vm-1", "vm-3"], self.pool_hosts())
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_discards_unfinished_creations(self, nginx):
+        Host.create("fake-pool", "rpaas-pool-small-", self.config)
+        self.storage.store_pool_entry("rpaas-pool-small-", "fake-pool")
+        tasks.ReplenishWarmPoolTask().run(self.config)
+        self.assertEqual(["vm-1"], FakeManager.destroyed)
+        self.assertEqual(["vm-2", "vm-3"], self.pool_hosts("ready"))
+        self.assertEqual(["vm-2", "vm-3"], self.pool_hosts())
+        self.assertEqual([], self.storage.list_pool_entries("rpaas-pool-small-"))
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_renews_lock_while_running(self, nginx):
+        conn = redis.StrictRedis()
+        held = []
+
+        def wait_healthcheck(host, timeout):
+            time.sleep(1.5)
+            held.append(conn.get("warm_pool:test_rpaas_warm_pool") is not None)
+
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        tasks.ReplenishWarmPoolTask().run(dict(self.config, WARM_POOL_LOCK_LEASE="1"))
+        self.assertEqual([True, True], held)
+        self.assertEqual(["vm-1", "vm-2"], self.pool_hosts("ready"))
+        self.assertIsNone(conn.get("warm_pool:test_rpaas_warm_pool"))
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_destroys_unhealthy_hosts(self, nginx):
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = NginxError("timeout")
+        tasks.ReplenishWarmPoolTask().run(self.config)
+        self.assertEqual([], self.pool_hosts())
+        self.assertItemsEqual(["vm-1", "vm-2"], FakeManager.destroyed)
+        self.assertEqual(2, self.storage.list_warm_pool_stats()[0]["replenish_failures"])
+
+    @patch("rpaas.tasks.nginx")
+    def test_replenish_skips_when_already_running(self, nginx):
+        lock = redis.StrictRedis().lock("warm_pool:test_rpaas_warm_pool", timeout=60)
+        lock.acquire()
+        self.addCleanup(lock.release)
+        tasks.ReplenishWarmPoolTask().run(self.config)
+        self.assertEqual([], self.pool_hosts())
+
+    def test_claim_pooled_host(self):
+        self.add_pool_host("ready")
+        self.storage.store_instance_metadata("x", plan_name="small")
+        config = dict(self.config, HOST_TAGS="rpaas_service:test_rpaas_warm_pool,rpaas_instance:x")
+        task = tasks.NewInstanceTask()
+        task.init_config(config)
+        host = task._create_host("x", config)
+        self.assertEqual("vm-1", host.id)
+        self.assertEqual(["rpaas_service:test_rpaas_warm_pool", "rpaas_instance:x"], FakeManager.tags["vm-1"])
+        self.assertEqual([], self.pool_hosts())
+        stored = self.storage.db[self.storage.hosts_collection].find_one({"_id": "vm-1"})
+        self.assertEqual("x", stored["group"])
+        self.assertNotIn("pool_state", stored)
+        self.assertEqual(1, self.storage.list_warm_pool_stats()[0]["hits"])
+
+    def test_claim_pooled_host_in_least_used_alternative(self):
+        hosts = self.storage.db[self.storage.hosts_collection]
+        hosts.insert({"_id": "vm-0", "dns_name": "10.0.0.100", "group": "x", "alternative_id": 0,
+                      "manager": "fake-pool"})
+        for i in xrange(2):
+            hosts.insert({"_id": "vm-{}".format(i + 1), "dns_name": "10.0.0.{}".format(i + 1),
+                          "group": "rpaas-pool-small-", "alternative_id": i, "pool_state": "ready",
+                          "manager": "fake-pool"})
+        self.storage.store_instance_metadata("x", plan_name="small")
+        config = dict(self.config, HM_ALTERNATIVE_CONFIG_COUNT="2")
+        task = tasks.NewInstanceTask()
+        task.init_config(config)
+        host = task._create_host("x", config)
+        self.assertEqual("vm-2", host.id)
+        self.assertEqual(1, host.alternative_id)
+        self.assertEqual(["vm-1"], self.pool_hosts("ready"))
+
+    def test_claim_pooled_host_miss(self):
+        self.add_pool_host("booting")
+        self.storage.store_instance_metadata("x", plan_name="small")
+        task = tasks.NewInstanceTask()
+        task.init_config(self.config)
+        host = task._create_host("x", self.config)
+        self.assertEqual("vm-2", host.id)
+        self.assertEqual(["vm-1"], self.pool_hosts())
+        self.assertEqual(1, self.storage.list_warm_pool_stats()[0]["misses"])
+
+    def test_claim_pooled_host_without_pool(self):
+        self.add_pool_host("ready")
+        self.storage.store_instance_metadata("x", plan_name="huge")
+        task = tasks.NewInstanceTask()
+        task.init_config(self.config)
+        host = task._create_host("x", self.config)
+        self.assertEqual("vm-2", host.id)
+        self.assertEqual(["vm-1"], self.pool_hosts("ready"))
+        self.assertEqual([], self.storage.list_warm_pool_stats())
+
+    @patch("rpaas.warm_pool.tasks")
+    def test_warm_pool_scheduler(self, tasks):
+        config = dict(self.config, WARM_POOL_RUN_INTERVAL=2)
+        pool = warm_pool.WarmPool(config)
+        pool.start()
+        time.sleep(1)
+        pool.stop()
+        tasks.ReplenishWarmPoolTask.return_value.delay.assert_called_once_with(config)